@@ -0,0 +1,11 @@
+from db_def import db
+from db_def import AccountSite
+from db_def import rebuild_account_sites
+
+# rebuilds the account_site membership table from the notes and feedbacks;
+# the listeners in db_def keep it up to date afterwards.
+
+print "rebuilding account_site..."
+with db.engine.begin() as connection:
+    rebuild_account_sites(connection)
+print "Done. (" + str(AccountSite.query.count()) + " memberships.)"
@@ -6,7 +6,7 @@ from flask import Response
 from flask import render_template
 from flask import make_response, current_app
 from flask_bootstrap import Bootstrap
-from flask import jsonify
+from flask import stream_with_context
 from flask.json import JSONEncoder
 
 from functools import update_wrapper
@@ -21,19 +21,49 @@ from db_def import Media
 from db_def import Feedback
 from db_def import Site
 from db_def import InteractionLog
+from db_def import InteractionBatch
+from db_def import DeviceHeartbeat
+from db_def import DEFAULT_DEVICE
+from db_def import AccountSite
+from db_def import DailyStat
+from db_def import Job
+from db_def import DAILY_STAT_METRICS
+from db_def import notes_to_hash
+from db_def import feedbacks_to_hash
+from db_def import context_registry
+from db_def import project_hashes
+from db_def import normalize_hashes
+from db_def import site_target_feedbacks
+from db_def import site_commenter_ids
+from db_def import site_feedback_ids
 
 import notification
 import trello_api
+import jobs
+import auth
+import serializer
+import cache
+import interactions
+import export
 import re
 from sqlalchemy import or_
 from sqlalchemy import and_
 from sqlalchemy import func
 from sqlalchemy import distinct
+from sqlalchemy import case
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError
 import traceback
+import base64
+import hashlib
+import shutil
+import tempfile
+import uuid
+from StringIO import StringIO
 
 from datetime import datetime
 from datetime import timedelta
-import calendar
 
 import cloudinary
 import cloudinary.api
@@ -98,13 +128,7 @@ class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         try:
             if isinstance(obj, datetime):
-                if obj.utcoffset() is not None:
-                    obj = obj - obj.utcoffset()
-                millis = int(
-                    calendar.timegm(obj.timetuple()) * 1000 +
-                    obj.microsecond / 1000
-                )
-                return millis
+                return serializer.epoch_millis(obj)
             iterable = iter(obj)
         except TypeError:
             pass
@@ -115,23 +139,75 @@ class CustomJSONEncoder(JSONEncoder):
 app.json_encoder = CustomJSONEncoder  
 
 def success(data):
-    return jsonify({"status_code": 200, "status_txt": "OK",         
+    return serializer.response({"status_code": 200, "status_txt": "OK",         
         "data": data})
 
+# rows fetched per round trip when streaming a whole table
+STREAM_BATCH_SIZE = 500
+
+def stream_success(query, serialize, batch_size=STREAM_BATCH_SIZE):
+    # same body as success(query.all()) but sent chunked: rows come from a
+    # server-side cursor and are encoded one batch at a time, so memory does
+    # not grow with the size of the table. serialize turns a list of rows
+    # into a list of hashes.
+    def generate():
+        yield '{"status_code": 200, "status_txt": "OK", "data": ['
+        separator = ''
+        batch = []
+        for row in query.execution_options(stream_results=True).yield_per(batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield separator + ', '.join(serializer.dumps(h) for h in serialize(batch))
+                separator = ', '
+                batch = []
+        if len(batch) > 0:
+            yield separator + ', '.join(serializer.dumps(h) for h in serialize(batch))
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def paged_success(data, cursor):
+    return serializer.response({"status_code": 200, "status_txt": "OK",
+        "data": data, "cursor": cursor})
+
+def list_success(hashes, etag=None, **extra):
+    # success() for a list of rows, extra goes next to data (the cursor).
+    # ?fields=a,b keeps only those keys of each row. ?normalize=1 sends each
+    # context, site and account once under "included", the rows refer to
+    # them by id.
+    fields = request.args.get('fields')
+    if fields:
+        hashes = project_hashes(hashes, [x.strip() for x in fields.split(',')])
+    body = {"status_code": 200, "status_txt": "OK", "data": hashes}
+    if request.args.get('normalize') == '1':
+        body['data'], body['included'] = normalize_hashes(hashes)
+    body.update(extra)
+    response = serializer.response(body)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+def rows_version(query, column):
+    # changes when a row of query is added, removed or has column bumped
+    return tuple(query.with_entities(func.max(column), func.count()).order_by(None).one())
+
+def request_etag(*versions):
+    # the same request over rows of the same versions gets the same body
+    return hashlib.sha1(repr((request.full_path,) + versions)).hexdigest()
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
 def error(msg):
-    return jsonify({"status_code": 400, "status_txt": msg}), 400
+    return serializer.response({"status_code": 400, "status_txt": msg}), 400
     
 def auth_error():
-    return jsonify({"status_code": 403, "status_txt": "You are not allowed to perform this action"}), 403
+    return serializer.response({"status_code": 403, "status_txt": "You are not allowed to perform this action"}), 403
 
 def validate_credentials(args):
-    username = args.get('username')
-    password = args.get('password')
-    if username is not None and password is not None:
-        account = Account.query.filter_by(username=username).first()
-        if account is not None and account.password == password:
-            return account
-    return None
+    # a token or username/password, see auth.py
+    return auth.authenticate(args, request.headers)
         
 
 @app.route('/api')
@@ -146,7 +222,7 @@ def api():
 @crossdomain(origin='*')
 def api_accounts_count():
     n = Account.query.count()
-    return jsonify({'success' : True, 'data' : n})
+    return serializer.response({'success' : True, 'data' : n})
 
 @app.route('/api/account/delete/<username>', methods = ['GET'])
 @crossdomain(origin='*')
@@ -176,7 +252,7 @@ def api_account_update(username):
             if 'icon_url' in f:
                 account.icon_url = f['icon_url']
             if 'password' in f:
-                account.password = f['password']
+                auth.set_password(account, f['password'])
             if 'consent' in f:
                 account.consent = f['consent']
             if 'affiliation' in f:
@@ -201,7 +277,7 @@ def api_account_new(username):
                 newAccount.name = f['name']
                 newAccount.email = f['email']
                 newAccount.consent = f['consent']
-                newAccount.password = f['password']
+                auth.set_password(newAccount, f['password'])
                 newAccount.created_at = datetime.now()
                 if 'icon_url' in f:
                     newAccount.icon_url = f['icon_url']
@@ -227,7 +303,10 @@ def api_account_login():
         requesting_user = validate_credentials(request.form)
         if requesting_user is not None:
             #login successful
-            return success(requesting_user.to_hash_short())
+            account = Account.query.get(requesting_user.id)
+            h = account.to_hash_short()
+            h['token'] = auth.issue_token(requesting_user)
+            return success(h)
         return error('Invalid username or password')
     else:
         return error('Username or password is not specified')
@@ -249,19 +328,19 @@ def api_account_get(query):
 @crossdomain(origin='*')
 def api_account_get_notes(username):
     account = Account.query.filter_by(username=username).first()
-    return success([x.to_hash() for x in account.notes])
+    return list_success(notes_to_hash(account.notes))
 
 @app.route('/api/account/<username>/feedbacks')
 @crossdomain(origin='*')
 def api_account_get_feedbacks(username):
     account = Account.query.filter_by(username=username).first()
-    return success([x.to_hash() for x in account.feedbacks])
+    return success(feedbacks_to_hash(account.feedbacks))
 
 @app.route('/api/accounts')
 @crossdomain(origin='*')
 def api_accounts_list():
     accounts = Account.query.all()
-    return success([x.to_hash() for x in accounts])
+    return list_success([x.to_hash() for x in accounts])
 
 @app.route('/api/account/<username>/activity/<activityname>/countstats')
 @crossdomain(origin='*')
@@ -286,13 +365,13 @@ def api_account_activity_countstats(username, activityname):
 @crossdomain(origin='*')
 def api_webaccounts_count():
     n = WebAccount.query.count()
-    return jsonify({'success' : True, 'data' : n})
+    return serializer.response({'success' : True, 'data' : n})
 
 @app.route('/api/webaccounts')
 @crossdomain(origin='*')
 def api_webaccounts_list():
     accounts = WebAccount.query.all()
-    return success([x.to_hash() for x in accounts])
+    return list_success([x.to_hash() for x in accounts])
 
 @app.route('/api/webaccount/update/<username>', methods = ['POST','GET'])
 @crossdomain(origin='*')
@@ -390,10 +469,11 @@ def api_note_delete(id):
     note = Note.query.get(id)
     if note is not None:
         requesting_user = validate_credentials(request.args)
-        if requesting_user is not None and note.account.username == requesting_user.username:
+        if requesting_user is not None and note.account_id == requesting_user.id:
             print "deleting %s " % note.to_hash()
-            trello_api.delete_card(note.id)
+            jobs.enqueue('trello_delete_card', note_id=note.id)
             note.status = "deleted"
+            note.modified_at = datetime.now()
             db.session.commit()
             return success({})
         else:
@@ -401,13 +481,29 @@ def api_note_delete(id):
     else:
         return error("note does not exist")
 
+# notes sent by /api/notes without n
+NOTES_LIMIT = 1000
+
 @app.route('/api/notes')
 @crossdomain(origin='*')
 def api_note_list():    
     format = request.args.get('format', 'full')
-    n = request.args.get('n',1000)
-    notes = Note.query.limit(n)
-    return success([x.to_hash(format) for x in notes])
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    # the versions are the ones of the notes sent
+    page = Note.query.with_entities(Note.id).order_by(Note.id).limit(n or NOTES_LIMIT).subquery()
+    notes = Note.query.filter(Note.id.in_(page))
+    versions = [rows_version(notes, Note.modified_at)]
+    if format == 'full':
+        # the full hashes embed the feedbacks on the notes
+        versions.append(rows_version(Feedback.query.filter(Feedback.table_name == 'note').
+            filter(Feedback.row_id.in_(page)), Feedback.modified_at))
+        versions += embedded_versions()
+    etag = request_etag(*versions)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    return list_success(notes_to_hash(notes.order_by(Note.id), format), etag)
 
 @app.route('/api/designideas/at/<site>')
 @crossdomain(origin='*')
@@ -416,11 +512,19 @@ def api_designidea_list_at_site(site):
     the_site = Site.query.filter_by(name=site).first()
     if not the_site:
         return error("site does not exist")
-    
-    notes = Note.query.filter(Note.kind.ilike('designidea')).order_by(Note.modified_at.asc()).all()
-    context_ids = [c.id for c in the_site.contexts]
-    notes = [x for x in notes if x.context_id in context_ids]
-    return success([x.to_hash(format) for x in notes])
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    position = get_position(request.args)
+    if position is False:
+        return error("invalid cursor")
+
+    notes = site_notes_query(the_site, 'DesignIdea')
+    etag = request_etag(*site_notes_versions(the_site, notes, format))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    notes, cursor = keyset_page(notes, Note.modified_at, Note.id, position, n)
+    return list_success(notes_to_hash(notes, format), etag, cursor=cursor)
 
 @app.route('/api/notes/at/<site>')
 @crossdomain(origin='*')
@@ -429,24 +533,31 @@ def api_notes_list_at_site(site):
     the_site = Site.query.filter_by(name=site).first()
     if not the_site:
         return error("site does not exist")
-    
-    notes = Note.query.filter(Note.kind.ilike('fieldnote')).order_by(Note.modified_at.asc()).all()
-    context_ids = [c.id for c in the_site.contexts]
-    notes = [x for x in notes if x.context_id in context_ids]
-    return success([x.to_hash(format) for x in notes])
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    position = get_position(request.args)
+    if position is False:
+        return error("invalid cursor")
+
+    notes = site_notes_query(the_site, 'FieldNote')
+    etag = request_etag(*site_notes_versions(the_site, notes, format))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    notes, cursor = keyset_page(notes, Note.modified_at, Note.id, position, n)
+    return list_success(notes_to_hash(notes, format), etag, cursor=cursor)
 
 @app.route('/api/notes/all')
 @crossdomain(origin='*')
 def api_note_list_all():
-    notes = Note.query.all()
-    return success([x.to_hash() for x in notes])
+    return stream_success(Note.query.order_by(Note.id), notes_to_hash)
 
 @app.route('/api/note/<id>/feedbacks')
 @crossdomain(origin='*')
 def api_note_get_feedbacks(id):
     note = Note.query.filter_by(id=id).first()
-    feedbacks = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id == id).all()
-    return success([x.to_hash() for x in feedbacks])
+    feedbacks = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id == id).all()
+    return success(feedbacks_to_hash(feedbacks))
 
 @app.route('/api/note/<id>/update', methods = ['POST'])
 @crossdomain(origin='*')
@@ -455,26 +566,19 @@ def api_note_update(id):
     note = Note.query.get(id)
     if note:
         requesting_user = validate_credentials(request.form)
-        if requesting_user is not None and note.account.username == requesting_user.username:
+        if requesting_user is not None and note.account_id == requesting_user.id:
             note.content = obj.get('content', note.content)
             note.kind = obj.get('kind', note.kind)
             note.status = obj.get('status', note.status)
             if 'context' in obj:
-                c = Context.query.filter_by(name=obj['context']).first()
+                c = context_registry.find(obj['context'])
                 if c == None:
                     return error("context %s does not exist" % obj['context'])
-                note.context = c
+                note.context_id = c.id
             note.modified_at = datetime.now()
-            db.session.commit()
             #if note.kind == 'DesignIdea':
-            feedbacks_comment = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==id, Feedback.kind=='commnet').all()
-            feedbacks_like = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==id, Feedback.kind=='like').all()
-            new_desc = find_location_for_note(note)
-            if len(new_desc) > 0:
-                new_desc = "location: " + new_desc + "\r\n"
-            new_desc = new_desc + note.to_trello_desc() + "\r\n#likes: " + str(len(feedbacks_like))# + "\r\n#comments: " + str(len(feedbacks_comment))
-            trello_api.update_card(note.id, note.content, new_desc)
-            trello_api.move_card(note.id, note.status)
+            jobs.enqueue('trello_update_card', note_id=note.id, move=True)
+            db.session.commit()
             return success(note.to_hash())
         else:
             return auth_error()
@@ -492,7 +596,7 @@ def api_note_create(username):
                 context = obj['context']            
                 kind = obj['kind']            
                 a = Account.query.filter_by(username=username).first()
-                c = Context.query.filter_by(name=context).first()
+                c = context_registry.find(context)
                 if a and c:
                     note = Note(a.id, c.id, kind, content)
                     a.modified_at = datetime.now()
@@ -504,16 +608,12 @@ def api_note_create(username):
                     else:
                         note.status = ''
                     db.session.add(note)
-                    db.session.commit()
+                    db.session.flush()
     
                     if kind == 'DesignIdea' and is_note_in_aces(note):
                         print "adding a design idea card to trello."
-                        card = trello_api.add_card(note.id, content, note.to_trello_desc(), note.status, use_default_list=True)
-                        if card:
-                            note.trello_card_id = card.id
-                            db.session.commit()
-                        else:
-                            print "could not create design idea card in trello."
+                        jobs.enqueue('trello_add_card', note_id=note.id)
+                    db.session.commit()
                     return success(note.to_hash())
             return error("some parameters are missing")
         return auth_error()
@@ -527,8 +627,7 @@ def api_note_create(username):
 @app.route('/api/medias')
 @crossdomain(origin='*')
 def api_media_list():
-    medias = Media.query.all()
-    return success([x.to_hash() for x in medias])
+    return stream_success(Media.query.order_by(Media.id), lambda medias: [x.to_hash() for x in medias])
 
 @app.route('/api/media/<id>')
 @crossdomain(origin='*')
@@ -542,8 +641,8 @@ def api_media_get(id):
 @app.route('/api/media/<id>/feedbacks')
 @crossdomain(origin='*')
 def api_media_get_feedbacks(id):
-    feedbacks = Feedback.query.filter(Feedback.table_name.ilike('media'), Feedback.row_id==id).all()
-    return success([x.to_hash() for x in feedbacks])
+    feedbacks = Feedback.query.filter(Feedback.table_name == 'media', Feedback.row_id==id).all()
+    return success(feedbacks_to_hash(feedbacks))
 
 from werkzeug.utils import secure_filename
 
@@ -567,44 +666,23 @@ def api_media_create(id):
             note = Note.query.get(id)
             if note is not None:
                 requesting_user = validate_credentials(request.form)
-                if requesting_user is not None and note.account.username == requesting_user.username:
+                if requesting_user is not None and note.account_id == requesting_user.id:
                     media = Media(note.id, kind, title, link)
+                    db.session.add(media)
+                    note.status = str(note.created_at.date())
+                    note.modified_at = datetime.now()
+                    db.session.flush()
                     file = request.files.get("file",None)
                     if not file:
                         print "No file provided."
                     if file and allowed_file(file.filename):
                         filename = secure_filename(file.filename)
-                        #file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                        # #print "saving locally to " + filename
-                        response = cloudinary.uploader.upload(file, public_id = media.id)
-                        # print "uploading to cloudinary .."
-                        if response:
-                            # print response['url']
-                            media.link = response['url']
-                    db.session.add(media)
-                    note.status = str(note.created_at.date())
-                    note.modified_at = datetime.now()
+                        # the upload and everything that needs the uploaded
+                        # link happen in the worker
+                        jobs.enqueue('media_upload', data=file.read(), media_id=media.id, filename=filename)
+                    else:
+                        enqueue_media_published(media)
                     db.session.commit()
-    
-                    if is_note_in_aces(note):
-                    
-                        # send notification
-                        notification.send_new_note_notification_email(note, media, True)
-                    
-                        print "Adding card to trello... link: ", media.link
-                        feedbacks_like = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==id, Feedback.kind=='like').all()
-                        new_desc = find_location_for_note(note)
-                        if len(new_desc) > 0:
-                            new_desc = "location: " + new_desc + "\r\n"
-                        new_desc = new_desc + note.to_trello_desc() + "\r\n#likes: " + str(len(feedbacks_like))# + "\r\n#comments: " + str(len(feedbacks_comment))
-    
-                        if len(note.content) == 0:
-                            card = trello_api.add_card_with_attachment(note.id, "[no description]", new_desc, note.status, media.get_url())
-                        else:
-                            card = trello_api.add_card_with_attachment(note.id, note.content, new_desc, note.status, media.get_url())
-                        if card:
-                            note.trello_card_id = card.id
-                            db.session.commit()
                     return success(media.to_hash())
                 else:
                     return auth_error()
@@ -621,9 +699,10 @@ def api_media_create(id):
 
 @app.route('/api/contexts')
 @crossdomain(origin='*')
+@cache.cached
 def api_context_list_all():
     contexts = Context.query.all()
-    return success([x.to_hash() for x in contexts])
+    return list_success([x.to_hash() for x in contexts])
 
 @app.route('/api/context/<id>')
 @crossdomain(origin='*')
@@ -637,20 +716,22 @@ def api_context_get_all_notes(id):
     context = Context.query.get(id)
     if context:
         items = context.notes
-        return success([x.to_hash() for x in items])
+        return list_success(notes_to_hash(items))
 
 
 @app.route('/api/context/activities')
 @crossdomain(origin='*')
+@cache.cached
 def api_context_get_all_activities():
     items = Context.query.filter(Context.kind.ilike('activity')).all()
-    return success([x.to_hash() for x in items])
+    return list_success([x.to_hash() for x in items])
 
 @app.route('/api/context/landmarks')
 @crossdomain(origin='*')
+@cache.cached
 def api_context_get_all_landmarks():
     items = Context.query.filter(Context.kind.ilike('landmark')).all()
-    return success([x.to_hash() for x in items])
+    return list_success([x.to_hash() for x in items])
 '''
 @app.route('/api/context/<id>/update', methods = ['POST'])
 @crossdomain(origin='*')
@@ -706,21 +787,23 @@ def api_context_add_activity(site_name):
 '''
 @app.route('/api/context/active/activities/at/<site_name>', methods = ['GET'])
 @crossdomain(origin='*')
+@cache.cached
 def api_context_active_activities_at_site(site_name):
     site = Site.query.filter_by(name=site_name).first()
     if not site:
         return error("site does not exists.")
     active_activities = get_active_contexts(site.id, 'activity')
-    return success([x.to_hash() for x in active_activities])
+    return list_success([x.to_hash() for x in active_activities])
 
 @app.route('/api/context/active/designideas/at/<site_name>', methods = ['GET'])
 @crossdomain(origin='*')
+@cache.cached
 def api_context_active_designideas_at_site(site_name):
     site = Site.query.filter_by(name=site_name).first()
     if not site:
         return error("site does not exists.")
     active_designideas = get_active_contexts(site.id, 'design')
-    return success([x.to_hash() for x in active_designideas])
+    return list_success([x.to_hash() for x in active_designideas])
 
 #
 # Feedback
@@ -729,8 +812,7 @@ def api_context_active_designideas_at_site(site_name):
 @app.route('/api/feedbacks')
 @crossdomain(origin='*')
 def api_feedbacks_list_all():
-    feedbacks = Feedback.query.all()
-    return success([x.to_hash() for x in feedbacks])
+    return stream_success(Feedback.query.order_by(Feedback.id), feedbacks_to_hash)
 
 @app.route('/api/feedback/<id>')
 @crossdomain(origin='*')
@@ -745,7 +827,7 @@ def api_feedback_update(id):
     obj = request.form
     requesting_user = validate_credentials(request.form)
     feedback = Feedback.query.get(id)
-    if feedback is not None and requesting_user is not None and feedback.account.username == requesting_user.username:
+    if feedback is not None and requesting_user is not None and feedback.account_id == requesting_user.id:
         feedback.content = obj.get('content', feedback.content)
         feedback.kind = obj.get('kind', feedback.kind)
         feedback.modified_at = datetime.now()
@@ -773,21 +855,12 @@ def api_feedback_add_to_note(kind,model,id,username):
                     row_id = id
                     feedback = Feedback(account.id, kind, content, table_name, row_id, parent_id)
                     db.session.add(feedback)
-                    db.session.commit()
                     if model.lower() == 'note':
                         #if target.kind == 'DesignIdea':
-                        feedbacks_comment = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==id, Feedback.kind=='comment').all()
-                        feedbacks_like = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==id, Feedback.kind=='like').all()
-                        new_desc = find_location_for_note(target)
-                        if len(new_desc) > 0:
-                            new_desc = "location: " + new_desc + "\r\n"
-                        trello_api.update_card(target.id, target.content, new_desc + target.to_trello_desc() + "\r\n#likes: " + \
-                                        str(len(feedbacks_like)))# + "\r\n#comments: " + str(len(feedbacks_comment)))
+                        jobs.enqueue('trello_update_card', note_id=target.id)
                         if kind.lower() == 'comment':
-                            account_username = "The Design Team"
-                            if account.username != 'default':
-                                account_username = account.username
-                            trello_api.add_comment_card(target.id, target.content, content)
+                            jobs.enqueue('trello_add_comment', note_id=target.id, text=content)
+                    db.session.commit()
                     return success(feedback.to_hash())
                 return error("something wrong")
             except:
@@ -831,6 +904,7 @@ def api_feedback_add_to_media(id,username):
 #
 @app.route('/api/site/<name>')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_get(name):
     site = Site.query.filter_by(name=name).first()    
     if site:
@@ -840,6 +914,7 @@ def api_site_get(name):
 
 @app.route('/api/site/<name>/long')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_get_long(name):
     site = Site.query.filter_by(name=name).first()    
     if site:
@@ -851,6 +926,7 @@ def api_site_get_long(name):
 
 @app.route('/api/site/<name>/active/activities')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_get_active_activities(name):
     site = Site.query.filter_by(name=name).first()    
     if site:
@@ -863,6 +939,7 @@ def api_site_get_active_activities(name):
 
 @app.route('/api/site/<name>/active/designideas')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_get_active_designideas(name):
     site = Site.query.filter_by(name=name).first()    
     if site:
@@ -881,7 +958,7 @@ def api_site_get_notes(name):
         notes = []
         for c in site.contexts:
             notes += c.notes
-        return success([x.to_hash() for x in notes])
+        return list_success(notes_to_hash(notes))
     else:
         return error("site does not exist")
 
@@ -895,18 +972,60 @@ def api_site_get_notes_user(name,username):
         for c in site.contexts:
             notes = Note.query.filter_by(account_id=account.id, context_id=c.id).all()
             all_notes += notes
-        return success([x.to_hash() for x in all_notes])
+        return list_success(notes_to_hash(all_notes))
     else:
         return error("site does not exist")
 
+@app.route('/api/site/<name>/feedbacks')
+@crossdomain(origin='*')
+def api_site_get_feedbacks(name):
+    the_site = Site.query.filter_by(name=name).first()
+    if not the_site:
+        return error("site does not exist")
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    position = get_position(request.args)
+    if position is False:
+        return error("invalid cursor")
+
+    feedbacks = site_feedbacks_query(the_site)
+    etag = request_etag(rows_version(feedbacks, Feedback.modified_at))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    feedbacks, cursor = keyset_page(feedbacks, Feedback.modified_at, Feedback.id, position, n)
+    return list_success(feedbacks_to_hash(feedbacks), etag, cursor=cursor)
+
+@app.route('/api/site/<name>/accounts')
+@crossdomain(origin='*')
+def api_site_get_accounts(name):
+    the_site = Site.query.filter_by(name=name).first()
+    if not the_site:
+        return error("site does not exist")
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    position = get_position(request.args)
+    if position is False:
+        return error("invalid cursor")
+
+    accounts = site_accounts_query(the_site)
+    etag = request_etag(rows_version(accounts, Account.modified_at))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    accounts, cursor = keyset_page(accounts, Account.modified_at, Account.id, position, n)
+    return list_success([x.to_hash() for x in accounts], etag, cursor=cursor)
+
 @app.route('/api/sites')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_list():
     sites = Site.query.all()
-    return success([x.to_hash() for x in sites])
+    return list_success([x.to_hash() for x in sites])
 
 @app.route('/api/site/<name>/contexts')
 @crossdomain(origin='*')
+@cache.cached
 def api_site_list_contexts(name):
     site = Site.query.filter_by(name=name).first()
     if site:
@@ -919,13 +1038,70 @@ def api_site_list_contexts(name):
             else:
                 ordered_list.insert(idx,c)
         #print [x.title for x in ordered_list]
-        return success([x.to_hash() for x in ordered_list])
+        return list_success([x.to_hash() for x in ordered_list])
     else:
         return error("site does not exist")
 
 #
 # Sync
 #
+
+# rows of each model returned per call to /api/sync/<site>
+SYNC_PAGE_SIZE = 200
+
+@app.route('/api/sync/<site>')
+@crossdomain(origin='*')
+def api_sync_site(site):
+    # delta sync for the tabletops: up to n rows of each model changed after
+    # the cursor, which keeps one position per model. deleted notes come back
+    # as tombstones. "more" stays true while any model filled its page, keep
+    # calling with the returned cursor until it is false.
+    format = request.args.get('format', 'full')
+    the_site = Site.query.filter_by(name=site).first()
+    if not the_site:
+        return error("site does not exist")
+    n = get_page_size(request.args)
+    if n is False:
+        return error("n must be a positive number")
+    if n is None:
+        n = SYNC_PAGE_SIZE
+    position = {}
+    if request.args.get('after'):
+        position = decode_cursor(request.args.get('after'))
+        if not isinstance(position, dict):
+            return error("invalid cursor")
+
+    streams = [
+        ('notes', site_notes_query(the_site), Note.modified_at, Note.id),
+        ('medias', site_medias_query(the_site), Media.modified_at, Media.id),
+        ('feedbacks', site_feedbacks_query(the_site), Feedback.modified_at, Feedback.id),
+        ('accounts', site_accounts_query(the_site), site_account_synced_at(), Account.id)]
+    pages = {}
+    more = False
+    for name, query, column, id_column in streams:
+        after = parse_position(position.get(name))
+        if name in position and after is None:
+            return error("invalid cursor")
+        query = keyset_after(query.filter(column != None), column, id_column, after)
+        # the position is read from the row, column may be an expression
+        rows = query.add_columns(column, id_column).limit(n).all()
+        items = [row[0] for row in rows]
+        if len(rows) > 0:
+            position[name] = [rows[-1][1].strftime(CURSOR_DATE_FORMAT), rows[-1][2]]
+        more = more or len(items) == n
+        pages[name] = items
+
+    notes = [x for x in pages['notes'] if x.status != 'deleted']
+    deleted = [x for x in pages['notes'] if x.status == 'deleted']
+    data = {
+        'notes': notes_to_hash(notes, format),
+        'deleted_notes': [{'id': x.id, 'modified_at': x.modified_at} for x in deleted],
+        'medias': [x.to_hash() for x in pages['medias']],
+        'feedbacks': feedbacks_to_hash(pages['feedbacks']),
+        'accounts': [x.to_hash() for x in pages['accounts']],
+        'more': more}
+    return paged_success(data, encode_cursor(position))
+
 '''
 @app.route('/api/sync/accounts/created/since/<year>/<month>/<date>/<hour>/<minute>')
 @crossdomain(origin='*')
@@ -1088,11 +1264,18 @@ def api_trello_sync(model_id):
         response = json.loads(d)
         action = response['action']
         action_data = action['data']
+        if action['type'] in ['createList', 'updateList']:
+            trello_api.invalidate_lists()
         if 'card' not in action_data:
             print "card not in action data: ", action_data
             return success("cannot be handled.")
         card_id = action_data['card']['id']
         print action['type']
+        if action['type'] == 'deleteCard':
+            for n in Note.query.filter_by(trello_card_id=card_id).all():
+                trello_api.forget_card(n.id)
+            db.session.commit()
+            return success("thanks!")
         card = trello_api.find_card_by_its_id(card_id)
         if not card:
             print "card not found."
@@ -1149,6 +1332,7 @@ def api_interaction_new(type, site):
         if type and 'date' in f and 'touch_x' in f and 'touch_y' in f and 'touch_id' in f and 'details' in f:
             newInteraction = InteractionLog(int(type))
             newInteraction.date = f['date']
+            newInteraction.occurred_at = interactions.parse_date(f['date'])
             newInteraction.touch_id = f['touch_id']
             newInteraction.touch_x = f['touch_x']
             newInteraction.touch_y = f['touch_y']
@@ -1161,152 +1345,351 @@ def api_interaction_new(type, site):
     else:
         return error("the request to add [%s] must be done through a post" % type)
 
+# most events accepted in one batch
+INTERACTION_BATCH_SIZE = 5000
+
+@app.route('/api/interactions/batch/at/<site>', methods = ['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type', 'Idempotency-Key'])
+def api_interaction_batch(site):
+    # many events in one request: a json array, or one json object per line.
+    # each event has type and date, and optionally touch_id, touch_x, touch_y
+    # and details. with an Idempotency-Key header (or ?key=) a batch that was
+    # already stored at the site is acknowledged without being inserted again.
+    the_site = Site.query.filter_by(name=site).first()
+    if not the_site:
+        return error("site does not exist")
+    key = request.headers.get('Idempotency-Key', request.args.get('key'))
+    if key is not None and len(key) > 64:
+        return error("the idempotency key is longer than 64 characters")
+    if key:
+        batch = InteractionBatch.query.filter_by(site_id=the_site.id, key=key).first()
+        if batch is not None:
+            return success({'count': batch.count, 'duplicate': True})
+
+    try:
+        events = parse_interactions(request.get_data())
+    except ValueError as e:
+        return error(str(e))
+    if len(events) > INTERACTION_BATCH_SIZE:
+        return error("at most %d events per batch" % INTERACTION_BATCH_SIZE)
+
+    try:
+        if key:
+            db.session.add(InteractionBatch(key, the_site.id, len(events)))
+            db.session.flush()
+        insert_interactions(events, the_site.id)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        # the same batch was stored by another request meanwhile
+        batch = InteractionBatch.query.filter_by(site_id=the_site.id, key=key).first() if key else None
+        if batch is None:
+            raise e
+        return success({'count': batch.count, 'duplicate': True})
+    return success({'count': len(events), 'duplicate': False})
+
+def parse_interactions(body):
+    body = body.strip()
+    if len(body) == 0:
+        return []
+    if body.startswith('['):
+        items = json.loads(body)
+    else:
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    events = []
+    created_at = datetime.utcnow()
+    log = InteractionLog.__table__
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or 'type' not in item or 'date' not in item:
+            raise ValueError("event %d needs a type and a date" % i)
+        try:
+            events.append({
+                'type': int(item['type']),
+                'date': unicode(item['date']),
+                'occurred_at': interactions.parse_date(unicode(item['date'])),
+                'touch_id': int(item.get('touch_id', -1)),
+                'touch_x': float(item.get('touch_x', -1)),
+                'touch_y': float(item.get('touch_y', -1)),
+                'details': unicode(item.get('details', '')),
+                'created_at': created_at})
+        except (TypeError, ValueError):
+            raise ValueError("event %d has an invalid value" % i)
+        for name in ['date', 'details']:
+            if len(events[-1][name]) > log.c[name].type.length:
+                raise ValueError("event %d has a %s longer than %d characters" % (i, name, log.c[name].type.length))
+    return events
+
+def insert_interactions(events, site_id):
+    # multi-row INSERTs, as large as the database takes
+    for event in events:
+        event['site_id'] = site_id
+    table = InteractionLog.__table__
+    rows = 1000
+    if db.engine.dialect.name == 'sqlite':
+        rows = 999 // len(table.c)
+    for i in range(0, len(events), rows):
+        db.session.execute(table.insert().values(events[i:i + rows]))
+
 #
 # Notifications
 #
+# seconds without a heartbeat before a device is reported as stale
+HEARTBEAT_STALE_AFTER = 600
+
 @app.route('/api/notification/alive/at/<site>', methods=['GET'])
 def api_notification_alive(site):
+    # ?device=<name> tells the devices of a site apart
     the_site = Site.query.filter_by(name=site).first()
     if not the_site:
         return error("Site Not Found.")
-
-    log = InteractionLog.query.filter(InteractionLog.details.ilike("tabletop is alive"), InteractionLog.site_id == the_site.id).first()
-    if not log:
-        new_notification = InteractionLog(0)
-        new_notification.details = "tabletop is alive"
-        new_notification.site_id = the_site.id
-        db.session.add(new_notification)
-        print "a notification was created."
-    else:
-        log.created_at = datetime.now()
-        print "updating the previous notification."
-    db.session.commit()
+    device = request.args.get('device', DEFAULT_DEVICE)
+    if len(device) > 64:
+        return error("the device name is longer than 64 characters")
+    heartbeat(the_site.id, device)
     return success("OK!")
 
+def heartbeat(site_id, device):
+    table = DeviceHeartbeat.__table__
+    now = datetime.utcnow()
+    where = and_(table.c.site_id == site_id, table.c.device == device)
+    try:
+        result = db.session.execute(table.update().where(where).values(last_seen_at=now))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(site_id=site_id, device=device,
+                last_seen_at=now, created_at=now))
+        db.session.commit()
+    except IntegrityError:
+        # the first heartbeat of the device was stored by another request
+        db.session.rollback()
+        db.session.execute(table.update().where(where).values(last_seen_at=now))
+        db.session.commit()
+
+@app.route('/api/notification/alive/status', methods=['GET'])
+@crossdomain(origin='*')
+def api_notification_alive_status():
+    # the devices not heard from in the last ?stale=<seconds>, every site or
+    # only ?site=<name>. ?all=1 lists the devices that are alive too.
+    try:
+        stale_after = int(request.args.get('stale', HEARTBEAT_STALE_AFTER))
+    except ValueError:
+        return error("stale must be a number of seconds")
+    since = datetime.utcnow() - timedelta(seconds=stale_after)
+    heartbeats = DeviceHeartbeat.query.options(joinedload('site'))
+    site = request.args.get('site')
+    if site:
+        the_site = Site.query.filter_by(name=site).first()
+        if not the_site:
+            return error("Site Not Found.")
+        heartbeats = heartbeats.filter(DeviceHeartbeat.site_id == the_site.id)
+    if request.args.get('all') != '1':
+        heartbeats = heartbeats.filter(DeviceHeartbeat.last_seen_at < since)
+    heartbeats = heartbeats.order_by(DeviceHeartbeat.last_seen_at).all()
+    result = []
+    for h in heartbeats:
+        hash = h.to_hash()
+        hash['stale'] = h.last_seen_at < since
+        result.append(hash)
+    return success(result)
+
 #
 # Stats
 #
-# @app.route('/api/stats/observations/at/<site>', methods=['GET'])
-@app.route('/api/stats/observations', methods=['GET'])
-@crossdomain(origin='*')
-def api_stats_observations():
-    # the_site = Site.query.filter_by(name=site).first()
-    # if not the_site:
-    #     return error("Site not found.")
-    observations = []
-    try:
-        observations = db.session.query(func.count(Note.id), func.date(Note.modified_at)).filter_by(kind="FieldNote").order_by(func.date(Note.modified_at)).group_by(func.date(Note.modified_at)).all()
-        # print observations
-    except:
-        print traceback.format_exc()
-    r = "date\tfrequency\r\n"
-    sum = 0
-    for obsv in observations:
-        r = r + str(obsv[1]) + "\t" + str(obsv[0]) + "\r\n"
-        sum = sum + obsv[0]
-    # r = r + str(sum)
-    return r
-
-# @app.route('/api/stats/designideas/at/<site>', methods=['GET'])
-@app.route('/api/stats/designideas', methods=['GET'])
-@crossdomain(origin='*')
-def api_stats_designideas():
-    # the_site = Site.query.filter_by(name=site).first()
-    # if not the_site:
-    #     return error("Site not found.")
-    designideas = []
-    try:
-        designideas = db.session.query(func.count(Note.id), func.date(Note.modified_at)).filter_by(kind="DesignIdea").order_by(func.date(Note.modified_at)).group_by(func.date(Note.modified_at)).all()
-        # print designideas
-    except:
-        print traceback.format_exc()
-    r = "date\tfrequency\r\n"
-    sum = 0
-    for ideas in designideas:
-        r = r + str(ideas[1]) + "\t" + str(ideas[0]) + "\r\n"
-        sum = sum + ideas[0]
-    # r = r + str(sum)
-    return r
-
-# @app.route('/api/stats/users/at/<site>', methods=['GET'])
-@app.route('/api/stats/users', methods=['GET'])
-@crossdomain(origin='*')
-def api_stats_users():
-    # the_site = Site.query.filter_by(name=site).first()
-    # if not the_site:
-    #     return error("Site not found.")
-    users = []
-    try:
-        users = db.session.query(func.count(Account.id), func.date(Account.modified_at)).order_by(func.date(Account.modified_at)).group_by(func.date(Account.modified_at)).all()
-        # print users
-    except:
-        print traceback.format_exc()
-    r = "date\tfrequency\r\n"
-    sum = 0
-    for u in users:
-        r = r + str(u[1]) + "\t" + str(u[0]) + "\r\n"
-        sum = sum + u[0]
-    # r = r + str(sum)
-    return r
-
-# @app.route('/api/stats/comments/at/<site>', methods=['GET'])
-@app.route('/api/stats/comments', methods=['GET'])
-@crossdomain(origin='*')
-def api_stats_comments():
-    # the_site = Site.query.filter_by(name=site).first()
-    # if not the_site:
-    #     return error("Site not found.")
-    comments = []
+@app.route('/api/stats/<metric>', methods=['GET'])
+@crossdomain(origin='*')
+def api_stats(metric):
+    # daily counts from the daily_stat rollup, one of DAILY_STAT_METRICS.
+    # ?site=<name> limits them to a site, ?from= and ?to= (YYYY-MM-DD, both
+    # included) to a range of days. tsv unless ?format=json.
+    if metric not in DAILY_STAT_METRICS:
+        return error("unknown metric %s" % metric)
+    counts = db.session.query(DailyStat.day, func.sum(DailyStat.count)).filter(DailyStat.metric == metric)
+    site = request.args.get('site')
+    if site:
+        the_site = Site.query.filter_by(name=site).first()
+        if not the_site:
+            return error("Site not found.")
+        counts = counts.filter(DailyStat.site_id == the_site.id)
     try:
-        comments = db.session.query(func.count(Feedback.id), func.date(Feedback.modified_at)).filter(Feedback.kind.ilike('comment')).order_by(func.date(Feedback.modified_at)).group_by(func.date(Feedback.modified_at)).all()
-        # print comments
-    except:
-        print traceback.format_exc()
-    r = "date\tfrequency\r\n"
-    sum = 0
-    for c in comments:
-        r = r + str(c[1]) + "\t" + str(c[0]) + "\r\n"
-        sum = sum + c[0]
-    # r = r + str(sum)
-    return r
-
-# @app.route('/api/stats/likes/at/<site>', methods=['GET'])
-@app.route('/api/stats/likes', methods=['GET'])
-@crossdomain(origin='*')
-def api_stats_likes():
-    # the_site = Site.query.filter_by(name=site).first()
-    # if not the_site:
-    #     return error("Site not found.")
-    likes = []
+        if request.args.get('from'):
+            counts = counts.filter(DailyStat.day >= datetime.strptime(request.args['from'], '%Y-%m-%d').date())
+        if request.args.get('to'):
+            counts = counts.filter(DailyStat.day <= datetime.strptime(request.args['to'], '%Y-%m-%d').date())
+    except ValueError:
+        return error("dates must be given as YYYY-MM-DD")
+    counts = counts.group_by(DailyStat.day).having(func.sum(DailyStat.count) > 0).order_by(DailyStat.day).all()
+
+    if request.args.get('format', 'tsv') == 'json':
+        return success([{'date': str(day), 'frequency': int(count)} for day, count in counts])
+    lines = ["date\tfrequency\r\n"]
+    for day, count in counts:
+        lines.append(str(day) + "\t" + str(count) + "\r\n")
+    return ''.join(lines)
+
+#
+# Exports
+#
+@app.route('/api/export/at/<site>', methods=['POST'])
+@crossdomain(origin='*')
+def api_export_site(site):
+    # exports the site's notes, medias and feedbacks in a job: format=ndjson,
+    # csv or columns, gzip=1, tables=notes,medias,feedbacks. poll
+    # /api/job/<id> for the links to the files. one export per site at a time.
+    requesting_user = validate_credentials(request.form)
+    if requesting_user is None:
+        return auth_error()
+    the_site = Site.query.filter_by(name=site).first()
+    if not the_site:
+        return error("site does not exist")
+    format = request.values.get('format', 'ndjson')
+    if format not in export.FORMATS:
+        return error("format must be one of %s" % ', '.join(sorted(export.FORMATS.keys())))
+    tables = None
+    if request.values.get('tables'):
+        tables = request.values.get('tables').split(',')
+        if not set(tables) <= set(t for t, q in export.TABLES):
+            return error("tables must be among %s" % ', '.join(t for t, q in export.TABLES))
+    pending = Job.query.filter(Job.kind == 'export_site', Job.status.in_(['queued', 'running'])).all()
+    if any(json.loads(job.payload)['site'] == the_site.name for job in pending):
+        return error("an export of this site is already under way")
+    job = jobs.enqueue('export_site', site=the_site.name, format=format,
+        compress=request.values.get('gzip') == '1', tables=tables, account_id=requesting_user.id)
+    db.session.commit()
+    return success(job.to_hash())
+
+@app.route('/api/job/<int:id>')
+@crossdomain(origin='*')
+def api_job_get(id):
+    # the job of an export is only shown to the account that asked for it
+    requesting_user = validate_credentials(request.args)
+    if requesting_user is None:
+        return auth_error()
+    job = Job.query.get(id)
+    if job is None:
+        return error("job does not exist")
+    if json.loads(job.payload).get('account_id', requesting_user.id) != requesting_user.id:
+        return auth_error()
+    return success(job.to_hash())
+
+#
+# Jobs, run by worker.py
+#
+@jobs.handler('trello_add_card')
+def job_trello_add_card(note_id):
+    note = Note.query.get(note_id)
+    if note is None:
+        return
+    card = trello_api.add_card(note.id, note.content, note.to_trello_desc(), note.status, use_default_list=True)
+    if not card:
+        print "could not create design idea card in trello."
+
+@jobs.handler('trello_update_card')
+def job_trello_update_card(note_id, move=False):
+    note = Note.query.get(note_id)
+    if note is None:
+        return
+    trello_api.update_card(note.id, note.content, trello_card_desc(note))
+    if move:
+        trello_api.move_card(note.id, note.status)
+
+@jobs.handler('trello_add_comment')
+def job_trello_add_comment(note_id, text):
+    note = Note.query.get(note_id)
+    if note is None:
+        return
+    trello_api.add_comment_card(note.id, note.content, text)
+
+@jobs.handler('trello_delete_card')
+def job_trello_delete_card(note_id):
+    trello_api.delete_card(note_id)
+
+@jobs.handler('media_upload')
+def job_media_upload(media_id, filename, data):
+    media = Media.query.get(media_id)
+    if media is None:
+        return
+    upload = StringIO(data)
+    upload.name = filename
+    response = cloudinary.uploader.upload(upload, public_id = media.id)
+    if response:
+        media.link = response['url']
+        # the full hash of the note embeds the new link
+        media.note.modified_at = datetime.now()
+    enqueue_media_published(media)
+    db.session.commit()
+
+@jobs.handler('notify_new_note')
+def job_notify_new_note(media_id):
+    media = Media.query.get(media_id)
+    if media is None:
+        return
+    notification.send_new_note_notification_email(media.note, media, True)
+
+@jobs.handler('trello_add_card_with_attachment')
+def job_trello_add_card_with_attachment(media_id):
+    media = Media.query.get(media_id)
+    if media is None:
+        return
+    note = media.note
+    print "Adding card to trello... link: ", media.link
+    title = note.content
+    if len(title) == 0:
+        title = "[no description]"
+    url = media.get_url()
+    trello_api.add_card(note.id, title, trello_card_desc(note), note.status, create_list=True)
+    # the card is kept before attaching, a retry attaches to it instead of
+    # making another one
+    db.session.commit()
+    trello_api.add_attachment(note.id, url)
+
+@jobs.handler('export_site')
+def job_export_site(site, format, compress, tables, account_id=None):
+    # the worker's disk is not the web's, the files go to cloudinary
+    the_site = Site.query.filter_by(name=site).first()
+    if the_site is None:
+        return
+    directory = tempfile.mkdtemp()
     try:
-        likes = db.session.query(func.count(Feedback.id), func.date(Feedback.modified_at)).filter(Feedback.kind.ilike('like')).order_by(func.date(Feedback.modified_at)).group_by(func.date(Feedback.modified_at)).all()
-        # print likes
-    except:
-        print traceback.format_exc()
-    r = "date\tfrequency\r\n"
-    sum = 0
-    for l in likes:
-        r = r + str(l[1]) + "\t" + str(l[0]) + "\r\n"
-        sum = sum + l[0]
-    # r = r + str(sum)
-    return r
+        files = export.export_site(the_site, directory, format, compress, tables, jobs.touch)
+        for f in files:
+            path = f.pop('path')
+            # unguessable, the links are only given to the account that asked
+            public_id = 'exports/%s-%s' % (uuid.uuid4().hex, os.path.basename(path))
+            response = cloudinary.uploader.upload(path, resource_type='raw', public_id=public_id)
+            f['url'] = response['secure_url']
+            jobs.touch()
+    finally:
+        shutil.rmtree(directory)
+    return files
+
+def enqueue_media_published(media):
+    if is_note_in_aces(media.note):
+        jobs.enqueue('notify_new_note', media_id=media.id)
+        jobs.enqueue('trello_add_card_with_attachment', media_id=media.id)
 
 #
 # Events
 #
+def note_id_of_card(card):
+    # the note of a card found by its description is remembered for next time
+    note_id = trello_api.get_note_id_by_card(card)
+    db.session.commit()
+    return note_id
+
 def trello_card_created(action_data, the_card, account_id, webusername):
     list_name = action_data['list']['name']
     if the_card.desc:
-        note_id = find_note_id_from_trello_card_desc(the_card.desc)
+        note_id = note_id_of_card(the_card)
         n = Note.query.filter_by(id=note_id).first()
         if n:
             return False
     context_name = 'aces_design_idea'
-    context = Context.query.filter_by(name=context_name).first()
+    context = context_registry.find(context_name)
     if context:
         note = Note(account_id, context.id, 'DesignIdea', the_card.name)
         note.web_username = webusername
         note.status = list_name
+        note.trello_card_id = the_card.id
+        note.trello_list_id = the_card.idList
         db.session.add(note)
         db.session.commit()
         new_desc = note.to_trello_desc() + "\r\n#likes: 0"
@@ -1316,7 +1699,7 @@ def trello_card_created(action_data, the_card, account_id, webusername):
     return True
 
 def trello_card_updated(action_data, the_card):
-    note_id = find_note_id_from_trello_card_desc(the_card.desc)
+    note_id = note_id_of_card(the_card)
     n = Note.query.filter_by(id=note_id).first()
     print "action data: ", action_data
     if not n:
@@ -1326,6 +1709,7 @@ def trello_card_updated(action_data, the_card):
             list_after = action_data['listAfter']
             print "the card was moved."
             n.status = list_after['name']
+            n.trello_list_id = list_after['id']
             n.modified_at = datetime.now()
             db.session.commit()
         else:
@@ -1347,12 +1731,12 @@ def trello_card_updated(action_data, the_card):
 
 def trello_comment_created(action_data, the_card, account_id, webusername):
     text = action_data['text']
-    note_id = find_note_id_from_trello_card_desc(the_card.desc)
+    note_id = note_id_of_card(the_card)
     n = Note.query.filter_by(id=note_id).first()
     if not n:
         return False
     else:
-        f = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id == note_id, Feedback.content == text).first()
+        f = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id == note_id, Feedback.content == text).first()
         if not f:
             feedback = Feedback(account_id, 'comment', text, 'note', n.id, 0)
             feedback.web_username = webusername
@@ -1364,15 +1748,15 @@ def trello_comment_created(action_data, the_card, account_id, webusername):
 
 def trello_comment_updated(action_data, the_card):
     old_comment = action_data['old']['text']
-    note_id = find_note_id_from_trello_card_desc(the_card.desc)
+    note_id = note_id_of_card(the_card)
     target = Note.query.filter_by(id=note_id).first()
     if target:
-        f = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id == note_id, Feedback.content == old_comment).first()
+        f = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id == note_id, Feedback.content == old_comment).first()
         if not f:
             if re.match(r"\[\S+\].+", old_comment):
                 t = re.findall(r"\[\S+\]", old_comment)
                 old_comment = old_comment[len(t[0]):].lstrip()
-                f = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id == note_id, Feedback.content == old_comment).first()
+                f = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id == note_id, Feedback.content == old_comment).first()
         if f:
             new_comment = action_data['action']['text']
             f.content = new_comment
@@ -1397,6 +1781,114 @@ def add_timestamp_txt(items):
         item['created_at_debug'] = ts.strftime('%Y/%m/%d/%H/%M')
     return items
 
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def keyset_page(query, column, id_column, position, n=None):
+    # pages through query ordered by (column, id), the position is the one
+    # of the last row of the previous page, from get_position. full precision
+    # is kept in the cursor so rows sharing a millisecond are neither skipped
+    # nor repeated.
+    query = keyset_after(query, column, id_column, position)
+    if n:
+        query = query.limit(n)
+    items = query.all()
+    last = keyset_position(items[-1], column, id_column) if len(items) > 0 else None
+    if last is None and position is not None:
+        # nothing after the position, the client keeps it
+        last = [position[0].strftime(CURSOR_DATE_FORMAT), position[1]]
+    return items, encode_cursor(last) if last is not None else None
+
+def get_position(args):
+    # the position of ?after=, None without one, False when it is invalid
+    cursor = args.get('after')
+    if not cursor:
+        return None
+    position = parse_position(decode_cursor(cursor))
+    if position is None:
+        return False
+    return position
+
+def parse_position(position):
+    try:
+        return datetime.strptime(position[0], CURSOR_DATE_FORMAT), int(position[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def keyset_after(query, column, id_column, position):
+    if position is not None:
+        last_value, last_id = position
+        query = query.filter(or_(column > last_value,
+            and_(column == last_value, id_column > last_id)))
+    return query.order_by(column.asc(), id_column.asc())
+
+def keyset_position(item, column, id_column):
+    value = getattr(item, column.key)
+    if value is None:
+        return None
+    return [value.strftime(CURSOR_DATE_FORMAT), getattr(item, id_column.key)]
+
+def get_page_size(args):
+    n = args.get('n')
+    if n is None:
+        return None
+    try:
+        n = int(n)
+    except ValueError:
+        return False
+    if n <= 0:
+        return False
+    return n
+
+def site_notes_query(the_site, kind=None):
+    query = Note.query.join(Context, Note.context_id == Context.id).\
+        filter(Context.site_id == the_site.id)
+    if kind is not None:
+        query = query.filter(Note.kind == kind)
+    return query
+
+def site_notes_versions(the_site, notes, format):
+    # the full hash of a note embeds its feedbacks, which do not bump
+    # note.modified_at. medias do.
+    versions = [rows_version(notes, Note.modified_at)]
+    if format == 'full':
+        f = aliased(Feedback)
+        on_notes = site_target_feedbacks(the_site, f)[0]
+        versions.append(rows_version(on_notes, f.modified_at))
+        versions += embedded_versions()
+    return versions
+
+def embedded_versions():
+    # the full hash of a note also embeds its account, context and site,
+    # whose changes do not bump note.modified_at either
+    return [rows_version(model.query, model.modified_at) for model in (Account, Context, Site)]
+
+def site_medias_query(the_site):
+    return Media.query.join(Note, Media.note_id == Note.id).\
+        join(Context, Note.context_id == Context.id).\
+        filter(Context.site_id == the_site.id)
+
+def site_feedbacks_query(the_site):
+    return Feedback.query.filter(Feedback.id.in_(site_feedback_ids(the_site)))
+
+def site_accounts_query(the_site):
+    return Account.query.join(AccountSite, AccountSite.account_id == Account.id).\
+        filter(AccountSite.site_id == the_site.id)
+
+def site_account_synced_at():
+    # an account of site_accounts_query() changed for the site when it was
+    # edited or when it joined the site, whichever came last
+    return case([(AccountSite.created_at > Account.modified_at, AccountSite.created_at)],
+        else_=Account.modified_at)
+
 def get_or_create_webaccount_from_trello_data(action):
     if 'memberCreator' in action:
         user_data = action['memberCreator']
@@ -1412,29 +1904,15 @@ def get_or_create_webaccount_from_trello_data(action):
     return get_default_user_id()
 
 def is_account_related_to_site(account, the_site, recursive):
-    for f in account.feedbacks:
-        if f.kind.lower() == 'comment':
-            if f.table_name.lower() == 'Note'.lower():
-                note_target = Note.query.get(f.row_id)
-                if note_target.context.site.id == the_site.id:
-                    return True
-            elif f.table_name.lower() == 'Context'.lower():
-                context_target = Context.query.get(f.row_id)
-                if context_target.site.id == the_site.id:
-                    return True
-            elif f.table_name.lower() == 'Account'.lower():
-                if recursive:
-                    account_target = Account.query.get(f.row_id)
-                    if is_account_related_to_site(account_target, the_site, False):
-                        return True
-                continue;
-            elif f.table_name.lower() == 'Media'.lower():
-                media_target = Media.query.get(f.row_id)
-                if media_target.note.context.site.id == the_site.id:
-                    return True
-            else:
-                continue
-    return False
+    # the account commented at the site or, with recursive, commented on an
+    # account that did
+    commenters = site_commenter_ids(the_site)
+    related = Account.id.in_(commenters)
+    if recursive:
+        f = aliased(Feedback)
+        related = or_(related, Account.id.in_(db.session.query(f.account_id).
+            filter(f.kind.ilike('comment'), f.table_name == 'account', f.row_id.in_(commenters))))
+    return db.session.query(Account.id).filter(Account.id == account.id, related).first() is not None
 
 def find_note_id_from_trello_card_desc(desc):
     id = -1
@@ -1443,25 +1921,29 @@ def find_note_id_from_trello_card_desc(desc):
         id = t[0].split(':')[1].strip()
     return id
 
+def trello_card_desc(note):
+    feedbacks_like = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='like').count()
+    desc = find_location_for_note(note)
+    if len(desc) > 0:
+        desc = "location: " + desc + "\r\n"
+    return desc + note.to_trello_desc() + "\r\n#likes: " + str(feedbacks_like)
+
 def find_location_for_note(note):
-    feedback_landmark = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==note.id, Feedback.kind=='Landmark').first()
+    feedback_landmark = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='Landmark').first()
     location_text = ""
     if note.kind == "FieldNote" and feedback_landmark:
-        location = Context.query.filter_by(name=feedback_landmark.content).first()
+        location = context_registry.find(feedback_landmark.content)
         if location:
             location_text = location.title
     return location_text
 
 def is_note_in_aces(note):
-    contexts = Context.query.filter(Context.name.ilike('aces%'), or_(Context.kind.ilike("activity"), Context.kind.ilike("design"))).all()
-    if len(contexts) == 0:
+    # an aces% activity or design context
+    context = context_registry.get(note.context_id)
+    if context is None:
         return False
-    context_ids = []
-    for context in contexts:
-        context_ids.append(context.id)
-    if note.context.id not in context_ids:
-        return False
-    return True
+    return (context.name or '').lower().startswith('aces') and \
+        (context.kind or '').lower() in ('activity', 'design')
 
 def get_default_user_id():
     default_user = Account.query.filter(Account.username.ilike('default')).first()
@@ -1470,20 +1952,8 @@ def get_default_user_id():
     return 1
 
 def get_active_contexts(site_id, context_kind):
-    all_contexts = Context.query.filter(Context.site_id==site_id, Context.kind.ilike(context_kind)).all()
-    active_contexts = []
-    for context in all_contexts:
-        extra_val = context.extras
-        e = {}
-        try:
-            e = json.loads(extra_val)
-            if 'active' not in e or e['active']:
-                active_contexts.append(context)
-        except:
-            active_contexts.append(context)
-            continue
-    active_contexts = sorted(active_contexts, key=lambda a: a.id, reverse=True)
-    return active_contexts
+    return Context.query.filter(Context.site_id == site_id, Context.kind.ilike(context_kind),
+        Context.active == True).order_by(Context.id.desc()).all()
 
 def find_latest_counts(account, activity, h):
     date_now = datetime.now()
@@ -0,0 +1,174 @@
+'''
+Credentials of the tabletop and mobile accounts.
+
+Passwords are kept as salted hashes in account.password_hash. Accounts
+created before that still have the plain password in account.password; it
+is hashed and cleared, in a transaction of its own, the first time the
+account logs in.
+
+A successful login also returns a signed token. Sending it back as
+"token" (or as an "Authorization: Bearer" header) instead of the username
+and password skips the password check. The token holds a fingerprint of
+the password hash, so changing the password revokes it; otherwise it
+expires after TOKEN_MAX_AGE. SECRET_KEY must be set, the same for every
+process; NATURENET_DEBUG=1 runs with a fixed development key instead.
+
+Checking a password hash is slow on purpose, the verified username,
+password and stored hash are remembered for CACHE_TTL: a new password
+changes the hash, which no entry matches.
+'''
+import os
+import hmac
+import time
+import hashlib
+from collections import OrderedDict
+
+from werkzeug.security import generate_password_hash
+from werkzeug.security import check_password_hash
+from itsdangerous import URLSafeTimedSerializer
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db_def import app
+from db_def import db
+from db_def import Account
+
+# signs the tokens, and keys the credentials cache: every process must share it
+if os.environ.get('SECRET_KEY'):
+    app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+elif os.environ.get('NATURENET_DEBUG') == '1':
+    app.config['SECRET_KEY'] = 'naturenet-development-key'
+if not app.config.get('SECRET_KEY'):
+    raise RuntimeError("SECRET_KEY is not set (NATURENET_DEBUG=1 uses a development key)")
+
+# seconds a token stays valid
+TOKEN_MAX_AGE = 30 * 24 * 3600
+# seconds a verified username/password/hash is remembered, and how many
+CACHE_TTL = 300
+CACHE_SIZE = 1000
+
+serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='naturenet-auth')
+
+class Principal(object):
+    # the account making a request, enough for the ownership checks
+    def __init__(self, id, username, fingerprint=None):
+        self.id = id
+        self.username = username
+        # of the password hash it was verified with, see fingerprint()
+        self.fingerprint = fingerprint
+
+    def __repr__(self):
+        return '<Principal username:%r>' % self.username
+
+#
+# Passwords
+#
+
+def set_password(account, password):
+    account.password_hash = generate_password_hash(password)
+    account.password = None
+
+def check_password(account, password):
+    if account.password_hash:
+        # werkzeug 0.9 cannot compare the unicode the database returns
+        return check_password_hash(str(account.password_hash), password)
+    if account.password is not None and account.password == password:
+        # an old plain password, hash it now that we know it. committed on
+        # its own, the session of the request keeps what it has pending
+        password_hash = generate_password_hash(password)
+        table = Account.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.id == account.id).
+                where(table.c.password == password).values(password_hash=password_hash, password=None))
+        set_committed_value(account, 'password_hash', password_hash)
+        set_committed_value(account, 'password', None)
+        return True
+    return False
+
+def fingerprint(password_hash):
+    # short, and says nothing of the hash without the key
+    return hmac.new(app.config['SECRET_KEY'], (password_hash or '').encode('utf-8'),
+        hashlib.sha256).hexdigest()[:16]
+
+#
+# Verification cache
+#
+
+CACHE = OrderedDict()
+
+def cache_key(username, password, password_hash):
+    # the cache never holds the password itself
+    return hmac.new(app.config['SECRET_KEY'], '\0'.join([username.encode('utf-8'), password.encode('utf-8'),
+        (password_hash or '').encode('utf-8')]), hashlib.sha256).hexdigest()
+
+def remember(key, principal):
+    CACHE.pop(key, None)
+    CACHE[key] = (principal, time.time() + CACHE_TTL)
+    while len(CACHE) > CACHE_SIZE:
+        CACHE.popitem(last=False)
+
+def recall(key):
+    entry = CACHE.get(key)
+    if entry is None:
+        return None
+    principal, expires_at = entry
+    if expires_at < time.time():
+        del CACHE[key]
+        return None
+    return principal
+
+#
+# Tokens
+#
+
+def issue_token(principal):
+    return serializer.dumps({'id': principal.id, 'username': principal.username,
+        'password': principal.fingerprint})
+
+def verify_token(token):
+    try:
+        data = serializer.loads(token, max_age=TOKEN_MAX_AGE)
+        principal = Principal(data['id'], data['username'], data['password'])
+    except (BadSignature, TypeError, KeyError):
+        return None
+    # revoked when the password changed since
+    table = Account.__table__
+    row = db.session.execute(select([table.c.password_hash]).where(table.c.id == principal.id)).first()
+    if row is None or fingerprint(row[0]) != principal.fingerprint:
+        return None
+    return principal
+
+#
+# Requests
+#
+
+def authenticate(args, headers=None):
+    '''Returns the Principal for a token or a username and password found in
+    args (request.args or request.form) or the Authorization header, None if
+    they are missing or wrong.'''
+    token = args.get('token')
+    if token is None and headers is not None:
+        authorization = headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):].strip()
+    if token:
+        principal = verify_token(token)
+        if principal is not None:
+            return principal
+
+    username = args.get('username')
+    password = args.get('password')
+    if username is None or password is None:
+        return None
+    account = Account.query.filter_by(username=username).first()
+    if account is None:
+        return None
+    principal = recall(cache_key(username, password, account.password_hash))
+    if principal is not None:
+        return principal
+    if not check_password(account, password):
+        return None
+    principal = Principal(account.id, account.username, fingerprint(account.password_hash))
+    remember(cache_key(username, password, account.password_hash), principal)
+    return principal
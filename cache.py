@@ -0,0 +1,142 @@
+'''
+Cache of whole responses, for the endpoints whose data changes a few times
+a season: sites and contexts.
+
+Responses are keyed by path and query string and kept TTL seconds. The
+default backend lives in the process, holds at most SIZE responses and
+drops the least recently used first. With CACHE_REDIS_URL set (and redis
+installed) the processes share one cache instead. Committing a change to a
+Site or Context empties the cache; a local cache in another process keeps
+serving its copy for up to TTL. The context registry of db_def follows the
+generation of a shared cache, so that it reloads too.
+'''
+import os
+import time
+import cPickle as pickle
+from collections import OrderedDict
+from functools import update_wrapper
+
+from flask import request
+from flask import current_app
+from flask import make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import object_session
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from db_def import Site
+from db_def import Context
+from db_def import context_registry
+
+# seconds a response is served from the cache, and how many are kept
+TTL = 300
+SIZE = 500
+
+class LocalBackend(object):
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            return None
+        self.entries[key] = entry
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.time() + ttl)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def generation(self):
+        # not shared, other processes do not see clear()
+        return None
+
+class RedisBackend(object):
+    # clear() moves to a new generation of keys, the old ones expire
+    GENERATION = 'naturenet:cache:generation'
+
+    def __init__(self, url):
+        self.client = redis.StrictRedis.from_url(url)
+
+    def prefix(self):
+        return 'naturenet:cache:%s:' % (self.client.get(self.GENERATION) or 0)
+
+    def get(self, key):
+        value = self.client.get(self.prefix() + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.setex(self.prefix() + key, ttl, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        self.client.incr(self.GENERATION)
+
+    def generation(self):
+        return self.client.get(self.GENERATION)
+
+if os.environ.get('CACHE_REDIS_URL') and redis is not None:
+    backend = RedisBackend(os.environ['CACHE_REDIS_URL'])
+else:
+    backend = LocalBackend()
+
+# read at every check, so that set_backend() applies to it
+context_registry.shared_generation = lambda: backend.generation()
+
+def set_backend(b):
+    global backend
+    backend = b
+
+def clear():
+    backend.clear()
+
+def cached(f):
+    # caches the successful GET responses of a view
+    def wrapped_function(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        key = request.full_path
+        entry = backend.get(key)
+        if entry is not None:
+            data, status, mimetype = entry
+            return current_app.response_class(data, status=status, mimetype=mimetype)
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            backend.set(key, (response.get_data(), response.status_code, response.mimetype), TTL)
+        return response
+    return update_wrapper(wrapped_function, f)
+
+#
+# Invalidation
+#
+
+def mark_changed(mapper, connection, target):
+    object_session(target).info['response_cache_stale'] = True
+
+for model in [Site, Context]:
+    for name in ['after_insert', 'after_update', 'after_delete']:
+        event.listen(model, name, mark_changed)
+
+@event.listens_for(Session, 'after_commit')
+def clear_after_commit(session):
+    # once the change is visible, so that no request caches what it replaced
+    if session.info.pop('response_cache_stale', False):
+        clear()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_after_rollback(session):
+    session.info.pop('response_cache_stale', None)
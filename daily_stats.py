@@ -0,0 +1,11 @@
+from db_def import db
+from db_def import DailyStat
+from db_def import rebuild_daily_stats
+
+# rebuilds the daily_stat rollup behind /api/stats from the notes, feedbacks
+# and accounts; the listeners in db_def keep it up to date afterwards.
+
+print "rebuilding daily_stat..."
+with db.engine.begin() as connection:
+    rebuild_daily_stats(connection)
+print "Done. (" + str(DailyStat.query.count()) + " daily counts.)"
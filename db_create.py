@@ -3,9 +3,11 @@ from db_def import Account
 from db_def import Note
 from db_def import Media
 from db_def import Context
+import db_migrate
 
 db.drop_all()
 db.create_all()
+db_migrate.stamp()
 
 # default = Account("default")
 # default.id = 0
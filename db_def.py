@@ -1,5 +1,18 @@
 from sqlalchemy import ForeignKey
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy import literal
+from sqlalchemy import exists
+from sqlalchemy import union
+from sqlalchemy import inspect
+from sqlalchemy import and_
+from sqlalchemy import text
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
@@ -7,6 +20,7 @@ from flask.ext.sqlalchemy import SQLAlchemy
 
 import json
 import datetime
+import time
 from time import strftime
 
 app = Flask(__name__)
@@ -29,10 +43,13 @@ class Site(db.Model):
     name = db.Column(db.String(80), unique=True)
     image_url = db.Column(db.String(200))
     description = db.Column(db.Text())
+    # bumped by a listener on every change, see "Modification times"
+    modified_at = db.Column(db.DateTime())
 
     def __init__(self, name, description):       
         self.name = name
         self.description = description 
+        self.modified_at = datetime.datetime.utcnow()
 
     def __repr__(self):
         return '<Site name:%r>' % self.name
@@ -54,6 +71,7 @@ class Account(db.Model):
     name = db.Column(db.String(80), unique=False)
     consent = db.Column(db.Text())
     password = db.Column(db.String(20))
+    password_hash = db.Column(db.String(128))
     email = db.Column(db.String(80))
     created_at = db.Column(db.DateTime())
     modified_at = db.Column(db.DateTime())
@@ -122,13 +140,22 @@ class WebAccount(db.Model):
     	return jsonify(self.to_hash())
 
 class Context(db.Model):
+    __table_args__ = (
+        db.Index('ix_context_site_id_kind', 'site_id', 'kind'),
+        db.Index('ix_context_name', 'name'),
+        db.Index('ix_context_site_id_active', 'site_id', 'active'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     kind = db.Column(db.String(40))
     name = db.Column(db.String(40))
     title = db.Column(db.Text())
     description = db.Column(db.Text())    
     extras = db.Column(db.Text())    
+    # parsed from extras on every write, see "Active contexts"
+    active = db.Column(db.Boolean())
     site_id = db.Column(db.Integer, ForeignKey('site.id'))
+    # bumped by a listener on every change, see "Modification times"
+    modified_at = db.Column(db.DateTime())
 
     site = relationship("Site", backref=backref('contexts', order_by=id))
 
@@ -138,6 +165,7 @@ class Context(db.Model):
         self.title = title
         self.description = description
         self.extras = ""
+        self.modified_at = datetime.datetime.utcnow()
 
     def __repr__(self):
         return '<Context kind:%r, name:%r>' % (self.kind, self.name)
@@ -151,6 +179,12 @@ class Context(db.Model):
 
 
 class Note(db.Model):
+    __table_args__ = (
+        db.Index('ix_note_context_id_modified_at', 'context_id', 'modified_at'),
+        db.Index('ix_note_kind', 'kind'),
+        db.Index('ix_note_account_id', 'account_id'),
+        db.Index('ix_note_trello_card_id', 'trello_card_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     kind = db.Column(db.String(40), unique=False)
     content = db.Column(db.Text())
@@ -161,11 +195,15 @@ class Note(db.Model):
     latitude = db.Column(db.Float())
     web_username = db.Column(db.String(80))
     trello_card_id = db.Column(db.String(80))
+    trello_list_id = db.Column(db.String(80))
     account_id = db.Column(db.Integer, ForeignKey('account.id'))
     context_id = db.Column(db.Integer, ForeignKey('context.id'))
 
     account = relationship("Account", backref=backref('notes', order_by=id))
     context = relationship("Context", backref=backref('notes', order_by=id))
+    feedbacks = relationship("Feedback",
+        primaryjoin="and_(Feedback.table_name == 'note', foreign(Feedback.row_id) == Note.id)",
+        order_by="Feedback.id", viewonly=True)
 
     def __init__(self, account_id, context_id, kind, content):       
         self.account_id = account_id
@@ -196,13 +234,12 @@ class Note(db.Model):
             h['medias'] = [ x.to_hash() for x in self.medias];
             h['context'] = self.context.to_hash();
             h['account'] = self.account.to_hash();
-            feedbacks = Feedback.query.filter_by(table_name='Note', row_id=self.id).all()            
-            h['feedbacks'] = [f.to_hash('short') for f in feedbacks]
+            h['feedbacks'] = [f.to_hash('short') for f in self.feedbacks]
             # h['feedbacks'] = [f.content for f in feedbacks]
         else:
             # h['medias'] = [ x.id for x in self.medias];
-            h['context'] = self.context.id;
-            h['account'] = self.account.id;
+            h['context'] = self.context_id;
+            h['account'] = self.account_id;
         return h
 
     def to_trello_desc(self):
@@ -240,6 +277,8 @@ class Media(db.Model):
     link = db.Column(db.Text())
     title = db.Column(db.Text())
     created_at = db.Column(db.DateTime())
+    # bumped by a listener on every change, /api/sync/<site> pages medias by it
+    modified_at = db.Column(db.DateTime())
 
     note_id = db.Column(db.Integer, ForeignKey('note.id'))
 
@@ -251,6 +290,7 @@ class Media(db.Model):
         self.title = title
         self.link = link
         self.created_at = datetime.datetime.utcnow()
+        self.modified_at = self.created_at
 
     def __repr__(self):
         return '<Media title:%r>' % self.title
@@ -283,7 +323,15 @@ class Media(db.Model):
 
 
 
+# feedback.table_name is stored in lowercase, these are the model names
+# reported to clients
+FEEDBACK_TARGET_NAMES = {'note': 'Note', 'context': 'Context', 'account': 'Account', 'media': 'Media'}
+
 class Feedback(db.Model):
+    __table_args__ = (
+        db.Index('ix_feedback_table_name_row_id_kind', 'table_name', 'row_id', 'kind'),
+        db.Index('ix_feedback_account_id', 'account_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     account_id = db.Column(db.Integer, ForeignKey('account.id'))
     kind = db.Column(db.String(40))
@@ -300,7 +348,7 @@ class Feedback(db.Model):
     def __init__(self, account_id, kind, content, table_name, row_id, parent_id):
         self.account_id = account_id
         self.row_id = row_id
-        self.table_name = table_name
+        self.table_name = table_name.lower()
         self.parent_id = parent_id
         self.kind = kind
         self.content = content
@@ -311,17 +359,11 @@ class Feedback(db.Model):
 
     @staticmethod
     def resolve_target(table_name, row_id):
-        #if table_name in ['Note', 'Context', 'Account']:
-        if table_name.lower() == 'Note'.lower():
-            return Note.query.get(row_id)
-        elif table_name.lower() == 'Context'.lower():
-            return Context.query.get(row_id)
-        elif table_name.lower() == 'Account'.lower():
-            return Account.query.get(row_id)
-        elif table_name.lower() == 'Media'.lower():
-            return Media.query.get(row_id)
-        else:
-            return None        
+        # query.get looks in the identity map first, see prefetch_feedbacks
+        model = FEEDBACK_TARGET_MODELS.get(table_name.lower())
+        if model is None:
+            return None
+        return model.query.get(row_id)
 
     def __repr__(self):
         return '<Feedback by %s: %s on %s: %s >' % (self.account, self.kind, self.table_name, self.content)
@@ -345,7 +387,7 @@ class Feedback(db.Model):
                 target_hash = target.to_hash('short')
             else:
                 target_hash = None
-            h['target'] = {'model': self.table_name,
+            h['target'] = {'model': FEEDBACK_TARGET_NAMES.get(self.table_name.lower(), self.table_name),
                            'id': self.row_id,
                            'data': target_hash}
         return h
@@ -363,6 +405,9 @@ class Feedback(db.Model):
         #         'account': self.account.to_hash()};
 
 class InteractionLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_interaction_log_site_id_created_at', 'site_id', 'created_at'),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     type = db.Column(db.Integer)
     date = db.Column(db.String(32))
@@ -371,12 +416,15 @@ class InteractionLog(db.Model):
     touch_y = db.Column(db.Float())
     details = db.Column(db.String(256))
     created_at = db.Column(db.DateTime())
+    # date parsed, None when the tabletop sent something unreadable
+    occurred_at = db.Column(db.DateTime())
     site_id = db.Column(db.Integer, ForeignKey('site.id'))
 
     site = relationship("Site", backref=backref('interactions', order_by=id))
 
     def __init__(self, type):
-        self.date = str(datetime.datetime.utcnow())
+        self.occurred_at = datetime.datetime.utcnow()
+        self.date = str(self.occurred_at)
         self.type = type
         self.touch_id = -1
         self.touch_x = -1
@@ -401,3 +449,817 @@ class InteractionLog(db.Model):
 
     def to_json(self):
         return json.dumps(self.to_hash())
+
+class InteractionHour(db.Model):
+    # interactions per site, hour and type, for the raw rows that were swept
+    # out of interaction_log. see interactions.py
+    __tablename__ = 'interaction_hour'
+    __table_args__ = (
+        db.Index('ix_interaction_hour_site_id_hour_type', 'site_id', 'hour', 'type', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, ForeignKey('site.id'))
+    hour = db.Column(db.DateTime())
+    type = db.Column(db.Integer)
+    count = db.Column(db.Integer)
+
+    def __init__(self, site_id, hour, type, count):
+        self.site_id = site_id
+        self.hour = hour
+        self.type = type
+        self.count = count
+
+    def __repr__(self):
+        return '<InteractionHour site:%r %s type:%r: %r>' % (self.site_id, self.hour, self.type, self.count)
+
+    def to_hash(self, format = 'full'):
+        return {
+        '_model_' : 'InteractionHour',
+        'site_id' : self.site_id,
+        'hour' : self.hour,
+        'type' : self.type,
+        'count' : self.count}
+
+class InteractionBatch(db.Model):
+    # idempotency keys of the batches posted to /api/interactions/batch, a
+    # retried batch with a key known at its site is not inserted again
+    __tablename__ = 'interaction_batch'
+    site_id = db.Column(db.Integer, ForeignKey('site.id'), primary_key=True, autoincrement=False)
+    key = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime())
+
+    def __init__(self, key, site_id, count):
+        self.key = key
+        self.site_id = site_id
+        self.count = count
+        self.created_at = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '<InteractionBatch %r count:%r>' % (self.key, self.count)
+
+# the device of a heartbeat that does not name one
+DEFAULT_DEVICE = 'tabletop'
+
+class DeviceHeartbeat(db.Model):
+    # when each device of a site last called /api/notification/alive
+    __tablename__ = 'device_heartbeat'
+    site_id = db.Column(db.Integer, ForeignKey('site.id'), primary_key=True, autoincrement=False)
+    device = db.Column(db.String(64), primary_key=True)
+    last_seen_at = db.Column(db.DateTime())
+    created_at = db.Column(db.DateTime())
+
+    site = relationship("Site")
+
+    def __init__(self, site_id, device):
+        self.site_id = site_id
+        self.device = device
+        self.created_at = datetime.datetime.utcnow()
+        self.last_seen_at = self.created_at
+
+    def __repr__(self):
+        return '<DeviceHeartbeat site:%r device:%r>' % (self.site_id, self.device)
+
+    def to_hash(self, format = 'full'):
+        return {
+        '_model_' : 'DeviceHeartbeat',
+        'site' : self.site.name,
+        'device' : self.device,
+        'last_seen_at' : self.last_seen_at,
+        'created_at' : self.created_at}
+
+class AccountSite(db.Model):
+    # the sites an account is active at: it wrote a note there, commented on
+    # a note, media or context there, or commented on an account that did one
+    # of these. kept up to date by the listeners under "Site membership".
+    __tablename__ = 'account_site'
+    __table_args__ = (
+        db.Index('ix_account_site_site_id', 'site_id'),
+    )
+    account_id = db.Column(db.Integer, ForeignKey('account.id'), primary_key=True, autoincrement=False)
+    site_id = db.Column(db.Integer, ForeignKey('site.id'), primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime())
+
+    def __init__(self, account_id, site_id):
+        self.account_id = account_id
+        self.site_id = site_id
+        self.created_at = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '<AccountSite account:%r, site:%r>' % (self.account_id, self.site_id)
+
+class DailyStat(db.Model):
+    # how many rows of a metric have their modified_at on a day, per site.
+    # site_id is 0 for rows without a site. kept up to date by the listeners
+    # under "Daily statistics".
+    __tablename__ = 'daily_stat'
+    __table_args__ = (
+        db.Index('ix_daily_stat_metric_day_site_id', 'metric', 'day', 'site_id', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date())
+    site_id = db.Column(db.Integer)
+    metric = db.Column(db.String(20))
+    count = db.Column(db.Integer)
+
+    def __init__(self, day, site_id, metric, count):
+        self.day = day
+        self.site_id = site_id
+        self.metric = metric
+        self.count = count
+
+    def __repr__(self):
+        return '<DailyStat %r %s site:%r: %r>' % (self.metric, self.day, self.site_id, self.count)
+
+class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64))
+    payload = db.Column(db.Text())
+    data = db.Column(db.LargeBinary())
+    status = db.Column(db.String(16))
+    attempts = db.Column(db.Integer)
+    last_error = db.Column(db.Text())
+    # json returned by the handler, e.g. the files of an export
+    result = db.Column(db.Text())
+    run_at = db.Column(db.DateTime())
+    locked_at = db.Column(db.DateTime())
+    created_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = payload
+        self.status = 'queued'
+        self.attempts = 0
+        self.created_at = datetime.datetime.utcnow()
+        self.run_at = self.created_at
+
+    def __repr__(self):
+        return '<Job %r kind:%r, status:%r>' % (self.id, self.kind, self.status)
+
+    def to_hash(self, format = 'full'):
+        return {
+        '_model_' : 'Job',
+        'id' : self.id,
+        'kind' : self.kind,
+        'status' : self.status,
+        'attempts' : self.attempts,
+        'result' : json.loads(self.result) if self.result else None,
+        'created_at' : self.created_at,
+        'finished_at' : self.finished_at}
+
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime())
+
+    def __init__(self, version, description):
+        self.version = version
+        self.description = description
+        self.applied_at = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '<SchemaMigration version:%r>' % self.version
+
+
+#
+# Bulk serialization
+#
+
+def prefetch_notes(notes):
+    '''Loads the medias, contexts, sites, accounts and feedbacks of the given
+    notes with one query each, so that to_hash('full') does not go back to the
+    database for every note. Returns the loaded objects; keep a reference to
+    them while serializing, the session only holds weak references.'''
+    notes = [n for n in notes if n.id is not None]
+    if len(notes) == 0:
+        return []
+    note_ids = [n.id for n in notes]
+
+    medias = Media.query.filter(Media.note_id.in_(note_ids)).order_by(Media.id).all()
+    medias_by_note = {}
+    for m in medias:
+        medias_by_note.setdefault(m.note_id, []).append(m)
+
+    feedbacks = Feedback.query.filter(Feedback.table_name == 'note',
+        Feedback.row_id.in_(note_ids)).order_by(Feedback.id).all()
+    feedbacks_by_note = {}
+    for f in feedbacks:
+        feedbacks_by_note.setdefault(f.row_id, []).append(f)
+
+    for n in notes:
+        set_committed_value(n, 'medias', medias_by_note.get(n.id, []))
+        set_committed_value(n, 'feedbacks', feedbacks_by_note.get(n.id, []))
+
+    # many-to-one relationships are resolved from the identity map, loading
+    # the targets is enough for note.context, context.site and note.account
+    context_ids = set(n.context_id for n in notes if n.context_id is not None)
+    contexts = []
+    if context_ids:
+        contexts = Context.query.options(joinedload(Context.site)).filter(Context.id.in_(context_ids)).all()
+
+    account_ids = set(n.account_id for n in notes) | set(f.account_id for f in feedbacks)
+    account_ids.discard(None)
+    accounts = []
+    if account_ids:
+        accounts = Account.query.filter(Account.id.in_(account_ids)).all()
+
+    return medias + feedbacks + contexts + accounts
+
+def notes_to_hash(notes, format = 'full'):
+    notes = list(notes)
+    if format == 'full':
+        loaded = prefetch_notes(notes)
+    return [n.to_hash(format) for n in notes]
+
+def project_hashes(hashes, fields):
+    return [dict((k, h[k]) for k in fields if k in h) for h in hashes]
+
+# nested hashes moved to a side table by normalize_hashes, by key
+SIDE_TABLES = {'context': 'contexts', 'site': 'sites', 'account': 'accounts'}
+
+def normalize_hashes(hashes):
+    '''Replaces the contexts, sites and accounts nested in the given hashes
+    by their ids. Returns the hashes and the side tables: the distinct
+    contexts, sites and accounts, themselves normalized.'''
+    tables = dict((name, {}) for name in SIDE_TABLES.values())
+    def walk(value):
+        if isinstance(value, list):
+            return [walk(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        h = {}
+        for key, v in value.items():
+            if key in SIDE_TABLES and isinstance(v, dict) and 'id' in v:
+                tables[SIDE_TABLES[key]][v['id']] = walk(v)
+                v = v['id']
+            else:
+                v = walk(v)
+            h[key] = v
+        return h
+    hashes = walk(hashes)
+    return hashes, dict((name, [rows[id] for id in sorted(rows)]) for name, rows in tables.items())
+
+# feedback.table_name -> the model of its target
+FEEDBACK_TARGET_MODELS = {'note': Note, 'context': Context, 'account': Account, 'media': Media}
+
+def prefetch_feedbacks(feedbacks, targets=True):
+    '''Loads the accounts of the given feedbacks, and with targets their
+    targets too, with one IN query per model, so that resolve() and
+    to_hash('full') are served from the identity map. Returns the loaded
+    objects, keep a reference to them while serializing.'''
+    feedbacks = [f for f in feedbacks if f.id is not None]
+    if len(feedbacks) == 0:
+        return []
+    loaded = []
+    account_ids = set(f.account_id for f in feedbacks)
+
+    if targets:
+        row_ids = {}
+        for f in feedbacks:
+            if f.table_name is not None and f.row_id is not None:
+                row_ids.setdefault(f.table_name.lower(), set()).add(f.row_id)
+        for table_name, ids in row_ids.items():
+            model = FEEDBACK_TARGET_MODELS.get(table_name)
+            if model is None:
+                continue
+            if model is Account:
+                # loaded below together with the authors
+                account_ids |= ids
+                continue
+            query = model.query
+            if model is Context:
+                query = query.options(joinedload(Context.site))
+            loaded.extend(query.filter(model.id.in_(ids)).all())
+
+    account_ids.discard(None)
+    if account_ids:
+        loaded.extend(Account.query.filter(Account.id.in_(account_ids)).all())
+    return loaded
+
+def feedbacks_to_hash(feedbacks, format = 'full'):
+    feedbacks = list(feedbacks)
+    loaded = prefetch_feedbacks(feedbacks, format == 'full')
+    return [f.to_hash(format) for f in feedbacks]
+
+#
+# Context registry
+#
+
+class ContextEntry(object):
+    # what the registry keeps of a context, safe to share between sessions
+    def __init__(self, id, kind, name, title, site_id):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.title = title
+        self.site_id = site_id
+
+    def __repr__(self):
+        return '<ContextEntry kind:%r, name:%r>' % (self.kind, self.name)
+
+class ContextRegistry(object):
+    '''The contexts by id and by name, loaded with one query and kept for
+    TTL seconds. Committing a change to a Context empties it. A lookup that
+    misses reloads it, at most once every MISS_INTERVAL seconds, so that a
+    context added by another process is found. With a shared response
+    cache, see cache.py, a change committed by another process is seen
+    within CHECK_INTERVAL seconds: the registry reloads when the generation
+    of that cache moved.'''
+    TTL = 600
+    MISS_INTERVAL = 30
+    CHECK_INTERVAL = 1
+
+    def __init__(self):
+        self.tables = None
+        self.loaded_at = 0
+        self.checked_at = 0
+        self.generation = None
+        # the generation of the shared cache, None without one
+        self.shared_generation = lambda: None
+
+    def load(self):
+        # read first, a change made while loading reloads at the next check
+        self.generation = self.shared_generation()
+        self.checked_at = time.time()
+        context = Context.__table__
+        rows = db.engine.execute(select([context.c.id, context.c.kind, context.c.name,
+            context.c.title, context.c.site_id]).order_by(context.c.id)).fetchall()
+        by_id, by_name = {}, {}
+        for row in rows:
+            entry = ContextEntry(*row)
+            by_id[entry.id] = entry
+            by_name.setdefault(entry.name, entry)
+        self.tables = (by_id, by_name)
+        self.loaded_at = time.time()
+        return self.tables
+
+    def clear(self):
+        self.tables = None
+
+    def lookup(self, table, key):
+        tables = self.tables
+        if tables is not None and self.checked_at + self.CHECK_INTERVAL < time.time():
+            self.checked_at = time.time()
+            if self.shared_generation() != self.generation:
+                tables = None
+        if tables is None or self.loaded_at + self.TTL < time.time():
+            tables = self.load()
+        entry = tables[table].get(key)
+        if entry is None and self.loaded_at + self.MISS_INTERVAL < time.time():
+            entry = self.load()[table].get(key)
+        return entry
+
+    def get(self, id):
+        try:
+            return self.lookup(0, int(id))
+        except (TypeError, ValueError):
+            return None
+
+    def find(self, name):
+        return self.lookup(1, name)
+
+context_registry = ContextRegistry()
+
+def context_changed(mapper, connection, context):
+    object_session(context).info['context_registry_stale'] = True
+
+for name in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(Context, name, context_changed)
+
+@event.listens_for(Session, 'after_commit')
+def clear_context_registry(session):
+    if session.info.pop('context_registry_stale', False):
+        context_registry.clear()
+
+@event.listens_for(Session, 'after_rollback')
+def keep_context_registry(session):
+    session.info.pop('context_registry_stale', None)
+
+def context_site_id(connection, context_id):
+    # on the flush's connection, which sees the context as this transaction
+    # does, uncommitted changes included; 0 for a context without a site
+    return connection.execute(site_of_context(context_id)).scalar() or 0
+
+#
+# Site feedbacks
+#
+
+def site_target_feedbacks(the_site, f):
+    # feedbacks (through the alias f) on the site's notes, medias and
+    # contexts, one join per target model. the alias keeps them from
+    # correlating with an enclosing feedback query.
+    on_notes = db.session.query(f).\
+        join(Note, and_(f.table_name == 'note', f.row_id == Note.id)).\
+        join(Context, Note.context_id == Context.id).\
+        filter(Context.site_id == the_site.id)
+    on_medias = db.session.query(f).\
+        join(Media, and_(f.table_name == 'media', f.row_id == Media.id)).\
+        join(Note, Media.note_id == Note.id).\
+        join(Context, Note.context_id == Context.id).\
+        filter(Context.site_id == the_site.id)
+    on_contexts = db.session.query(f).\
+        join(Context, and_(f.table_name == 'context', f.row_id == Context.id)).\
+        filter(Context.site_id == the_site.id)
+    return [on_notes, on_medias, on_contexts]
+
+def site_commenter_ids(the_site):
+    # accounts that commented on the site's notes, medias or contexts
+    f = aliased(Feedback)
+    queries = [q.filter(f.kind.ilike('comment')).with_entities(f.account_id)
+        for q in site_target_feedbacks(the_site, f)]
+    return queries[0].union(*queries[1:])
+
+def site_feedback_ids(the_site):
+    f = aliased(Feedback)
+    queries = [q.with_entities(f.id) for q in site_target_feedbacks(the_site, f)]
+    # feedbacks on an account belong to the site when that account commented there
+    queries.append(db.session.query(f.id).
+        filter(f.table_name == 'account', f.row_id.in_(site_commenter_ids(the_site))))
+    return queries[0].union(*queries[1:])
+
+#
+# Site membership
+#
+
+def site_of_note(note_id):
+    note, context = Note.__table__, Context.__table__
+    return select([context.c.site_id]).\
+        select_from(note.join(context, note.c.context_id == context.c.id)).\
+        where(note.c.id == note_id)
+
+def sites_of_feedback_target(table_name, row_id):
+    # a select of the site of the note, media or context (table_name, row_id)
+    note, media, context = Note.__table__, Media.__table__, Context.__table__
+    if table_name == 'note':
+        return site_of_note(row_id)
+    elif table_name == 'media':
+        return select([context.c.site_id]).\
+            select_from(media.join(note, media.c.note_id == note.c.id).
+                join(context, note.c.context_id == context.c.id)).\
+            where(media.c.id == row_id)
+    elif table_name == 'context':
+        return select([context.c.site_id]).where(context.c.id == row_id)
+    return None
+
+# an account is a member of a site when it wrote a note there or commented on
+# a note, media or context there (directly), or when it commented on an
+# account that is directly a member. member_sites() is that rule, both the
+# rebuild and the listeners apply it.
+
+def direct_sites(account_ids=None):
+    # the selects of the direct memberships, to be unioned
+    note, media, context, feedback = Note.__table__, Media.__table__, Context.__table__, Feedback.__table__
+    comment = db.func.lower(feedback.c.kind) == 'comment'
+    authors = select([note.c.account_id, context.c.site_id]).\
+        select_from(note.join(context, note.c.context_id == context.c.id))
+    on_notes = select([feedback.c.account_id, context.c.site_id]).\
+        select_from(feedback.join(note, feedback.c.row_id == note.c.id).
+            join(context, note.c.context_id == context.c.id)).\
+        where(feedback.c.table_name == 'note').where(comment)
+    on_medias = select([feedback.c.account_id, context.c.site_id]).\
+        select_from(feedback.join(media, feedback.c.row_id == media.c.id).
+            join(note, media.c.note_id == note.c.id).
+            join(context, note.c.context_id == context.c.id)).\
+        where(feedback.c.table_name == 'media').where(comment)
+    on_contexts = select([feedback.c.account_id, context.c.site_id]).\
+        select_from(feedback.join(context, feedback.c.row_id == context.c.id)).\
+        where(feedback.c.table_name == 'context').where(comment)
+    if account_ids is not None:
+        authors = authors.where(note.c.account_id.in_(account_ids))
+        on_notes, on_medias, on_contexts = [q.where(feedback.c.account_id.in_(account_ids))
+            for q in (on_notes, on_medias, on_contexts)]
+    return [authors, on_notes, on_medias, on_contexts]
+
+def member_sites(account_ids=None):
+    # (account_id, site_id) of the memberships of account_ids, or of everyone
+    feedback = Feedback.__table__
+    on_account = and_(feedback.c.table_name == 'account', db.func.lower(feedback.c.kind) == 'comment',
+        feedback.c.account_id != None)
+    targets = None
+    if account_ids is not None:
+        on_account = and_(on_account, feedback.c.account_id.in_(account_ids))
+        targets = select([feedback.c.row_id]).where(on_account)
+    direct = union(*direct_sites(targets)).alias()
+    on_accounts = select([feedback.c.account_id, direct.c.site_id]).\
+        select_from(feedback.join(direct, feedback.c.row_id == direct.c.account_id)).\
+        where(on_account)
+    members = union(*(direct_sites(account_ids) + [on_accounts])).alias()
+    return select([members.c.account_id, members.c.site_id]).\
+        where(members.c.account_id != None).where(members.c.site_id != None)
+
+def refresh_account_sites(connection, account_ids):
+    # makes the memberships of account_ids, and of the accounts that
+    # commented on them, follow member_sites()
+    feedback, membership = Feedback.__table__, AccountSite.__table__
+    account_ids = set(id for id in account_ids if id is not None)
+    if not account_ids:
+        return
+    account_ids.update(id for id, in connection.execute(select([feedback.c.account_id]).
+        where(feedback.c.table_name == 'account').where(feedback.c.row_id.in_(account_ids)).
+        where(db.func.lower(feedback.c.kind) == 'comment').where(feedback.c.account_id != None)))
+    account_ids = list(account_ids)
+    rows = set(tuple(row) for row in connection.execute(member_sites(account_ids)))
+    existing = set(tuple(row) for row in connection.execute(select([membership.c.account_id, membership.c.site_id]).
+        where(membership.c.account_id.in_(account_ids))))
+    for account_id, site_id in existing - rows:
+        connection.execute(membership.delete().where(membership.c.account_id == account_id).
+            where(membership.c.site_id == site_id))
+    now = datetime.datetime.utcnow()
+    for account_id, site_id in rows - existing:
+        insert_account_site(connection, account_id, site_id, now)
+
+def insert_account_site(connection, account_id, site_id, now):
+    # the join time is account_site.created_at, /api/sync/<site> sends the
+    # account again after it; account.modified_at is left to edits
+    if connection.dialect.name == 'postgresql':
+        # a concurrent flush may have added it first
+        connection.execute(text("INSERT INTO account_site (account_id, site_id, created_at) "
+            "VALUES (:account_id, :site_id, :now) ON CONFLICT DO NOTHING"),
+            account_id=account_id, site_id=site_id, now=now)
+        return
+    connection.execute(AccountSite.__table__.insert().values(account_id=account_id, site_id=site_id,
+        created_at=now))
+
+def is_comment(feedback):
+    return feedback.kind is not None and feedback.kind.lower() == 'comment'
+
+def commenter_ids(connection, note_id=None, media_id=None):
+    # who commented on the note and its medias, or on the media
+    feedback, media = Feedback.__table__, Media.__table__
+    if note_id is not None:
+        on_target = db.or_(and_(feedback.c.table_name == 'note', feedback.c.row_id == note_id),
+            and_(feedback.c.table_name == 'media',
+                feedback.c.row_id.in_(select([media.c.id]).where(media.c.note_id == note_id))))
+    else:
+        on_target = and_(feedback.c.table_name == 'media', feedback.c.row_id == media_id)
+    return [id for id, in connection.execute(select([feedback.c.account_id]).distinct().
+        where(on_target).where(db.func.lower(feedback.c.kind) == 'comment'))]
+
+@event.listens_for(Note, 'after_insert')
+def note_account_site(mapper, connection, note):
+    refresh_account_sites(connection, [note.account_id])
+
+@event.listens_for(Note, 'after_delete')
+def note_deleted_account_site(mapper, connection, note):
+    # the comments stay, without a site
+    refresh_account_sites(connection, [note.account_id] + commenter_ids(connection, note_id=note.id))
+
+@event.listens_for(Media, 'after_delete')
+def media_deleted_account_site(mapper, connection, media):
+    refresh_account_sites(connection, commenter_ids(connection, media_id=media.id))
+
+def load_previous_value(target, value, oldvalue, initiator):
+    pass
+
+# the account a note is taken from needs a refresh too, load it even when
+# the note was expired
+event.listen(Note.account_id, 'set', load_previous_value, active_history=True)
+
+@event.listens_for(Note, 'after_update')
+def note_moved_account_site(mapper, connection, note):
+    state = inspect(note)
+    if state.attrs.context_id.history.has_changes() or state.attrs.account_id.history.has_changes():
+        account_ids = [note.account_id] + list(state.attrs.account_id.history.deleted)
+        if state.attrs.context_id.history.has_changes():
+            # the comments on the note follow it to its new site
+            account_ids += commenter_ids(connection, note_id=note.id)
+        refresh_account_sites(connection, account_ids)
+
+@event.listens_for(Feedback, 'after_insert')
+@event.listens_for(Feedback, 'after_delete')
+def feedback_account_site(mapper, connection, feedback):
+    if is_comment(feedback):
+        refresh_account_sites(connection, [feedback.account_id])
+
+def rebuild_account_sites(connection):
+    '''Recomputes the whole account_site table from the notes and feedbacks.
+    The rows that stay keep their created_at, the join time.'''
+    membership = AccountSite.__table__
+    members = member_sites().alias()
+    same = and_(members.c.account_id == membership.c.account_id, members.c.site_id == membership.c.site_id)
+    connection.execute(membership.delete().where(~exists().where(same)))
+    members = member_sites().alias()
+    same = and_(members.c.account_id == membership.c.account_id, members.c.site_id == membership.c.site_id)
+    connection.execute(membership.insert().from_select(['account_id', 'site_id', 'created_at'],
+        select([members.c.account_id, members.c.site_id,
+            literal(datetime.datetime.utcnow(), db.DateTime)]).where(~exists().where(same))))
+
+#
+# Daily statistics
+#
+
+DAILY_STAT_METRICS = ('observations', 'designideas', 'users', 'comments', 'likes')
+
+NOTE_KIND_METRICS = {'FieldNote': 'observations', 'DesignIdea': 'designideas'}
+FEEDBACK_KIND_METRICS = {'comment': 'comments', 'like': 'likes'}
+
+# the attributes a row's (day, site, metric) depends on
+STAT_ATTRIBUTES = ('modified_at', 'kind', 'context_id', 'table_name', 'row_id')
+
+def site_of_context(context_id):
+    context = Context.__table__
+    return select([context.c.site_id]).where(context.c.id == context_id)
+
+def stat_key(connection, obj, value):
+    # the (day, site_id, metric) obj counts toward, value(name) reads its attributes
+    modified_at = value('modified_at')
+    if modified_at is None:
+        return None
+    if isinstance(modified_at, datetime.datetime):
+        modified_at = modified_at.date()
+    sites = None
+    site_id = 0
+    if isinstance(obj, Note):
+        metric = NOTE_KIND_METRICS.get(value('kind'))
+        if value('context_id') is not None:
+            site_id = context_site_id(connection, value('context_id'))
+    elif isinstance(obj, Feedback):
+        kind = value('kind')
+        metric = FEEDBACK_KIND_METRICS.get(kind.lower() if kind else None)
+        table_name = value('table_name')
+        if table_name is not None and table_name.lower() in ('note', 'media', 'context'):
+            sites = sites_of_feedback_target(table_name.lower(), value('row_id'))
+    else:
+        metric = 'users'
+    if metric is None:
+        return None
+    if sites is not None:
+        site_id = connection.execute(sites).scalar() or 0
+    return (modified_at, site_id, metric)
+
+def change_stat(connection, key, delta):
+    if key is None:
+        return
+    day, site_id, metric = key
+    if connection.dialect.name == 'postgresql':
+        # two flushes may both add the first row of a day, the loser adds to it
+        connection.execute(text("INSERT INTO daily_stat (day, site_id, metric, count) "
+            "VALUES (:day, :site_id, :metric, :delta) ON CONFLICT (metric, day, site_id) "
+            "DO UPDATE SET count = daily_stat.count + excluded.count"),
+            day=day, site_id=site_id, metric=metric, delta=delta)
+        return
+    stat = DailyStat.__table__
+    where = and_(stat.c.day == day, stat.c.site_id == site_id, stat.c.metric == metric)
+    result = connection.execute(stat.update().where(where).values(count=stat.c.count + delta))
+    if result.rowcount == 0:
+        connection.execute(stat.insert().values(day=day, site_id=site_id, metric=metric, count=delta))
+
+def current_values(obj):
+    return lambda name: getattr(obj, name, None)
+
+def previous_values(obj):
+    # the values obj had before the changes being flushed
+    state = inspect(obj)
+    def value(name):
+        if name not in state.attrs:
+            return None
+        history = state.attrs[name].history
+        if history.deleted:
+            return history.deleted[0]
+        return getattr(obj, name)
+    return value
+
+def stat_inserted(mapper, connection, obj):
+    change_stat(connection, stat_key(connection, obj, current_values(obj)), 1)
+
+def stat_updated(mapper, connection, obj):
+    state = inspect(obj)
+    if not any(state.attrs[name].history.has_changes() for name in STAT_ATTRIBUTES if name in state.attrs):
+        return
+    previous = stat_key(connection, obj, previous_values(obj))
+    current = stat_key(connection, obj, current_values(obj))
+    if previous != current:
+        change_stat(connection, previous, -1)
+        change_stat(connection, current, 1)
+    if isinstance(obj, Note) and state.attrs.context_id.history.has_changes():
+        move_note_feedback_stats(connection, obj, previous_values(obj)('context_id'), obj.context_id)
+
+def move_note_feedback_stats(connection, note, previous_context_id, context_id):
+    # the feedbacks on a note and its medias count toward the note's site
+    previous_site_id, site_id = 0, 0
+    if previous_context_id is not None:
+        previous_site_id = context_site_id(connection, previous_context_id)
+    if context_id is not None:
+        site_id = context_site_id(connection, context_id)
+    if previous_site_id == site_id:
+        return
+    feedback, media = Feedback.__table__, Media.__table__
+    media_ids = select([media.c.id]).where(media.c.note_id == note.id)
+    rows = connection.execute(select([feedback.c.modified_at, feedback.c.kind]).where(
+        db.or_(and_(feedback.c.table_name == 'note', feedback.c.row_id == note.id),
+               and_(feedback.c.table_name == 'media', feedback.c.row_id.in_(media_ids)))))
+    for modified_at, kind in rows:
+        metric = FEEDBACK_KIND_METRICS.get(kind.lower() if kind else None)
+        if metric is None or modified_at is None:
+            continue
+        if isinstance(modified_at, datetime.datetime):
+            modified_at = modified_at.date()
+        change_stat(connection, (modified_at, previous_site_id, metric), -1)
+        change_stat(connection, (modified_at, site_id, metric), 1)
+
+def stat_deleted(mapper, connection, obj):
+    change_stat(connection, stat_key(connection, obj, previous_values(obj)), -1)
+    if isinstance(obj, Note):
+        # the feedbacks left behind no longer have a site
+        move_note_feedback_stats(connection, obj, previous_values(obj)('context_id'), None)
+
+for model in (Note, Feedback, Account):
+    event.listen(model, 'after_insert', stat_inserted)
+    event.listen(model, 'after_update', stat_updated)
+    event.listen(model, 'after_delete', stat_deleted)
+
+# setting one of these on an expired row loads the value it replaces, so
+# that previous_values() finds it in the history
+for model in (Note, Feedback, Account):
+    for name in STAT_ATTRIBUTES:
+        if name in model.__table__.c:
+            event.listen(getattr(model, name), 'set', load_previous_value, active_history=True)
+
+def rebuild_daily_stats(connection):
+    '''Recomputes the whole daily_stat table from the notes, feedbacks and accounts.'''
+    note, feedback, account = Note.__table__, Feedback.__table__, Account.__table__
+    context, media = Context.__table__, Media.__table__
+    stat = DailyStat.__table__
+    columns = ['day', 'site_id', 'metric', 'count']
+    connection.execute(stat.delete())
+
+    def insert(metric, day, site_id, from_obj, *conditions):
+        query = select([day, site_id, literal(metric), db.func.count()]).select_from(from_obj).\
+            where(day != None).group_by(day, site_id)
+        for condition in conditions:
+            query = query.where(condition)
+        connection.execute(stat.insert().from_select(columns, query))
+
+    note_day = db.func.date(note.c.modified_at)
+    note_site = db.func.coalesce(context.c.site_id, 0)
+    with_context = note.outerjoin(context, note.c.context_id == context.c.id)
+    for kind, metric in NOTE_KIND_METRICS.items():
+        insert(metric, note_day, note_site, with_context, note.c.kind == kind)
+
+    insert('users', db.func.date(account.c.modified_at), literal(0), account)
+
+    # the site of a feedback, through whichever target it has
+    on_note, note_context = note.alias(), context.alias()
+    on_media, media_note, media_context = media.alias(), note.alias(), context.alias()
+    on_context = context.alias()
+    with_targets = feedback.\
+        outerjoin(on_note, and_(feedback.c.table_name == 'note', feedback.c.row_id == on_note.c.id)).\
+        outerjoin(note_context, on_note.c.context_id == note_context.c.id).\
+        outerjoin(on_media, and_(feedback.c.table_name == 'media', feedback.c.row_id == on_media.c.id)).\
+        outerjoin(media_note, on_media.c.note_id == media_note.c.id).\
+        outerjoin(media_context, media_note.c.context_id == media_context.c.id).\
+        outerjoin(on_context, and_(feedback.c.table_name == 'context', feedback.c.row_id == on_context.c.id))
+    feedback_site = db.func.coalesce(note_context.c.site_id, media_context.c.site_id, on_context.c.site_id, 0)
+    for kind, metric in FEEDBACK_KIND_METRICS.items():
+        insert(metric, db.func.date(feedback.c.modified_at), feedback_site, with_targets,
+            db.func.lower(feedback.c.kind) == kind)
+
+#
+# Active contexts
+#
+
+def is_active(extras):
+    # a context is active unless its extras are json with a false "active"
+    try:
+        e = json.loads(extras)
+        return 'active' not in e or bool(e['active'])
+    except:
+        return True
+
+@event.listens_for(Context, 'before_insert')
+@event.listens_for(Context, 'before_update')
+def set_context_active(mapper, connection, context):
+    context.active = is_active(context.extras)
+
+#
+# Note kinds
+#
+
+# note.kind is stored under these names whatever case it was sent in, so
+# that it is compared with = and uses ix_note_kind
+NOTE_KINDS = dict((kind.lower(), kind) for kind in ['FieldNote', 'DesignIdea'])
+
+def note_kind(kind):
+    if kind is None:
+        return None
+    return NOTE_KINDS.get(kind.lower(), kind)
+
+@event.listens_for(Note, 'before_insert')
+@event.listens_for(Note, 'before_update')
+def set_note_kind(mapper, connection, note):
+    note.kind = note_kind(note.kind)
+
+#
+# Modification times
+#
+
+@event.listens_for(Media, 'before_update')
+@event.listens_for(Context, 'before_update')
+@event.listens_for(Site, 'before_update')
+def set_modified_at(mapper, connection, target):
+    if object_session(target).is_modified(target, include_collections=False):
+        target.modified_at = datetime.datetime.utcnow()
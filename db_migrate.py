@@ -0,0 +1,227 @@
+'''
+Schema migrations for an existing database.
+
+db_create.py builds a fresh database from the models and stamps it with
+the latest version, so migrations only need to bring older databases up
+to date. Each migration runs in its own transaction.
+
+    python db_migrate.py            apply the pending migrations
+    python db_migrate.py status     list the migrations and whether they ran
+    python db_migrate.py stamp      mark every migration as applied
+'''
+import sys
+import datetime
+
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import literal
+from sqlalchemy import bindparam
+from sqlalchemy import inspect
+
+from db_def import db
+from db_def import Site
+from db_def import Account
+from db_def import Note
+from db_def import Media
+from db_def import Context
+from db_def import Feedback
+from db_def import InteractionLog
+from db_def import Job
+from db_def import AccountSite
+from db_def import rebuild_account_sites
+from db_def import DailyStat
+from db_def import rebuild_daily_stats
+from db_def import InteractionBatch
+from db_def import InteractionHour
+from db_def import DeviceHeartbeat
+from db_def import DEFAULT_DEVICE
+from db_def import is_active
+from db_def import NOTE_KINDS
+from db_def import SchemaMigration
+
+MIGRATIONS = []
+
+def migration(version, description):
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        return f
+    return decorator
+
+def create_missing_indexes(connection, table, names):
+    existing = set(ix['name'] for ix in inspect(connection).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            print "creating index %s on %s" % (index.name, table.name)
+            index.create(connection)
+
+def add_missing_columns(connection, table, names):
+    existing = set(c['name'] for c in inspect(connection).get_columns(table.name))
+    for name in names:
+        if name not in existing:
+            column = table.c[name]
+            print "adding column %s.%s" % (table.name, name)
+            connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name,
+                column.type.compile(dialect=connection.dialect)))
+
+#
+# Migrations
+#
+
+@migration(1, "lowercase feedback.table_name, index the hot query predicates")
+def add_query_indexes(connection):
+    feedback = Feedback.__table__
+    connection.execute(feedback.update().
+        where(feedback.c.table_name != func.lower(feedback.c.table_name)).
+        values(table_name=func.lower(feedback.c.table_name)))
+    create_missing_indexes(connection, Feedback.__table__, ['ix_feedback_table_name_row_id_kind'])
+    create_missing_indexes(connection, Note.__table__,
+        ['ix_note_context_id_modified_at', 'ix_note_kind', 'ix_note_account_id'])
+    create_missing_indexes(connection, Context.__table__, ['ix_context_site_id_kind', 'ix_context_name'])
+    create_missing_indexes(connection, InteractionLog.__table__, ['ix_interaction_log_site_id_created_at'])
+
+@migration(2, "note.trello_list_id and the note -> trello card index")
+def add_trello_card_index(connection):
+    add_missing_columns(connection, Note.__table__, ['trello_list_id'])
+    create_missing_indexes(connection, Note.__table__, ['ix_note_trello_card_id'])
+
+@migration(3, "job table for the outbound job queue")
+def add_job_table(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+@migration(4, "account_site membership table, filled from the notes and feedbacks")
+def add_account_site_table(connection):
+    AccountSite.__table__.create(connection, checkfirst=True)
+    rebuild_account_sites(connection)
+
+@migration(5, "account.password_hash, filled when each account logs in")
+def add_password_hash(connection):
+    add_missing_columns(connection, Account.__table__, ['password_hash'])
+
+@migration(6, "daily_stat rollup behind /api/stats, filled from the notes, feedbacks and accounts")
+def add_daily_stat_table(connection):
+    DailyStat.__table__.create(connection, checkfirst=True)
+    rebuild_daily_stats(connection)
+
+@migration(7, "interaction_batch idempotency keys")
+def add_interaction_batch_table(connection):
+    InteractionBatch.__table__.create(connection, checkfirst=True)
+
+@migration(8, "interaction_log.occurred_at and the interaction_hour rollup")
+def add_interaction_rollup(connection):
+    # occurred_at of the existing rows is filled by: python interactions.py dates
+    add_missing_columns(connection, InteractionLog.__table__, ['occurred_at'])
+    InteractionHour.__table__.create(connection, checkfirst=True)
+
+@migration(9, "device_heartbeat, seeded from the 'tabletop is alive' interactions")
+def add_device_heartbeat_table(connection):
+    heartbeat = DeviceHeartbeat.__table__
+    heartbeat.create(connection, checkfirst=True)
+    log = InteractionLog.__table__
+    last_seen = select([log.c.site_id, literal(DEFAULT_DEVICE), func.max(log.c.created_at),
+        func.min(log.c.created_at)]).\
+        where(func.lower(log.c.details) == 'tabletop is alive').\
+        where(log.c.site_id != None).group_by(log.c.site_id)
+    connection.execute(heartbeat.insert().from_select(
+        ['site_id', 'device', 'last_seen_at', 'created_at'], last_seen))
+
+@migration(10, "context.active, parsed from context.extras")
+def add_context_active(connection):
+    add_missing_columns(connection, Context.__table__, ['active'])
+    create_missing_indexes(connection, Context.__table__, ['ix_context_site_id_active'])
+    context = Context.__table__
+    rows = connection.execute(select([context.c.id, context.c.extras])).fetchall()
+    if len(rows) > 0:
+        connection.execute(context.update().where(context.c.id == bindparam('context_id')).
+            values(active=bindparam('is_active')),
+            [{'context_id': id, 'is_active': is_active(extras)} for id, extras in rows])
+
+@migration(11, "job.result, the outcome of jobs such as site exports")
+def add_job_result(connection):
+    add_missing_columns(connection, Job.__table__, ['result'])
+
+@migration(12, "index feedback.account_id, read when an account's memberships are refreshed")
+def add_feedback_account_index(connection):
+    create_missing_indexes(connection, Feedback.__table__, ['ix_feedback_account_id'])
+
+@migration(13, "interaction_batch keyed by site and key")
+def key_interaction_batch_by_site(connection):
+    # the keys are only kept a few days, the table is small enough to copy
+    batch = InteractionBatch.__table__
+    rows = [dict(row) for row in connection.execute(batch.select())]
+    batch.drop(connection)
+    batch.create(connection)
+    if len(rows) > 0:
+        connection.execute(batch.insert(), rows)
+
+@migration(14, "note.kind in its canonical case, compared with =")
+def normalize_note_kinds(connection):
+    note = Note.__table__
+    n = 0
+    for kind in NOTE_KINDS.values():
+        n += connection.execute(note.update().
+            where(func.lower(note.c.kind) == kind.lower()).where(note.c.kind != kind).
+            values(kind=kind)).rowcount
+    if n > 0:
+        # the notes of other cases were not counted
+        rebuild_daily_stats(connection)
+
+@migration(15, "media.modified_at, the media cursor of /api/sync")
+def add_media_modified_at(connection):
+    add_missing_columns(connection, Media.__table__, ['modified_at'])
+    media = Media.__table__
+    connection.execute(media.update().where(media.c.modified_at == None).
+        values(modified_at=media.c.created_at))
+
+@migration(16, "site.modified_at and context.modified_at, in the ETags of full notes")
+def add_site_context_modified_at(connection):
+    now = datetime.datetime.utcnow()
+    for table in [Site.__table__, Context.__table__]:
+        add_missing_columns(connection, table, ['modified_at'])
+        connection.execute(table.update().where(table.c.modified_at == None).values(modified_at=now))
+
+#
+# Runner
+#
+
+def applied_versions():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return set(m.version for m in SchemaMigration.query.all())
+
+def pending():
+    done = applied_versions()
+    return [m for m in sorted(MIGRATIONS) if m[0] not in done]
+
+def upgrade():
+    todo = pending()
+    if len(todo) == 0:
+        print "database is up to date."
+    for version, description, f in todo:
+        print "applying migration %d: %s" % (version, description)
+        with db.engine.begin() as connection:
+            f(connection)
+            connection.execute(SchemaMigration.__table__.insert(),
+                version=version, description=description,
+                applied_at=datetime.datetime.utcnow())
+
+def stamp():
+    for version, description, f in pending():
+        db.session.add(SchemaMigration(version, description))
+    db.session.commit()
+
+def status():
+    done = applied_versions()
+    for version, description, f in sorted(MIGRATIONS):
+        state = 'applied' if version in done else 'pending'
+        print "%3d  %-8s %s" % (version, state, description)
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    if command == 'upgrade':
+        upgrade()
+    elif command == 'stamp':
+        stamp()
+    elif command == 'status':
+        status()
+    else:
+        print __doc__
+        sys.exit(1)
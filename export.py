@@ -0,0 +1,191 @@
+'''
+Exports the notes, medias and feedbacks of a site, for analysis.
+
+    python export.py <site>                            ndjson files in the current directory
+    python export.py <site> --format csv --gzip        gzipped csv files
+    python export.py <site> --format columns -o dir    columnar files, in dir
+    python export.py <site> --tables notes,medias      some of the tables only
+
+Each table goes to <site>-<table>.<format>, plus .gz with --gzip. The rows
+are read through a server side cursor, BATCH_SIZE at a time, and written
+as they come, so memory does not grow with the site. The username and
+context name of each row come from joins in the same query. Dates are
+written in ISO 8601.
+
+ndjson is one JSON object per line, csv a header line then utf-8 rows.
+columns is one JSON object per group of up to GROUP_SIZE rows, holding an
+array of values per column: it compresses better than rows and loads
+column by column into a data frame.
+
+POST /api/export/at/<site> runs the same export in a job, see api.py.
+'''
+import os
+import csv
+import gzip
+import argparse
+import datetime
+
+from sqlalchemy import select
+
+from db_def import db
+from db_def import Site
+from db_def import Account
+from db_def import Context
+from db_def import Note
+from db_def import Media
+from db_def import Feedback
+from db_def import site_feedback_ids
+import serializer
+
+# rows fetched per round trip
+BATCH_SIZE = 1000
+# rows per group of the columns format
+GROUP_SIZE = 10000
+
+def notes_select(the_site):
+    note, context, account = Note.__table__, Context.__table__, Account.__table__
+    return select([note.c.id, note.c.kind, note.c.content, note.c.status,
+        note.c.latitude, note.c.longitude, note.c.created_at, note.c.modified_at,
+        note.c.account_id, account.c.username, note.c.web_username,
+        note.c.context_id, context.c.name.label('context')]).\
+        select_from(note.join(context, note.c.context_id == context.c.id).
+            outerjoin(account, note.c.account_id == account.c.id)).\
+        where(context.c.site_id == the_site.id).order_by(note.c.id)
+
+def medias_select(the_site):
+    media, note, context = Media.__table__, Note.__table__, Context.__table__
+    return select([media.c.id, media.c.note_id, media.c.kind, media.c.title,
+        media.c.link, media.c.created_at, media.c.modified_at]).\
+        select_from(media.join(note, media.c.note_id == note.c.id).
+            join(context, note.c.context_id == context.c.id)).\
+        where(context.c.site_id == the_site.id).order_by(media.c.id)
+
+def feedbacks_select(the_site):
+    feedback, account = Feedback.__table__, Account.__table__
+    return select([feedback.c.id, feedback.c.kind, feedback.c.content,
+        feedback.c.table_name, feedback.c.row_id, feedback.c.parent_id,
+        feedback.c.created_at, feedback.c.modified_at,
+        feedback.c.account_id, account.c.username, feedback.c.web_username]).\
+        select_from(feedback.outerjoin(account, feedback.c.account_id == account.c.id)).\
+        where(feedback.c.id.in_(site_feedback_ids(the_site))).order_by(feedback.c.id)
+
+TABLES = [('notes', notes_select), ('medias', medias_select), ('feedbacks', feedbacks_select)]
+
+def plain(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+#
+# Formats
+#
+
+class NdjsonWriter(object):
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns
+
+    def write(self, row):
+        self.out.write(serializer.dumps(dict(zip(self.columns, row))) + '\n')
+
+    def close(self):
+        pass
+
+class CsvWriter(object):
+    def __init__(self, out, columns):
+        self.writer = csv.writer(out)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+
+    def close(self):
+        pass
+
+class ColumnsWriter(object):
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns
+        self.group = []
+
+    def write(self, row):
+        self.group.append(row)
+        if len(self.group) >= GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.group) > 0:
+            self.out.write(serializer.dumps({'columns': self.columns, 'rows': len(self.group),
+                'values': [list(values) for values in zip(*self.group)]}) + '\n')
+        self.group = []
+
+    def close(self):
+        self.flush()
+
+FORMATS = {'ndjson': NdjsonWriter, 'csv': CsvWriter, 'columns': ColumnsWriter}
+
+#
+# Export
+#
+
+def export_table(connection, query, path, format, compress, progress=None):
+    # writes the rows of query to path, returns how many there were.
+    # progress() is called after each batch.
+    out = gzip.open(path, 'wb') if compress else open(path, 'wb')
+    try:
+        result = connection.execution_options(stream_results=True).execute(query)
+        writer = FORMATS[format](out, result.keys())
+        n = 0
+        rows = result.fetchmany(BATCH_SIZE)
+        while len(rows) > 0:
+            for row in rows:
+                writer.write([plain(v) for v in row])
+            n += len(rows)
+            if progress is not None:
+                progress()
+            rows = result.fetchmany(BATCH_SIZE)
+        writer.close()
+        result.close()
+    finally:
+        out.close()
+    return n
+
+def export_site(the_site, directory, format='ndjson', compress=False, tables=None, progress=None):
+    # one file per table, read from one snapshot so that they agree
+    files = []
+    connection = db.engine.connect()
+    if connection.dialect.name == 'postgresql':
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+    try:
+        with connection.begin():
+            for table, query in TABLES:
+                if tables is not None and table not in tables:
+                    continue
+                name = '%s-%s.%s' % (the_site.name, table, format)
+                if compress:
+                    name += '.gz'
+                path = os.path.join(directory, name)
+                rows = export_table(connection, query(the_site), path, format, compress, progress)
+                files.append({'table': table, 'path': path, 'rows': rows})
+    finally:
+        connection.close()
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the notes, medias and feedbacks of a site.")
+    parser.add_argument('site')
+    parser.add_argument('--format', choices=sorted(FORMATS.keys()), default='ndjson')
+    parser.add_argument('--gzip', action='store_true', help="compress the files")
+    parser.add_argument('--tables', help="comma separated, among %s" % ', '.join(t for t, q in TABLES))
+    parser.add_argument('-o', '--directory', default='.', help="where to write the files")
+    args = parser.parse_args()
+
+    the_site = Site.query.filter_by(name=args.site).first()
+    if the_site is None:
+        parser.error("site %s does not exist" % args.site)
+    tables = args.tables.split(',') if args.tables else None
+    for f in export_site(the_site, args.directory, args.format, args.gzip, tables):
+        print "%s: %d rows in %s" % (f['table'], f['rows'], f['path'])
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,31 @@
-from openpyxl.reader.excel import load_workbook
+'''
+Loads the sites, accounts, contexts, notes and feedbacks of a workbook.
 
+    python import.py [data.xlsx]                  recreate the schema and load the workbook
+    python import.py [data.xlsx] --incremental    add and update rows, keep the rest
+    python import.py [data.xlsx] --deployment     sites and contexts only, plus the default account
+
+The first cell of each sheet holds its number of rows, the rows follow.
+Accounts, contexts and notes keep the ids of the sheet, so that feedbacks
+can refer to them. The sheets are streamed and the rows inserted in batches
+with a lookup table per referenced model. With --incremental, sites and
+contexts are matched by name, accounts by username, notes by id, medias by
+note and link, and feedbacks by all their columns, looking up the rows of
+each batch only, so that memory follows the batch size rather than the
+tables. The rows found are updated when they changed, the others
+inserted. Everything happens in one
+transaction, the account_site and daily_stat tables are rebuilt at the end.
+'''
+import argparse
 import datetime
+from random import randint
+
+from openpyxl import load_workbook
+from sqlalchemy import select
+from sqlalchemy import bindparam
+from sqlalchemy import or_
+from werkzeug.security import generate_password_hash
+from werkzeug.security import check_password_hash
 
 from db_def import db
 from db_def import Account
@@ -9,158 +34,293 @@ from db_def import Media
 from db_def import Context
 from db_def import Feedback
 from db_def import Site
+from db_def import is_active
+from db_def import note_kind
+from db_def import rebuild_account_sites
+from db_def import rebuild_daily_stats
+from db_def import context_registry
+import db_migrate
+import cache
 
-db.drop_all()
-db.create_all()
-
-deployment = False
-
-
-wb = load_workbook(filename = r'data.xlsx')
-context_sheet = wb.get_sheet_by_name(name = 'Context')
-site_sheet = wb.get_sheet_by_name(name = 'Site')
-account_sheet = wb.get_sheet_by_name(name = 'Account')
-note_sheet = wb.get_sheet_by_name(name = 'Note')
-feedback_sheet = wb.get_sheet_by_name(name = 'Feedback')
-
-n = site_sheet.cell('A1').value
-for i in range(2,2+n):
-	name = site_sheet.cell('B' + str(i)).value	
-	description  = site_sheet.cell('C' + str(i)).value
-	image_url  = site_sheet.cell('D' + str(i)).value
-
-	site = Site(name, description)
-	site.image_url = image_url
-	db.session.add(site)
-	print "create site: %s" % site		
-db.session.commit()		
-
-created_at = datetime.date(2014,3,1)
-
-if not deployment:
-	n = account_sheet.cell('A1').value
-	for i in range(2,2+n):
-		id = account_sheet.cell('A' + str(i)).value	
-		username = account_sheet.cell('B' + str(i)).value
-		account = Account(username)
-		account.name = account_sheet.cell('C' + str(i)).value
-		account.email = account_sheet.cell('D' + str(i)).value
-		account.password = account_sheet.cell('E' + str(i)).value
-		account.consent = account_sheet.cell('F' + str(i)).value
-		account.icon_url = account_sheet.cell('G' + str(i)).value
-
-		created_at += datetime.timedelta(days=1)
-		account.created_at = created_at
-		account.modified_at =  created_at
-		if id:
-			print "create account: %s" % account
-			db.session.add(account)
-	db.session.commit()
-else:
-	account = Account("default")
-	created_at += datetime.timedelta(days=1)
-	account.created_at = created_at
-	account.modified_at =  created_at
-	db.session.add(account)
-	db.session.commit()
-
-n = context_sheet.cell('A1').value
-for i in range(2,2+n):
-	id = note_sheet.cell('A' + str(i)).value	
-	kind = context_sheet.cell('B' + str(i)).value
-	name = context_sheet.cell('C' + str(i)).value
-	title = context_sheet.cell('D' + str(i)).value
-	description = context_sheet.cell('E' + str(i)).value
-	site = context_sheet.cell('F' + str(i)).value
-	# extras = context_sheet.cell('G' + str(i)).value
-	context = Context(kind, name, title, description)
-	# context.extras = extras
-	
-	site = Site.query.filter_by(name=site).first()
-	context.site_id = site.id
-
-	if kind == 'Landmark':
-		lat = context_sheet.cell('G' + str(i)).value
-		lgn = context_sheet.cell('H' + str(i)).value
-		context.extras = str({"latitude": float(lat), "longitude": float(lgn)})
-
-	if id:
-		print "create context: %s" % context
-		db.session.add(context)
-db.session.commit()
-
-created_at = datetime.datetime(2014,4,1,0,0)
+BATCH_SIZE = 1000
+# rows looked up per query, under the bound parameters sqlite allows
+LOOKUP_SIZE = 400
 
+def sheet_rows(wb, name, columns):
+    # the rows of a sheet as lists of columns values, without the count row
+    rows = wb[name].iter_rows(min_row=1)
+    n = next(rows)[0].value or 0
+    for i, row in enumerate(rows):
+        if i >= n:
+            break
+        values = [cell.value for cell in row][:columns]
+        yield values + [None] * (columns - len(values))
 
-from random import randint
+def column_values(obj):
+    # the row obj would be inserted as, defaults of its constructor included
+    return dict((c.key, getattr(obj, c.key)) for c in obj.__table__.c if getattr(obj, c.key) is not None)
+
+class Writer(object):
+    '''Inserts and updates the rows of a table, batch_size at a time. The
+    rows of a batch are matched to the ones already in the table by the key
+    columns, looked up with one query per batch on the lookup columns (the
+    first key column by default); a matched row is updated when one of the
+    compared columns changed.'''
+    def __init__(self, connection, table, key, columns, batch_size, parent=None, lookup=None):
+        self.connection = connection
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self.batch_size = batch_size
+        # a writer of the rows these refer to, flushed first
+        self.parent = parent
+        self.lookup = lookup or key[:1]
+        self.pending = []
+        self.inserted = 0
+        self.updated = 0
+        self.now = datetime.datetime.utcnow()
+
+    def save(self, values, insert=True, force=False, insert_only=()):
+        # insert_only: columns left alone when the row is already there
+        self.pending.append((values, insert, force, insert_only))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def key_of(self, values):
+        return tuple(values.get(k) for k in self.key)
+
+    def existing(self, batch):
+        # key -> row of the rows already in the table with the keys of batch
+        c = self.table.c
+        # labeled, the key may be the id itself
+        columns = [c.id.label('known_id')] + [c[k] for k in self.key] + [c[k] for k in self.columns]
+        keys = set(self.key_of(values) for values in batch)
+        found = {}
+        for i in range(0, len(batch), LOOKUP_SIZE):
+            query = select(columns)
+            for name in self.lookup:
+                values = set(v.get(name) for v in batch[i:i + LOOKUP_SIZE])
+                condition = c[name].in_([v for v in values if v is not None])
+                if None in values:
+                    condition = or_(condition, c[name] == None)
+                query = query.where(condition)
+            for row in self.connection.execute(query):
+                key = tuple(row[k] for k in self.key)
+                if key in keys:
+                    found.setdefault(key, dict(row))
+        return found
+
+    def flush(self):
+        if self.parent is not None:
+            self.parent.flush()
+        batch, self.pending = self.pending, []
+        found = self.existing([values for values, insert, force, insert_only in batch])
+        inserts, updates = [], []
+        for values, insert, force, insert_only in batch:
+            key = self.key_of(values)
+            row = found.get(key)
+            if row is not None:
+                values = dict((k, v) for k, v in values.items() if k not in insert_only)
+                changed = any(c in values and values[c] != row[c] for c in self.columns)
+                if row['known_id'] is not None and (changed or force):
+                    updates.append(self.update_values(row['known_id'], values))
+            elif insert:
+                # twice in the batch, inserted once
+                found[key] = dict(values, known_id=values.get('id'))
+                inserts.append(values)
+        # executemany wants the same keys in every row
+        for keys, rows in group_by_keys(inserts):
+            self.connection.execute(self.table.insert(), rows)
+            self.inserted += len(rows)
+        for keys, rows in group_by_keys(updates):
+            values = dict((k, bindparam(k)) for k in keys if k != 'row_id')
+            self.connection.execute(self.table.update().
+                where(self.table.c.id == bindparam('row_id')).values(values), rows)
+            self.updated += len(rows)
+
+    def update_values(self, row_id, values):
+        # a changed row must be sent again by /api/sync
+        values = dict(values)
+        values.pop('id', None)
+        values.pop('created_at', None)
+        if 'modified_at' in self.table.c:
+            values['modified_at'] = self.now
+        values['row_id'] = row_id
+        return values
+
+    def close(self):
+        self.flush()
+        print "%s: %d inserted, %d updated" % (self.table.name, self.inserted, self.updated)
+
+    def ids(self):
+        # key -> id for a single column key, with the ids the database gave
+        # the inserted rows
+        return lookup(self.connection, self.table.c[self.key[0]], self.table.c.id)
+
+def group_by_keys(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return groups.items()
+
+def lookup(connection, key, value):
+    # key -> value of the rows already in the table
+    return dict((k, v) for k, v in connection.execute(select([key, value])))
+
+#
+# Sheets
+#
+
+def import_sites(connection, wb, args):
+    writer = Writer(connection, Site.__table__, ['name'], ['description', 'image_url'], args.batch_size)
+    for id, name, description, image_url in sheet_rows(wb, 'Site', 4):
+        site = Site(name, description)
+        site.image_url = image_url
+        writer.save(column_values(site))
+    writer.close()
+    return writer.ids()
+
+def import_accounts(connection, wb, args):
+    accounts = Account.__table__
+    writer = Writer(connection, accounts, ['username'], ['name', 'email', 'consent', 'icon_url'], args.batch_size)
+    password_hashes = lookup(connection, accounts.c.username, accounts.c.password_hash)
+    created_at = datetime.date(2014, 3, 1)
+    rows = sheet_rows(wb, 'Account', 7)
+    if args.deployment:
+        rows = [[None, 'default', None, None, None, None, None]]
+    for id, username, name, email, password, consent, icon_url in rows:
+        account = Account(username)
+        account.id = id
+        account.name = name
+        account.email = email
+        account.consent = consent
+        if icon_url:
+            account.icon_url = icon_url
+        created_at += datetime.timedelta(days=1)
+        account.created_at = created_at
+        account.modified_at = created_at
+        new_password = False
+        if password:
+            password = unicode(password)
+            previous = password_hashes.get(username)
+            new_password = previous is None or not check_password_hash(str(previous), password)
+            if new_password:
+                account.password_hash = generate_password_hash(password)
+        writer.save(column_values(account), insert=bool(id) or args.deployment, force=new_password)
+    writer.close()
+    return writer.ids()
+
+def import_contexts(connection, wb, args, site_ids):
+    writer = Writer(connection, Context.__table__, ['name'],
+        ['kind', 'title', 'description', 'extras', 'site_id'], args.batch_size)
+    for id, kind, name, title, description, site, lat, lng in sheet_rows(wb, 'Context', 8):
+        if site not in site_ids:
+            print "skipping context %s: unknown site %s" % (name, site)
+            continue
+        context = Context(kind, name, title, description)
+        context.id = id
+        context.site_id = site_ids[site]
+        if kind == 'Landmark':
+            context.extras = str({"latitude": float(lat), "longitude": float(lng)})
+        context.active = is_active(context.extras)
+        writer.save(column_values(context), insert=bool(id))
+    writer.close()
+    return writer.ids()
+
+def import_notes(connection, wb, args, account_ids, context_ids):
+    notes = Writer(connection, Note.__table__, ['id'],
+        ['account_id', 'context_id', 'kind', 'content', 'latitude', 'longitude'], args.batch_size)
+    medias = Writer(connection, Media.__table__, ['note_id', 'link'], ['kind', 'title'], args.batch_size, notes)
+    for values in sheet_rows(wb, 'Note', 11):
+        id, username, context, kind, content = values[:5]
+        media_kind, media_title, media_url, latitude, longitude, created_at = values[5:]
+        if not id:
+            continue
+        if username not in account_ids or context not in context_ids:
+            print "skipping note %s: unknown account %s or context %s" % (id, username, context)
+            continue
+        note = Note(account_ids[username], context_ids[context], note_kind(kind), content)
+        note.id = id
+        insert_only = ()
+        if not created_at:
+            created_at = 1396325280
+            # spread the new notes without a date around their location
+            det1 = 1.0 + float(randint(1, 100) - 50) / 5000000
+            det2 = 1.0 + float(randint(1, 100) - 50) / 5000000
+            note.latitude = float(latitude) * det1
+            note.longitude = float(longitude) * det2
+            insert_only = ('latitude', 'longitude')
+        else:
+            created_at = int(created_at)
+            note.latitude = float(latitude)
+            note.longitude = float(longitude)
+        date = datetime.datetime.fromtimestamp(created_at)
+        note.created_at = date
+        note.modified_at = date
+        notes.save(column_values(note), insert_only=insert_only)
+
+        if media_kind:
+            media = Media(id, media_kind, media_title, media_url)
+            media.created_at = date
+            medias.save(column_values(media))
+    notes.close()
+    medias.close()
+
+def import_feedbacks(connection, wb, args, account_ids):
+    # there is no parent in the sheet, feedbacks are top level
+    writer = Writer(connection, Feedback.__table__, ['account_id', 'kind', 'content', 'table_name', 'row_id'],
+        [], args.batch_size, lookup=['table_name', 'row_id'])
+    for id, table_name, row_id, kind, content, username in sheet_rows(wb, 'Feedback', 6):
+        if not table_name:
+            continue
+        if username not in account_ids:
+            print "skipping feedback %s: unknown account %s" % (id, username)
+            continue
+        feedback = Feedback(account_ids[username], kind, content, table_name, row_id, 0)
+        writer.save(column_values(feedback))
+    writer.close()
+
+def reset_sequences(connection):
+    # ids were given explicitly, the next generated ones must follow them
+    if connection.dialect.name != 'postgresql':
+        return
+    for model in [Site, Account, Context, Note, Media, Feedback]:
+        name = model.__table__.name
+        connection.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "(SELECT COALESCE(MAX(id), 0) + 1 FROM %s), false)" % (name, name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads a workbook into the database.")
+    parser.add_argument('filename', nargs='?', default='data.xlsx')
+    parser.add_argument('--incremental', action='store_true',
+        help="add and update rows instead of recreating the schema")
+    parser.add_argument('--deployment', action='store_true',
+        help="sites and contexts only, plus the default account")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+        help="rows per insert (default %d)" % BATCH_SIZE)
+    args = parser.parse_args()
+
+    if not args.incremental:
+        db.drop_all()
+        db.create_all()
+        db_migrate.stamp()
+
+    wb = load_workbook(filename=args.filename, read_only=True)
+    with db.engine.begin() as connection:
+        site_ids = import_sites(connection, wb, args)
+        account_ids = import_accounts(connection, wb, args)
+        context_ids = import_contexts(connection, wb, args, site_ids)
+        if not args.deployment:
+            import_notes(connection, wb, args, account_ids, context_ids)
+            import_feedbacks(connection, wb, args, account_ids)
+        reset_sequences(connection)
+        # the listeners that keep these do not see core inserts
+        rebuild_account_sites(connection)
+        rebuild_daily_stats(connection)
+    # nor do the ones that empty these, see cache.py
+    cache.clear()
+    context_registry.clear()
+    print "Done."
 
-if not deployment:
-	# NOTE
-	n = note_sheet.cell('A1').value
-	for i in range(2,2+n):
-		id = note_sheet.cell('A' + str(i)).value	
-		username = note_sheet.cell('B' + str(i)).value	
-		context  = note_sheet.cell('C' + str(i)).value
-		kind     = note_sheet.cell('D' + str(i)).value
-		content  = note_sheet.cell('E' + str(i)).value	
-
-		media_kind  = note_sheet.cell('F' + str(i)).value	
-		media_title = note_sheet.cell('G' + str(i)).value	
-		media_url = note_sheet.cell('H' + str(i)).value	
-		# media_url = "https://dl.dropboxusercontent.com/u/5104407/nntest/" + media_url
-
-
-		latitude  = note_sheet.cell('I' + str(i)).value	
-		longitude  = note_sheet.cell('J' + str(i)).value		
-		created_at = note_sheet.cell('K' + str(i)).value
-
-		if not created_at:
-			created_at = 1396325280
-			det1 = 1.0 + float(randint(1,100) - 50)/5000000
-			det2 = 1.0 + float(randint(1,100) - 50)/5000000				
-		else:
-			created_at = int(created_at)
-			det1 = 1.0
-			det2 = 1.0
-
-		date = datetime.datetime.fromtimestamp(created_at)	
-		if id:
-			a = Account.query.filter_by(username=username).first()
-			c = Context.query.filter_by(name=context).first()
-			note = Note(a.id, c.id, kind, content)
-
-			note.latitude = float(latitude) * det1
-			note.longitude = float(longitude) * det2		
-			note.created_at =  date
-			note.modified_at =  date
-			# created_at += datetime.timedelta(seconds=100)		
-			print "create note: %s" % note
-			db.session.add(note)
-			db.session.commit()
-			
-			if media_kind:
-				media = Media(note.id, media_kind, media_title, media_url) 
-				media.created_at = date
-				# created_at += datetime.timedelta(seconds=60)		
-				print "create media: %s" % media
-				db.session.add(media)
-				db.session.commit()
-
-	n = feedback_sheet.cell('A1').value
-	for i in range(2,2+n):
-		table_name = feedback_sheet.cell('B' + str(i)).value	
-		row_id  = feedback_sheet.cell('C' + str(i)).value
-		kind     = feedback_sheet.cell('D' + str(i)).value
-		content  = feedback_sheet.cell('E' + str(i)).value	
-		username = feedback_sheet.cell('F' + str(i)).value		
-
-		if id:
-			a = Account.query.filter_by(username=username).first()
-			feedback = Feedback(a.id, kind, content, table_name, row_id)
-			db.session.add(feedback)
-			
-			print "create feedback: %s" % feedback		
-	db.session.commit()		
-
-
-#print sheet_ranges.cell('B2').value # D18
+if __name__ == '__main__':
+    main()
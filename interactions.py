@@ -0,0 +1,266 @@
+'''
+Storage of the interaction log.
+
+interaction_log only grows. sweep() sums the raw rows older than
+RETENTION_DAYS into interaction_hour (site, hour, type, count) and
+removes them. Once the table is partitioned by month (PostgreSQL 11 or
+later), whole months are dropped instead of deleted row by row. Neither
+the sweep nor vacuum then grows with the table.
+
+    python interactions.py partition   partition interaction_log by month, once
+    python interactions.py sweep       roll up and remove the expired rows, run daily
+    python interactions.py dates       fill occurred_at for rows stored before it existed
+'''
+import os
+import re
+import sys
+import datetime
+
+from sqlalchemy import select
+from sqlalchemy import func
+from sqlalchemy import and_
+from sqlalchemy import true
+from sqlalchemy import text
+from sqlalchemy import bindparam
+from sqlalchemy.sql import table
+from sqlalchemy.sql import column
+
+from db_def import db
+from db_def import InteractionLog
+from db_def import InteractionHour
+from db_def import InteractionBatch
+
+# days raw interactions are kept before being rolled up
+RETENTION_DAYS = int(os.environ.get('INTERACTION_RETENTION_DAYS', 90))
+# days idempotency keys of batches are kept
+BATCH_KEY_RETENTION_DAYS = 7
+# rows rolled up and deleted per transaction on an unpartitioned table
+SWEEP_BATCH_SIZE = 10000
+# months of partitions created ahead of time
+PARTITIONS_AHEAD = 2
+
+# what the tabletops send as date
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S']
+
+def parse_date(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            continue
+    return None
+
+#
+# Hourly rollup
+#
+
+def hour_of(connection, created_at):
+    if connection.dialect.name == 'postgresql':
+        return func.date_trunc('hour', created_at)
+    return func.strftime('%Y-%m-%d %H:00:00', created_at)
+
+def hourly_counts(connection, log, condition):
+    hour = hour_of(connection, log.c.created_at)
+    return connection.execute(select([log.c.site_id, hour, log.c.type, func.count()]).
+        where(condition).group_by(log.c.site_id, hour, log.c.type)).fetchall()
+
+def add_hours(connection, counts):
+    hours = InteractionHour.__table__
+    for site_id, hour, type, count in counts:
+        if not isinstance(hour, datetime.datetime):
+            hour = datetime.datetime.strptime(str(hour)[:19], '%Y-%m-%d %H:%M:%S')
+        where = and_(hours.c.site_id == site_id, hours.c.hour == hour, hours.c.type == type)
+        result = connection.execute(hours.update().where(where).values(count=hours.c.count + count))
+        if result.rowcount == 0:
+            connection.execute(hours.insert().values(site_id=site_id, hour=hour, type=type, count=count))
+
+#
+# Retention
+#
+
+def sweep(now=None):
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(days=RETENTION_DAYS)
+    with db.engine.begin() as connection:
+        partitioned = is_partitioned(connection)
+    if partitioned:
+        n = sweep_partitions(cutoff)
+        with db.engine.begin() as connection:
+            ensure_partitions(connection, now)
+    else:
+        n = sweep_rows(cutoff)
+
+    batches = InteractionBatch.__table__
+    with db.engine.begin() as connection:
+        connection.execute(batches.delete().where(
+            batches.c.created_at < now - datetime.timedelta(days=BATCH_KEY_RETENTION_DAYS)))
+    return n
+
+def sweep_rows(cutoff):
+    # rolls up and deletes the expired rows SWEEP_BATCH_SIZE at a time,
+    # oldest ids first
+    log = InteractionLog.__table__
+    n = 0
+    while True:
+        with db.engine.begin() as connection:
+            expired = select([log.c.id]).where(log.c.created_at < cutoff).\
+                order_by(log.c.id).limit(SWEEP_BATCH_SIZE).alias()
+            last_id = connection.execute(select([func.max(expired.c.id)])).scalar()
+            if last_id is None:
+                return n
+            batch = and_(log.c.created_at < cutoff, log.c.id <= last_id)
+            add_hours(connection, hourly_counts(connection, log, batch))
+            n += connection.execute(log.delete().where(batch)).rowcount
+
+def sweep_partitions(cutoff):
+    # rolls up and drops the partitions that end before the cutoff
+    n = 0
+    with db.engine.begin() as connection:
+        expired = [name for name, upper in partitions(connection) if upper is not None and upper <= cutoff]
+    for name in expired:
+        with db.engine.begin() as connection:
+            log = table(name, column('site_id'), column('created_at'), column('type'))
+            counts = hourly_counts(connection, log, true())
+            add_hours(connection, counts)
+            connection.execute('ALTER TABLE interaction_log DETACH PARTITION %s' % name)
+            connection.execute('DROP TABLE %s' % name)
+            n += sum(count for site_id, hour, type, count in counts)
+            print "dropped partition %s" % name
+    return n
+
+#
+# Partitions (PostgreSQL)
+#
+
+def is_partitioned(connection):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'interaction_log')")).scalar()
+
+def partitions(connection):
+    # (name, end of its range) of each partition, None for the default one
+    rows = connection.execute(text("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'interaction_log'"))
+    result = []
+    for name, bound in rows:
+        upper = re.search(r"TO \('([^']+)'\)", bound)
+        if upper:
+            upper = datetime.datetime.strptime(upper.group(1)[:19], '%Y-%m-%d %H:%M:%S')
+        result.append((name, upper))
+    return result
+
+def month_start(d, months=0):
+    month = d.month - 1 + months
+    return datetime.datetime(d.year + month // 12, month % 12 + 1, 1)
+
+def ensure_partitions(connection, now):
+    # the months from now on that no partition covers yet. the partitions
+    # follow each other from MINVALUE, so those ending after the last one.
+    ends = [upper for name, upper in partitions(connection) if upper is not None]
+    covered = max(ends) if ends else None
+    for i in range(PARTITIONS_AHEAD + 1):
+        start, end = month_start(now, i), month_start(now, i + 1)
+        if covered is not None and start < covered:
+            continue
+        create_partition(connection, start, end)
+
+def create_partition(connection, start, end):
+    name = 'interaction_log_%s' % start.strftime('%Y_%m')
+    where = "created_at >= '%s' AND created_at < '%s'" % (start, end)
+    in_default = connection.execute("SELECT EXISTS (SELECT 1 FROM interaction_log_default WHERE %s)" % where).scalar()
+    if not in_default:
+        connection.execute("CREATE TABLE %s PARTITION OF interaction_log "
+            "FOR VALUES FROM ('%s') TO ('%s')" % (name, start, end))
+        return
+    # a new partition cannot overlap rows of the default one: they move to it
+    print "moving the rows of %s out of interaction_log_default" % start.strftime('%Y-%m')
+    connection.execute("ALTER TABLE interaction_log DETACH PARTITION interaction_log_default")
+    connection.execute("CREATE TABLE %s PARTITION OF interaction_log "
+        "FOR VALUES FROM ('%s') TO ('%s')" % (name, start, end))
+    connection.execute("WITH moved AS (DELETE FROM interaction_log_default WHERE %s RETURNING *) "
+        "INSERT INTO interaction_log SELECT * FROM moved" % where)
+    connection.execute("ALTER TABLE interaction_log ATTACH PARTITION interaction_log_default DEFAULT")
+
+def partition():
+    # turns interaction_log into a table partitioned by month of created_at.
+    # the existing rows stay where they are, as the partition of everything
+    # up to the end of this month, and go once the sweep passes that month.
+    with db.engine.begin() as connection:
+        if connection.dialect.name != 'postgresql' or connection.dialect.server_version_info < (11,):
+            print "partitioning needs PostgreSQL 11 or later."
+            return
+        now = datetime.datetime.utcnow()
+        if is_partitioned(connection):
+            print "interaction_log is already partitioned."
+        else:
+            print "partitioning interaction_log..."
+            # the current month is still being written to the legacy table
+            first = month_start(now, 1)
+            # range partitions cannot hold a NULL key
+            connection.execute("UPDATE interaction_log SET created_at = COALESCE(occurred_at, '1970-01-01') "
+                "WHERE created_at IS NULL")
+            connection.execute("ALTER TABLE interaction_log ALTER COLUMN created_at SET NOT NULL")
+            connection.execute("ALTER TABLE interaction_log RENAME TO interaction_log_legacy")
+            connection.execute("ALTER INDEX ix_interaction_log_site_id_created_at "
+                "RENAME TO ix_interaction_log_legacy_site_id_created_at")
+            # the id sequence must outlive the legacy partition
+            connection.execute("ALTER SEQUENCE %s OWNED BY NONE" %
+                connection.execute("SELECT pg_get_serial_sequence('interaction_log_legacy', 'id')").scalar())
+            # the primary key of a partitioned table includes the partition key
+            connection.execute("ALTER TABLE interaction_log_legacy DROP CONSTRAINT %s" %
+                connection.execute("SELECT conname FROM pg_constraint WHERE contype = 'p' "
+                    "AND conrelid = 'interaction_log_legacy'::regclass").scalar())
+            connection.execute("CREATE TABLE interaction_log (LIKE interaction_log_legacy INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE (created_at)")
+            connection.execute("ALTER TABLE interaction_log ADD PRIMARY KEY (id, created_at)")
+            connection.execute("ALTER TABLE interaction_log ADD FOREIGN KEY (site_id) REFERENCES site (id)")
+            connection.execute("ALTER TABLE interaction_log ATTACH PARTITION interaction_log_legacy "
+                "FOR VALUES FROM (MINVALUE) TO ('%s')" % first)
+            connection.execute("CREATE INDEX ix_interaction_log_site_id_created_at "
+                "ON interaction_log (site_id, created_at)")
+            # rows for a month without a partition yet land here
+            connection.execute("CREATE TABLE interaction_log_default PARTITION OF interaction_log DEFAULT")
+        ensure_partitions(connection, now)
+
+#
+# occurred_at
+#
+
+def fill_dates(batch_size=SWEEP_BATCH_SIZE):
+    log = InteractionLog.__table__
+    last_id, n = 0, 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(select([log.c.id, log.c.date]).
+                where(log.c.occurred_at == None).where(log.c.id > last_id).
+                order_by(log.c.id).limit(batch_size)).fetchall()
+            if len(rows) == 0:
+                return n
+            last_id = rows[-1][0]
+            values = [{'row_id': id, 'parsed': parse_date(date)} for id, date in rows]
+            values = [v for v in values if v['parsed'] is not None]
+            if values:
+                connection.execute(log.update().where(log.c.id == bindparam('row_id')).
+                    values(occurred_at=bindparam('parsed')), values)
+            n += len(values)
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'partition':
+        partition()
+    elif command == 'sweep':
+        print "Done. (" + str(sweep()) + " interactions rolled up.)"
+    elif command == 'dates':
+        print "Done. (" + str(fill_dates()) + " dates parsed.)"
+    else:
+        print __doc__
+        sys.exit(1)
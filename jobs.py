@@ -0,0 +1,136 @@
+'''
+A durable job queue kept in the job table, for side effects that should not
+hold up a request: Trello calls, Cloudinary uploads, emails and site exports.
+
+Requests enqueue jobs in the same transaction as the change that causes
+them, and worker.py runs them. A failed job is retried with exponential
+backoff until it runs out of attempts.
+'''
+import json
+import time
+import datetime
+import traceback
+
+from sqlalchemy import or_
+from sqlalchemy import and_
+
+from db_def import db
+from db_def import Job
+
+MAX_ATTEMPTS = 6
+# seconds before the first retry, doubled after every failed attempt
+RETRY_DELAY = 30
+# a job still running after this many seconds belongs to a dead worker,
+# unless its handler calls touch()
+LOCK_TIMEOUT = 600
+POLL_INTERVAL = 2
+
+HANDLERS = {}
+
+def handler(kind):
+    def decorator(f):
+        HANDLERS[kind] = f
+        return f
+    return decorator
+
+def enqueue(kind, data=None, **payload):
+    # the job is only added to the session, it is committed together with
+    # the caller's changes
+    job = Job(kind, json.dumps(payload))
+    job.data = data
+    db.session.add(job)
+    return job
+
+def claim_next():
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=LOCK_TIMEOUT)
+    candidates = Job.query.filter(or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.locked_at < stale))).\
+        order_by(Job.run_at, Job.id).limit(10).all()
+    for job in candidates:
+        # only one worker wins the update when several race for a job
+        t = Job.__table__
+        result = db.session.execute(t.update().
+            where(and_(t.c.id == job.id, t.c.status == job.status, t.c.attempts == job.attempts)).
+            values(status='running', locked_at=now, attempts=job.attempts + 1))
+        db.session.commit()
+        if result.rowcount == 1:
+            return Job.query.get(job.id)
+    return None
+
+# the id of the job being run, and when touch() last stored it is alive
+current = None
+touched_at = 0
+
+def touch():
+    # a long handler calls this as often as it likes, so that its job is not
+    # taken for one of a dead worker. on its own connection, outside the
+    # handler's transaction, at most once a minute.
+    global touched_at
+    if current is None or time.time() - touched_at < 60:
+        return
+    touched_at = time.time()
+    t = Job.__table__
+    db.engine.execute(t.update().where(and_(t.c.id == current, t.c.status == 'running')).
+        values(locked_at=datetime.datetime.utcnow()))
+
+def run(job):
+    global current
+    job_id = job.id
+    current = job_id
+    f = HANDLERS.get(job.kind)
+    try:
+        if f is None:
+            raise KeyError("no handler for job kind %s" % job.kind)
+        payload = json.loads(job.payload)
+        if job.data is not None:
+            payload['data'] = job.data
+        result = f(**payload)
+        job = Job.query.get(job_id)
+        job.status = 'done'
+        if result is not None:
+            job.result = json.dumps(result)
+        job.data = None
+        job.last_error = None
+        job.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+        return True
+    except Exception:
+        error = traceback.format_exc()
+        print "job %s failed: %s" % (job_id, error)
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.last_error = error
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = 'failed'
+            job.finished_at = datetime.datetime.utcnow()
+        else:
+            job.status = 'queued'
+            delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        db.session.commit()
+        return False
+    finally:
+        current = None
+
+def run_pending():
+    n = 0
+    job = claim_next()
+    while job is not None:
+        run(job)
+        n = n + 1
+        db.session.remove()
+        job = claim_next()
+    return n
+
+def work():
+    print "job worker started, handlers: %s" % ', '.join(sorted(HANDLERS.keys()))
+    while True:
+        try:
+            if run_pending() == 0:
+                time.sleep(POLL_INTERVAL)
+        except Exception:
+            print traceback.format_exc()
+            db.session.remove()
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,46 @@
+'''
+JSON encoding of the API responses.
+
+The backend is simplejson, whose C speedups are in requirements.txt, or the
+standard library json when it is missing. set_backend() swaps in any module
+with the same dumps(). Responses are not indented: indentation turns the C
+encoder off. Datetimes are sent as milliseconds since the epoch.
+'''
+import datetime
+
+from flask import current_app
+from werkzeug.http import http_date
+
+try:
+    import simplejson as backend
+except ImportError:
+    import json as backend
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def set_backend(module):
+    global backend
+    backend = module
+
+def epoch_millis(d):
+    if d.utcoffset() is not None:
+        d = d.replace(tzinfo=None) - d.utcoffset()
+    delta = d - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+def default(obj):
+    # called by the encoder for what json has no type for
+    if isinstance(obj, datetime.datetime):
+        return epoch_millis(obj)
+    if isinstance(obj, datetime.date):
+        return http_date(obj.timetuple())
+    try:
+        return list(iter(obj))
+    except TypeError:
+        raise TypeError(repr(obj) + " is not JSON serializable")
+
+def dumps(obj):
+    return backend.dumps(obj, default=default, sort_keys=True)
+
+def response(body, status=200):
+    return current_app.response_class(dumps(body), status=status, mimetype='application/json')
@@ -0,0 +1,79 @@
+'''
+Shared setup of the python tests: a throwaway sqlite database, the
+development secret key, and a few sites, accounts and contexts.
+
+    python -m unittest discover -s tests -p 'test_*.py'
+
+The java tests next to this file run against a live server instead.
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('NATURENET_DEBUG', '1')
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import BigInteger
+from sqlalchemy.ext.compiler import compiles
+
+@compiles(BigInteger, 'sqlite')
+def compile_big_integer(type_, compiler, **kw):
+    # sqlite only generates the ids of INTEGER PRIMARY KEY columns
+    return 'INTEGER'
+
+import db_def
+DATABASE = os.path.join(tempfile.mkdtemp(), 'test.db')
+db_def.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE
+db_def.app.config['TESTING'] = True
+
+import api
+import cache
+from db_def import db
+from db_def import Site
+from db_def import Account
+from db_def import Context
+from db_def import context_registry
+
+def reset_database():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    cache.clear()
+    context_registry.clear()
+
+class DatabaseTestCase(unittest.TestCase):
+    '''Starts each test on an empty schema holding the sites aces and umd,
+    the accounts tom, carol and mike (password pw) and a few contexts. Ids
+    are kept rather than rows, a request removes the session.'''
+
+    def setUp(self):
+        reset_database()
+        self.client = api.app.test_client()
+        aces, umd = Site('aces', 'ACES'), Site('umd', 'UMD')
+        db.session.add_all([aces, umd])
+        accounts = []
+        for username in ['tom', 'carol', 'mike']:
+            account = Account(username)
+            account.password = 'pw'
+            account.email = username + '@example.com'
+            accounts.append(account)
+        db.session.add_all(accounts)
+        db.session.flush()
+        self.aces_id, self.umd_id = aces.id, umd.id
+        self.tom_id, self.carol_id, self.mike_id = [a.id for a in accounts]
+        self.observation_id = self.add_context('Activity', 'aces_free_observation', aces.id)
+        self.idea_id = self.add_context('Design', 'aces_design_idea', aces.id)
+        self.umd_observation_id = self.add_context('Activity', 'umd_free_observation', umd.id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def add_context(self, kind, name, site_id):
+        context = Context(kind, name, name, '')
+        context.site_id = site_id
+        db.session.add(context)
+        db.session.flush()
+        return context.id
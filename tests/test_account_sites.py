@@ -0,0 +1,126 @@
+import datetime
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Account
+from db_def import Note
+from db_def import Media
+from db_def import Feedback
+from db_def import AccountSite
+from db_def import rebuild_account_sites
+
+class AccountSiteTest(DatabaseTestCase):
+    '''The memberships the listeners keep, through refresh_account_sites,
+    must be the ones rebuild_account_sites computes from scratch.'''
+
+    def memberships(self):
+        db.session.expire_all()
+        return sorted((m.account_id, m.site_id) for m in AccountSite.query.all())
+
+    def assertRebuildAgrees(self):
+        live = self.memberships()
+        with db.engine.begin() as connection:
+            rebuild_account_sites(connection)
+        self.assertEqual(live, self.memberships())
+        return live
+
+    def test_notes_and_feedbacks(self):
+        note = Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird')
+        db.session.add(note)
+        db.session.flush()
+        media = Media(note.id, 'Photo', 'bird', 'http://example.com/bird.jpg')
+        db.session.add(media)
+        db.session.flush()
+        db.session.add_all([
+            Feedback(self.carol_id, 'comment', 'sharp', 'media', media.id, 0),
+            Feedback(self.mike_id, 'comment', 'fun', 'context', self.umd_observation_id, 0)])
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), sorted([
+            (self.tom_id, self.aces_id), (self.carol_id, self.aces_id), (self.mike_id, self.umd_id)]))
+
+    def test_comments_on_accounts(self):
+        db.session.add(Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird'))
+        comment = Feedback(self.carol_id, 'comment', 'hi', 'account', self.tom_id, 0)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertIn((self.carol_id, self.aces_id), self.assertRebuildAgrees())
+
+        # tom leaves aces, so does the one who commented on him
+        note = Note.query.filter_by(account_id=self.tom_id).first()
+        note.context_id = self.umd_observation_id
+        db.session.commit()
+        self.assertIn((self.carol_id, self.umd_id), self.assertRebuildAgrees())
+
+        db.session.delete(comment)
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), [(self.tom_id, self.umd_id)])
+
+    def test_moves_and_deletes(self):
+        note = Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird')
+        other = Note(self.tom_id, self.umd_observation_id, 'FieldNote', 'a tree')
+        db.session.add_all([note, other])
+        db.session.commit()
+
+        # expired by the commit, to another account then another site
+        note.account_id = self.mike_id
+        db.session.commit()
+        self.assertRebuildAgrees()
+        note.context_id = self.umd_observation_id
+        db.session.commit()
+        self.assertRebuildAgrees()
+
+        db.session.delete(other)
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), [(self.mike_id, self.umd_id)])
+
+    def test_commented_notes_moved_and_deleted(self):
+        note = Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird')
+        db.session.add(note)
+        db.session.flush()
+        media = Media(note.id, 'Photo', 'bird', 'http://example.com/bird.jpg')
+        db.session.add(media)
+        db.session.flush()
+        db.session.add_all([
+            Feedback(self.carol_id, 'comment', 'nice', 'note', note.id, 0),
+            Feedback(self.mike_id, 'comment', 'sharp', 'media', media.id, 0)])
+        db.session.commit()
+
+        # the commenters follow the note to umd
+        note.context_id = self.umd_observation_id
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), sorted([
+            (self.tom_id, self.umd_id), (self.carol_id, self.umd_id), (self.mike_id, self.umd_id)]))
+
+        db.session.delete(media)
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), sorted([
+            (self.tom_id, self.umd_id), (self.carol_id, self.umd_id)]))
+
+        db.session.delete(note)
+        db.session.commit()
+        self.assertEqual(self.assertRebuildAgrees(), [])
+
+    def test_joins_are_synced_without_editing_the_account(self):
+        account = Account.query.get(self.carol_id)
+        account.modified_at = datetime.datetime(2014, 6, 1)
+        db.session.commit()
+        response = self.client.get('/api/sync/umd')
+        cursor = json.loads(response.data)['cursor']
+        db.session.add(Note(self.carol_id, self.umd_observation_id, 'FieldNote', 'a tree'))
+        db.session.commit()
+        data = json.loads(self.client.get('/api/sync/umd?after=' + cursor).data)['data']
+        self.assertEqual([a['id'] for a in data['accounts']], [self.carol_id])
+        self.assertEqual(Account.query.get(self.carol_id).modified_at, datetime.datetime(2014, 6, 1))
+
+        # a rebuild keeps the join time, the account is not sent again
+        cursor = json.loads(self.client.get('/api/sync/umd?after=' + cursor).data)['cursor']
+        with db.engine.begin() as connection:
+            rebuild_account_sites(connection)
+        data = json.loads(self.client.get('/api/sync/umd?after=' + cursor).data)['data']
+        self.assertEqual(data['accounts'], [])
+
+if __name__ == '__main__':
+    unittest.main()
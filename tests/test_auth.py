@@ -0,0 +1,56 @@
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+import auth
+from db_def import db
+from db_def import Site
+from db_def import Account
+
+class AuthTest(DatabaseTestCase):
+
+    def login(self, username, password):
+        response = self.client.post('/api/account/login', data={'username': username, 'password': password})
+        return json.loads(response.data)
+
+    def update(self, credentials, **values):
+        values.update(credentials)
+        return self.client.post('/api/account/update/tom', data=values).status_code
+
+    def test_plain_passwords_are_hashed_on_login(self):
+        self.assertEqual(self.login('tom', 'pw')['status_code'], 200)
+        account = Account.query.get(self.tom_id)
+        self.assertIsNone(account.password)
+        self.assertTrue(account.password_hash)
+        self.assertEqual(self.login('tom', 'pw')['status_code'], 200)
+        self.assertEqual(self.login('tom', 'wrong')['status_code'], 400)
+
+    def test_the_rehash_does_not_commit_the_request(self):
+        db.session.add(Site('pending', 'not committed'))
+        account = Account.query.get(self.tom_id)
+        with auth.app.test_request_context():
+            self.assertIsNotNone(auth.authenticate({'username': 'tom', 'password': 'pw'}))
+        db.session.rollback()
+        self.assertIsNone(Site.query.filter_by(name='pending').first())
+        self.assertTrue(Account.query.get(self.tom_id).password_hash)
+
+    def test_tokens(self):
+        token = self.login('tom', 'pw')['data']['token']
+        self.assertEqual(self.update({'token': token}, email='tom@example.org'), 200)
+        self.assertEqual(self.update({'token': token + 'x'}, email='tom@example.org'), 403)
+        self.assertEqual(self.update({'token': self.login('carol', 'pw')['data']['token']}), 403)
+
+    def test_a_new_password_revokes_tokens_and_cached_credentials(self):
+        token = self.login('tom', 'pw')['data']['token']
+        # verified once, then served from the cache
+        self.assertEqual(self.login('tom', 'pw')['status_code'], 200)
+        # the new password goes in the password field, sign the change with the token
+        self.assertEqual(self.update({'token': token}, password='new'), 200)
+        self.assertEqual(self.update({'username': 'tom', 'password': 'pw'}), 403)
+        self.assertEqual(self.update({'token': token}), 403)
+        self.assertEqual(self.update({'username': 'tom', 'password': 'new'}), 200)
+        self.assertEqual(self.update({'token': self.login('tom', 'new')['data']['token']}), 200)
+
+if __name__ == '__main__':
+    unittest.main()
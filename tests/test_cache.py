@@ -0,0 +1,74 @@
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+import cache
+from db_def import db
+from db_def import Context
+
+class ResponseCacheTest(DatabaseTestCase):
+
+    def titles(self, url='/api/contexts'):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sorted(c['title'] for c in json.loads(response.data)['data'])
+
+    def rename(self, title):
+        Context.query.get(self.observation_id).title = title
+
+    def test_served_from_the_cache(self):
+        self.titles()
+        # bypassing the session, as another process would
+        db.engine.execute(Context.__table__.update().values(title='renamed'))
+        self.assertNotIn('renamed', self.titles())
+        cache.clear()
+        self.assertIn('renamed', self.titles())
+
+    def test_cleared_on_commit(self):
+        self.titles()
+        self.rename('renamed')
+        db.session.commit()
+        self.assertIn('renamed', self.titles())
+        pond_id = self.add_context('Landmark', 'aces_pond', self.aces_id)
+        db.session.commit()
+        self.assertIn('aces_pond', self.titles())
+        db.session.delete(Context.query.get(pond_id))
+        db.session.commit()
+        self.assertNotIn('aces_pond', self.titles())
+
+    def test_kept_on_rollback(self):
+        self.titles()
+        self.rename('renamed')
+        db.session.flush()
+        db.session.rollback()
+        db.engine.execute(Context.__table__.update().values(title='elsewhere'))
+        self.assertNotIn('elsewhere', self.titles())
+        # and the rollback did not leave a clear pending for the next commit
+        db.session.add(Context.query.get(self.idea_id))
+        db.session.commit()
+        self.assertNotIn('elsewhere', self.titles())
+
+    def test_keyed_by_query_string(self):
+        self.titles('/api/contexts?a=1')
+        db.engine.execute(Context.__table__.update().values(title='renamed'))
+        self.assertNotIn('renamed', self.titles('/api/contexts?a=1'))
+        self.assertIn('renamed', self.titles('/api/contexts?a=2'))
+
+class LocalBackendTest(unittest.TestCase):
+
+    def test_least_recently_used_first(self):
+        backend = cache.LocalBackend(size=2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual([backend.get(k) for k in 'abc'], [1, None, 3])
+
+    def test_expired(self):
+        backend = cache.LocalBackend()
+        backend.set('a', 1, -1)
+        self.assertIsNone(backend.get('a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import datetime
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Note
+
+class KeysetCursorTest(DatabaseTestCase):
+
+    def add_notes(self, dates):
+        notes = [Note(self.tom_id, self.observation_id, 'FieldNote', 'note %d' % i) for i in range(len(dates))]
+        db.session.add_all(notes)
+        db.session.flush()
+        # the listeners bump modified_at, set it afterwards
+        for note, date in zip(notes, dates):
+            db.session.execute(Note.__table__.update().where(Note.__table__.c.id == note.id).
+                values(modified_at=date))
+        db.session.commit()
+        return [note.id for note in notes]
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response.status_code, json.loads(response.data)
+
+    def pages(self, url, n):
+        # the ids of each page, following the cursors to the end
+        pages, cursor = [], None
+        while True:
+            status, body = self.get(url + '?n=%d' % n + ('&after=' + cursor if cursor else ''))
+            self.assertEqual(status, 200)
+            if len(body['data']) == 0:
+                return pages, cursor
+            pages.append([x['id'] for x in body['data']])
+            cursor = body['cursor']
+
+    def test_pages_cover_every_row_once_in_order(self):
+        base = datetime.datetime(2014, 6, 1, 12, 0, 0)
+        # rows sharing a millisecond, and rows sharing a date
+        dates = [base + datetime.timedelta(microseconds=i * 100) for i in range(5)] + [base] * 3 + \
+            [base + datetime.timedelta(days=1)]
+        ids = self.add_notes(dates)
+        expected = [id for date, id in sorted(zip(dates, ids))]
+        pages, cursor = self.pages('/api/notes/at/aces', 2)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertIsNotNone(cursor)
+
+    def test_a_cursor_past_the_end_is_kept(self):
+        self.add_notes([datetime.datetime(2014, 6, 1)])
+        status, body = self.get('/api/notes/at/aces')
+        cursor = body['cursor']
+        status, body = self.get('/api/notes/at/aces?after=' + cursor)
+        self.assertEqual(status, 200)
+        self.assertEqual(body['data'], [])
+        self.assertEqual(body['cursor'], cursor)
+
+    def test_later_rows_come_after_the_cursor(self):
+        self.add_notes([datetime.datetime(2014, 6, 1)])
+        status, body = self.get('/api/notes/at/aces')
+        later = self.add_notes([datetime.datetime(2014, 6, 2)])
+        status, body = self.get('/api/notes/at/aces?after=' + body['cursor'])
+        self.assertEqual([x['id'] for x in body['data']], later)
+
+    def test_invalid_cursors_are_rejected(self):
+        for url in ['/api/notes/at/aces', '/api/designideas/at/aces',
+                '/api/site/aces/feedbacks', '/api/site/aces/accounts']:
+            for cursor in ['garbage', 'WyJub3QgYSBkYXRlIiwgMV0=']:
+                status, body = self.get(url + '?after=' + cursor)
+                self.assertEqual(status, 400, url)
+                self.assertEqual(body['status_txt'], 'invalid cursor')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Account
+from db_def import Note
+from db_def import Media
+from db_def import Feedback
+from db_def import DailyStat
+from db_def import rebuild_daily_stats
+
+class DailyStatTest(DatabaseTestCase):
+    '''The counts the listeners keep, through change_stat, must be the ones
+    rebuild_daily_stats computes from scratch.'''
+
+    def counts(self):
+        db.session.expire_all()
+        return sorted((s.day, s.site_id, s.metric, s.count) for s in DailyStat.query.all() if s.count != 0)
+
+    def assertRebuildAgrees(self):
+        live = self.counts()
+        with db.engine.begin() as connection:
+            rebuild_daily_stats(connection)
+        self.assertEqual(live, self.counts())
+
+    def test_inserts(self):
+        observation = Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird')
+        idea = Note(self.carol_id, self.idea_id, 'DesignIdea', 'a bench')
+        elsewhere = Note(self.mike_id, self.umd_observation_id, 'FieldNote', 'a tree')
+        db.session.add_all([observation, idea, elsewhere])
+        db.session.flush()
+        media = Media(observation.id, 'Photo', 'bird', 'http://example.com/bird.jpg')
+        db.session.add(media)
+        db.session.flush()
+        db.session.add_all([
+            Feedback(self.carol_id, 'comment', 'nice', 'note', observation.id, 0),
+            Feedback(self.mike_id, 'Like', 'true', 'Note', idea.id, 0),
+            Feedback(self.tom_id, 'comment', 'sharp', 'media', media.id, 0),
+            Feedback(self.tom_id, 'comment', 'fun', 'context', self.umd_observation_id, 0),
+            Feedback(self.tom_id, 'comment', 'hi', 'account', self.carol_id, 0)])
+        db.session.commit()
+        self.assertIn((observation.modified_at.date(), self.aces_id, 'observations', 1), self.counts())
+        self.assertRebuildAgrees()
+
+    def test_moves_and_deletes(self):
+        note = Note(self.tom_id, self.observation_id, 'FieldNote', 'a bird')
+        other = Note(self.carol_id, self.observation_id, 'FieldNote', 'a bee')
+        db.session.add_all([note, other])
+        db.session.flush()
+        comment = Feedback(self.carol_id, 'comment', 'nice', 'note', note.id, 0)
+        like = Feedback(self.mike_id, 'like', 'true', 'note', other.id, 0)
+        db.session.add_all([comment, like])
+        db.session.commit()
+
+        # to another site, its feedbacks follow
+        note.context_id = self.umd_observation_id
+        db.session.commit()
+        self.assertRebuildAgrees()
+
+        # to another kind
+        note.kind = 'DesignIdea'
+        like.kind = 'comment'
+        db.session.commit()
+        self.assertRebuildAgrees()
+
+        # a note with its feedback, then one without
+        db.session.delete(like)
+        db.session.delete(other)
+        db.session.commit()
+        self.assertRebuildAgrees()
+        db.session.delete(note)
+        db.session.commit()
+        self.assertRebuildAgrees()
+
+    def test_accounts(self):
+        db.session.add(Account('dan'))
+        db.session.commit()
+        self.assertRebuildAgrees()
+        # joining a site is not an edit of the account
+        before = self.counts()
+        db.session.add(Note(self.tom_id, self.umd_observation_id, 'FieldNote', 'a tree'))
+        db.session.commit()
+        self.assertEqual([c for c in self.counts() if c[2] == 'users'], [c for c in before if c[2] == 'users'])
+        self.assertRebuildAgrees()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import datetime
+import unittest
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Site
+from db_def import Account
+from db_def import Context
+from db_def import Note
+from db_def import Feedback
+
+class ETagTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        notes = [Note(self.tom_id, self.observation_id, 'FieldNote', 'note %d' % i) for i in range(3)]
+        db.session.add_all(notes)
+        db.session.commit()
+        self.note_id = notes[0].id
+
+    def etag(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.headers['ETag'].strip('"')
+
+    def status(self, url, etag):
+        return self.client.get(url, headers={'If-None-Match': '"%s"' % etag}).status_code
+
+    def change(self, url, f):
+        # the status of url with the etag it had before f()
+        etag = self.etag(url)
+        self.assertEqual(self.status(url, etag), 304)
+        f()
+        db.session.commit()
+        return self.status(url, etag)
+
+    def edit_note(self, content):
+        # as /api/note/update does
+        note = Note.query.get(self.note_id)
+        note.content = content
+        note.modified_at = datetime.datetime.utcnow()
+
+    def test_not_modified_until_a_change(self):
+        for url in ['/api/notes', '/api/notes/at/aces']:
+            self.assertEqual(self.change(url, lambda: None), 304)
+            self.assertEqual(self.change(url, lambda: self.edit_note(url)), 200)
+
+    def test_embedded_rows(self):
+        for url in ['/api/notes', '/api/notes/at/aces']:
+            changes = [
+                lambda: db.session.add(Feedback(self.carol_id, 'comment', url, 'note', self.note_id, 0)),
+                # as /api/account/update does
+                lambda: setattr(Account.query.get(self.tom_id), 'modified_at', datetime.datetime.now()),
+                lambda: setattr(Context.query.get(self.observation_id), 'title', url),
+                lambda: setattr(Site.query.get(self.aces_id), 'description', url)]
+            for f in changes:
+                self.assertEqual(self.change(url, f), 200)
+
+    def test_short_notes_ignore_the_embedded_rows(self):
+        url = '/api/notes/at/aces?format=short'
+        self.assertEqual(self.change(url, lambda: setattr(Context.query.get(self.observation_id), 'title', 'x')), 304)
+
+    def test_query_arguments(self):
+        self.assertNotEqual(self.etag('/api/notes?n=1'), self.etag('/api/notes?n=2'))
+        # a change past the page keeps it
+        url = '/api/notes?n=1'
+        self.assertEqual(self.change(url, lambda: db.session.add(
+            Note(self.tom_id, self.observation_id, 'FieldNote', 'later'))), 304)
+
+if __name__ == '__main__':
+    unittest.main()
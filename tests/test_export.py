@@ -0,0 +1,85 @@
+import os
+import csv
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Site
+from db_def import Note
+from db_def import Media
+from db_def import Feedback
+import export
+
+class ExportTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        notes = [Note(self.tom_id, self.observation_id, 'FieldNote', u'a bird \xe9'),
+            Note(self.carol_id, self.idea_id, 'DesignIdea', 'a bench'),
+            Note(self.mike_id, self.umd_observation_id, 'FieldNote', 'elsewhere')]
+        db.session.add_all(notes)
+        db.session.flush()
+        db.session.add(Media(notes[0].id, 'Photo', 'bird', 'http://example.com/bird.jpg'))
+        db.session.add_all([Feedback(self.carol_id, 'comment', 'nice', 'note', notes[0].id, 0),
+            Feedback(self.mike_id, 'comment', 'far', 'note', notes[2].id, 0)])
+        db.session.commit()
+        self.note_ids = [notes[0].id, notes[1].id]
+
+    def tearDown(self):
+        DatabaseTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def export(self, format, compress=False, tables=None):
+        files = export.export_site(Site.query.get(self.aces_id), self.directory, format, compress, tables)
+        return dict((f['table'], f) for f in files)
+
+    def read(self, f, compress=False):
+        return (gzip.open if compress else open)(f['path'], 'rb').read()
+
+    def test_ndjson(self):
+        files = self.export('ndjson')
+        self.assertEqual(sorted(files), ['feedbacks', 'medias', 'notes'])
+        self.assertEqual([f['rows'] for t, f in sorted(files.items())], [1, 1, 2])
+        notes = [json.loads(line) for line in self.read(files['notes']).splitlines()]
+        self.assertEqual([n['id'] for n in notes], self.note_ids)
+        self.assertEqual(notes[0]['username'], 'tom')
+        self.assertEqual(notes[0]['context'], 'aces_free_observation')
+        self.assertEqual(notes[0]['content'], u'a bird \xe9')
+        self.assertTrue(files['notes']['path'].endswith('aces-notes.ndjson'))
+
+    def test_csv_gzip(self):
+        files = self.export('csv', compress=True)
+        self.assertTrue(files['notes']['path'].endswith('aces-notes.csv.gz'))
+        rows = list(csv.reader(self.read(files['notes'], True).splitlines()))
+        self.assertEqual(rows[0][:3], ['id', 'kind', 'content'])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][2].decode('utf-8'), u'a bird \xe9')
+
+    def test_columns(self):
+        files = self.export('columns', tables=['notes'])
+        self.assertEqual(sorted(files), ['notes'])
+        groups = [json.loads(line) for line in self.read(files['notes']).splitlines()]
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0]['rows'], 2)
+        values = dict(zip(groups[0]['columns'], groups[0]['values']))
+        self.assertEqual(values['id'], self.note_ids)
+        self.assertEqual(values['kind'], ['FieldNote', 'DesignIdea'])
+
+    def test_columns_groups(self):
+        size = export.GROUP_SIZE
+        export.GROUP_SIZE = 1
+        try:
+            files = self.export('columns', tables=['notes'])
+        finally:
+            export.GROUP_SIZE = size
+        groups = [json.loads(line) for line in self.read(files['notes']).splitlines()]
+        self.assertEqual([g['values'][0] for g in groups], [[id] for id in self.note_ids])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import imp
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from openpyxl import Workbook
+
+from support import ROOT
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Context
+from db_def import Note
+from db_def import Feedback
+
+# import is a keyword, the module cannot be imported by its name
+importer = imp.load_source('importer', os.path.join(ROOT, 'import.py'))
+
+def sheets():
+    return {
+        'Site': [[1, 'aces', 'ACES', None]],
+        'Account': [[1, 'default', 'Default', 'default@example.com', 'pw', 'yes', None],
+            [2, 'tom', 'Tom', 'tom@example.com', 'pw', 'yes', None]],
+        'Context': [[1, 'Activity', 'aces_free_observation', 'Free Observation', '', 'aces', None, None],
+            [2, 'Landmark', 'aces_rock', 'Rock', '', 'aces', 38.9, -77.0]],
+        'Note': [[1, 'tom', 'aces_free_observation', 'FieldNote', 'a bird', 'Photo', 'bird',
+            'http://example.com/bird.jpg', 38.9, -77.0, 1400000000]],
+        'Feedback': [[1, 'Note', 1, 'comment', 'nice ' * 200, 'tom'], [2, 'Note', 1, 'like', 'true', 'tom']]}
+
+class ImportTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.xlsx')
+
+    def tearDown(self):
+        DatabaseTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def write(self, sheets):
+        wb = Workbook()
+        wb.remove_sheet(wb.active)
+        for name, rows in sheets.items():
+            ws = wb.create_sheet(title=name)
+            ws.append([len(rows)])
+            for row in rows:
+                ws.append(row)
+        wb.save(self.path)
+
+    def run_import(self, *args):
+        # the summary line of each table, table -> (inserted, updated)
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv, sys.stdout = ['import.py', self.path] + list(args), StringIO()
+        try:
+            importer.main()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+        db.session.remove()
+        counts = {}
+        for line in output.splitlines():
+            if ' inserted, ' in line:
+                table, rest = line.split(': ')
+                inserted, updated = rest.replace(' inserted,', '').replace(' updated', '').split()
+                counts[table] = (int(inserted), int(updated))
+        return counts, output
+
+    def test_a_second_incremental_import_changes_nothing(self):
+        self.write(sheets())
+        counts, output = self.run_import()
+        self.assertEqual(counts['note'], (1, 0))
+        self.assertEqual(counts['feedback'], (2, 0))
+        counts, output = self.run_import('--incremental')
+        self.assertEqual(set(counts.values()), set([(0, 0)]))
+
+    def test_incremental_adds_and_updates(self):
+        self.write(sheets())
+        self.run_import()
+        changed = sheets()
+        changed['Note'][0][4] = 'a heron'
+        changed['Note'].append([2, 'tom', 'aces_rock', 'FieldNote', 'a rock', None, None, None,
+            38.9, -77.0, 1400000100])
+        changed['Feedback'][0][4] = 'very nice'
+        self.write(changed)
+        counts, output = self.run_import('--incremental')
+        self.assertEqual(counts['note'], (1, 1))
+        # feedbacks are matched by all their columns, a new content is a new one
+        self.assertEqual(counts['feedback'], (1, 0))
+        self.assertEqual(Note.query.get(1).content, 'a heron')
+        self.assertEqual(Feedback.query.count(), 3)
+
+    def test_batches_smaller_than_the_sheets(self):
+        changed = sheets()
+        # the same feedback twice is stored once
+        changed['Feedback'].append([3, 'Note', 1, 'like', 'true', 'tom'])
+        self.write(changed)
+        counts, output = self.run_import('--batch-size', '1')
+        self.assertEqual(counts['feedback'], (2, 0))
+        counts, output = self.run_import('--incremental', '--batch-size', '2')
+        self.assertEqual(set(counts.values()), set([(0, 0)]))
+
+    def test_notes_without_a_date_keep_their_location(self):
+        changed = sheets()
+        changed['Note'][0][10] = None
+        self.write(changed)
+        self.run_import()
+        note = Note.query.get(1)
+        location = (note.latitude, note.longitude)
+        counts, output = self.run_import('--incremental')
+        self.assertEqual(counts['note'], (0, 0))
+        note = Note.query.get(1)
+        self.assertEqual((note.latitude, note.longitude), location)
+
+    def test_contexts_of_unknown_sites_are_skipped(self):
+        changed = sheets()
+        changed['Context'].append([3, 'Activity', 'mars_free_observation', 'Mars', '', 'mars', None, None])
+        self.write(changed)
+        counts, output = self.run_import()
+        self.assertIn('skipping context mars_free_observation: unknown site mars', output)
+        self.assertIsNone(Context.query.filter_by(name='mars_free_observation').first())
+
+if __name__ == '__main__':
+    unittest.main()
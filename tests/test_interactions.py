@@ -0,0 +1,52 @@
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import InteractionLog
+
+EVENTS = [{'type': 1, 'date': '2014-06-01 12:00:00', 'touch_x': 10, 'touch_y': 20},
+    {'type': 2, 'date': '2014-06-01 12:00:01', 'details': 'zoom'}]
+
+class InteractionBatchTest(DatabaseTestCase):
+
+    def post(self, site, body, key=None):
+        headers = {'Idempotency-Key': key} if key else {}
+        response = self.client.post('/api/interactions/batch/at/%s' % site, data=body, headers=headers)
+        return response.status_code, json.loads(response.data)
+
+    def logged(self, site_id):
+        db.session.expire_all()
+        return InteractionLog.query.filter_by(site_id=site_id).count()
+
+    def test_a_batch_is_stored_once_per_key(self):
+        status, body = self.post('aces', json.dumps(EVENTS), 'k1')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['data'], {'count': 2, 'duplicate': False})
+        status, body = self.post('aces', json.dumps(EVENTS), 'k1')
+        self.assertEqual(body['data'], {'count': 2, 'duplicate': True})
+        self.assertEqual(self.logged(self.aces_id), 2)
+
+    def test_keys_belong_to_a_site(self):
+        self.post('aces', json.dumps(EVENTS), 'k1')
+        status, body = self.post('umd', json.dumps(EVENTS), 'k1')
+        self.assertEqual(body['data'], {'count': 2, 'duplicate': False})
+        self.assertEqual(self.logged(self.umd_id), 2)
+
+    def test_without_a_key_every_batch_is_stored(self):
+        lines = '\n'.join(json.dumps(e) for e in EVENTS)
+        self.post('aces', lines)
+        self.post('aces', lines)
+        self.assertEqual(self.logged(self.aces_id), 4)
+
+    def test_a_rejected_batch_does_not_use_its_key(self):
+        status, body = self.post('aces', json.dumps([{'type': 1}]), 'k2')
+        self.assertEqual(status, 400)
+        status, body = self.post('aces', json.dumps([dict(EVENTS[1], details='x' * 1000)]), 'k2')
+        self.assertEqual(status, 400)
+        status, body = self.post('aces', json.dumps(EVENTS), 'k2')
+        self.assertEqual(body['data'], {'count': 2, 'duplicate': False})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import datetime
+import unittest
+
+import simplejson as json
+
+from support import DatabaseTestCase
+import jobs
+from db_def import db
+from db_def import Job
+
+calls = []
+
+@jobs.handler('test_record')
+def record(**payload):
+    calls.append(payload)
+    return {'n': len(calls)}
+
+@jobs.handler('test_fail')
+def fail(**payload):
+    calls.append(payload)
+    raise ValueError('failed')
+
+class JobTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        del calls[:]
+
+    def enqueue(self, kind, data=None, **payload):
+        job = jobs.enqueue(kind, data, **payload)
+        db.session.commit()
+        return job.id
+
+    def job(self, job_id):
+        db.session.remove()
+        return Job.query.get(job_id)
+
+    def make_due(self, job_id):
+        Job.query.get(job_id).run_at = datetime.datetime.utcnow()
+        db.session.commit()
+
+    def test_run(self):
+        job_id = self.enqueue('test_record', 'bytes', note_id=1)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [{'note_id': 1, 'data': 'bytes'}])
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.attempts), ('done', 1))
+        self.assertEqual(json.loads(job.result), {'n': 1})
+        # done, and the data no longer kept
+        self.assertIsNone(job.data)
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_not_before_commit(self):
+        jobs.enqueue('test_record')
+        db.session.rollback()
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_retried_with_backoff_then_failed(self):
+        job_id = self.enqueue('test_fail')
+        self.assertEqual(jobs.run_pending(), 1)
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('ValueError', job.last_error)
+        delay = job.run_at - datetime.datetime.utcnow()
+        self.assertTrue(datetime.timedelta(0) < delay <= datetime.timedelta(seconds=jobs.RETRY_DELAY))
+        # not due yet
+        self.assertEqual(jobs.run_pending(), 0)
+        for i in range(jobs.MAX_ATTEMPTS - 1):
+            self.make_due(job_id)
+            self.assertEqual(jobs.run_pending(), 1)
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.attempts), ('failed', jobs.MAX_ATTEMPTS))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(len(calls), jobs.MAX_ATTEMPTS)
+
+    def test_unknown_kind(self):
+        job_id = self.enqueue('test_unknown')
+        jobs.run_pending()
+        self.assertIn('no handler', self.job(job_id).last_error)
+
+    def test_claimed_once(self):
+        job_id = self.enqueue('test_record')
+        self.assertEqual(jobs.claim_next().id, job_id)
+        self.assertIsNone(jobs.claim_next())
+
+    def test_stale_lock_reclaimed(self):
+        job_id = self.enqueue('test_record')
+        jobs.claim_next()
+        # a worker died running it
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=jobs.LOCK_TIMEOUT + 1)
+        db.engine.execute(Job.__table__.update().values(locked_at=stale))
+        job = jobs.claim_next()
+        self.assertEqual((job.id, job.attempts), (job_id, 2))
+
+if __name__ == '__main__':
+    unittest.main()
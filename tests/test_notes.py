@@ -0,0 +1,77 @@
+import unittest
+
+from sqlalchemy import event
+
+from support import DatabaseTestCase
+from db_def import db
+from db_def import Note
+from db_def import Media
+from db_def import Feedback
+from db_def import notes_to_hash
+
+class QueryCounter(object):
+    # counts the statements sent to the database while in a with block
+    def __enter__(self):
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self.executed)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(db.engine, 'before_cursor_execute', self.executed)
+
+    def executed(self, *args):
+        self.count += 1
+
+class NotesToHashTest(DatabaseTestCase):
+
+    def add_notes(self, n):
+        accounts = [self.tom_id, self.carol_id, self.mike_id]
+        contexts = [self.observation_id, self.idea_id, self.umd_observation_id]
+        for i in range(n):
+            note = Note(accounts[i % 3], contexts[i % 3], 'FieldNote', 'note %d' % i)
+            db.session.add(note)
+            db.session.flush()
+            db.session.add(Media(note.id, 'Photo', 'photo %d' % i, 'link%d' % i))
+            db.session.add(Feedback(accounts[(i + 1) % 3], 'comment', 'comment %d' % i, 'note', note.id, 0))
+        db.session.commit()
+
+    def notes(self):
+        db.session.remove()
+        return Note.query.order_by(Note.id).all()
+
+    def test_same_hashes_as_one_note_at_a_time(self):
+        self.add_notes(6)
+        one_at_a_time = [n.to_hash('full') for n in self.notes()]
+        self.assertEqual(notes_to_hash(self.notes()), one_at_a_time)
+        self.assertEqual(len(one_at_a_time[0]['medias']), 1)
+        self.assertEqual(len(one_at_a_time[0]['feedbacks']), 1)
+
+    def test_queries_do_not_grow_with_the_notes(self):
+        counts, added = [], 0
+        for n in [5, 50]:
+            self.add_notes(n - added)
+            added = n
+            notes = self.notes()
+            with QueryCounter() as counter:
+                notes_to_hash(notes)
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_the_listing_queries_do_not_grow_with_the_notes(self):
+        counts, added = [], 0
+        for n in [5, 50]:
+            self.add_notes(n - added)
+            added = n
+            db.session.remove()
+            with QueryCounter() as counter:
+                response = self.client.get('/api/notes/all')
+                # streamed, the queries run as the body is read
+                body = response.data
+                response.close()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body.count('"_model_": "Note"'), n)
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
+if __name__ == '__main__':
+    unittest.main()
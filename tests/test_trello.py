@@ -0,0 +1,55 @@
+import unittest
+
+# the repository on sys.path
+import support
+import trello
+
+class Response(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class Session(object):
+    # answers every request with the next of responses, the last one repeated
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = 0
+
+    def request(self, *args, **kwargs):
+        self.requests += 1
+        return self.responses[min(self.requests, len(self.responses)) - 1]
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.sleep = trello.time.sleep
+        trello.time.sleep = self.sleeps.append
+        self.client = trello.TrelloClient('key', max_retries=3, backoff=1, max_backoff=5)
+
+    def tearDown(self):
+        trello.time.sleep = self.sleep
+
+    def request(self, responses, method='GET'):
+        self.client.session = Session(responses)
+        response = self.client._request(method, 'https://api.trello.com/1/x')
+        return response.status_code, self.client.session.requests
+
+    def test_retry_after_is_capped(self):
+        self.assertEqual(self.request([Response(429, {'Retry-After': '3600'}), Response(200)]), (200, 2))
+        self.assertEqual(self.sleeps, [5])
+
+    def test_backoff_is_capped(self):
+        self.client.max_retries = 5
+        self.assertEqual(self.request([Response(503)]), (503, 6))
+        self.assertEqual(self.sleeps, [1, 2, 4, 5, 5])
+
+    def test_gives_up_after_max_retries(self):
+        self.assertEqual(self.request([Response(429, {'Retry-After': '2'})], 'POST'), (429, 4))
+        self.assertEqual(self.sleeps, [2, 2, 2])
+        # server errors are not retried for POST
+        self.assertEqual(self.request([Response(503)], 'POST'), (503, 1))
+
+if __name__ == '__main__':
+    unittest.main()
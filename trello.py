@@ -1,6 +1,8 @@
 from datetime import datetime
 import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 
 
@@ -12,6 +14,10 @@ class ResourceUnavailable(Exception):
         self._msg = msg
         self._status = http_response.status_code
 
+    @property
+    def status(self):
+        return self._status
+
     def __str__(self):
         return "%s (HTTP status: %s)" % (
         self._msg, self._status)
@@ -28,7 +34,16 @@ class TokenError(Exception):
 class TrelloClient(object):
     """ Base class for Trello API access """
 
-    def __init__(self, api_key, api_secret=None, token=None, token_secret=None):
+    # rate limited requests are always retried, server errors only when
+    # repeating the request is harmless
+    RETRY_ALWAYS = (429,)
+    RETRY_IDEMPOTENT = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+    # most urls trello accepts in a single /batch request
+    BATCH_SIZE = 10
+
+    def __init__(self, api_key, api_secret=None, token=None, token_secret=None,
+                 pool_size=10, max_retries=3, timeout=30, backoff=0.5, max_backoff=30):
         """
         Constructor
 
@@ -37,6 +52,13 @@ class TrelloClient(object):
         :token_key: OAuth token generated by the user in
                     trello.util.create_oauth_token
         :token_secret: the OAuth client secret for the given OAuth token
+        :pool_size: number of keep-alive connections kept to api.trello.com
+        :max_retries: retries for rate limited and failed requests
+        :timeout: seconds to wait for Trello on every request
+        :backoff: seconds before the first retry when Trello gives no hint,
+                  doubled after every attempt
+        :max_backoff: most seconds to wait before a retry, whatever the
+                      hint
         """
 
         # client key and secret for oauth1 session
@@ -52,6 +74,15 @@ class TrelloClient(object):
         self.resource_owner_key = token
         self.resource_owner_secret = token_secret
 
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     def info_for_all_boards(self, actions):
         """
         Use this if you want to retrieve info for all your boards in one swoop
@@ -98,6 +129,23 @@ class TrelloClient(object):
     def get_member(self, member_id):
         return Member(self, member_id).fetch()
 
+    def get_card(self, card_id):
+        """
+        Fetches a single card by its id, with all of its fields set as
+        attributes like in Board.get_cards
+        """
+        return self._card_from_json(self.fetch_json('/cards/' + card_id))
+
+    def _card_from_json(self, json_obj):
+        board = Board(self, json_obj['idBoard'])
+        card = Card(List(board, json_obj['idList']), json_obj['id'],
+                    name=json_obj['name'])
+        for card_key, card_val in json_obj.items():
+            if card_key in ['id', 'name']:
+                continue
+            setattr(card, card_key, card_val)
+        return card
+
     def fetch_json(
             self,
             uri_path,
@@ -126,8 +174,8 @@ class TrelloClient(object):
         url = 'https://api.trello.com/1/%s' % uri_path
 
         # perform the HTTP requests, if possible uses OAuth authentication
-        response = requests.request(http_method, url, params=query_params, verify=True,
-                                    headers=headers, data=json.dumps(post_args), auth=self.oauth)
+        response = self._request(http_method, url, params=query_params, verify=True,
+                                 headers=headers, data=json.dumps(post_args), auth=self.oauth)
 
         if response.status_code == 401:
             print "Unauthorized"
@@ -138,6 +186,71 @@ class TrelloClient(object):
 
         return response.json()
 
+    def fetch_json_batch(self, uri_paths):
+        """
+        GETs several resources through Trello's /batch endpoint, BATCH_SIZE
+        urls per request. Returns the results in the order of uri_paths,
+        None for the ones that failed.
+
+        :uri_paths: paths like in fetch_json, query strings may be included
+                    but must not contain commas
+        """
+        results = []
+        for i in range(0, len(uri_paths), self.BATCH_SIZE):
+            chunk = ['/' + p.lstrip('/') for p in uri_paths[i:i + self.BATCH_SIZE]]
+            json_obj = self.fetch_json('/batch', query_params={'urls': ','.join(chunk)})
+            for item in json_obj:
+                # each result is keyed by its status code: {"200": {...}}
+                if isinstance(item, dict) and '200' in item:
+                    results.append(item['200'])
+                else:
+                    results.append(None)
+        return results
+
+    def _request(self, http_method, url, **kwargs):
+        """ Sends a request on the pooled session, retrying when allowed """
+        retryable = self.RETRY_ALWAYS
+        if http_method in self.IDEMPOTENT_METHODS:
+            retryable = self.RETRY_ALWAYS + self.RETRY_IDEMPOTENT
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(http_method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if http_method not in self.IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    raise
+                response = None
+            if response is not None and (response.status_code not in retryable or attempt >= self.max_retries):
+                return response
+            delay = self._retry_delay(response, attempt)
+            print "trello request failed, retrying in %.1fs" % delay
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    def _retry_delay(self, response, attempt):
+        """ Seconds to wait before retrying, at most max_backoff """
+        return max(0, min(self._hinted_delay(response, attempt), self.max_backoff))
+
+    def _hinted_delay(self, response, attempt):
+        """ Seconds to wait before retrying, as hinted by Trello if possible """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+            # trello reports its rate limit window in these headers
+            for prefix in ('x-rate-limit-api-token', 'x-rate-limit-api-key'):
+                remaining = response.headers.get(prefix + '-remaining')
+                interval = response.headers.get(prefix + '-interval-ms')
+                if remaining == '0' and interval:
+                    try:
+                        return float(interval) / 1000
+                    except ValueError:
+                        pass
+        return self.backoff * 2 ** attempt
+
     def list_hooks(self, token=None):
         """
         Returns a list of all hooks associated with a specific token. If you don't pass in a token,
@@ -182,7 +295,7 @@ class TrelloClient(object):
 
         print "creating a webhook in trello.py: url=%s, data=%s." % (url, str(data))
 
-        response = requests.post(url, data=data, auth=self.oauth)
+        response = self._request('POST', url, data=data, auth=self.oauth)
         #response = requests.post(url, data=data)
         print "response text: ", response.text
         print "response status: ", response.status_code
@@ -676,6 +789,11 @@ class Card(object):
             http_method='POST',
             post_args={'url': url, 'name': desc, }, )
 
+    def get_attachments(self):
+        return self.client.fetch_json(
+            '/cards/' + self.id + '/attachments',
+            query_params={'fields': 'url'}, )
+
 
 
 class Member(object):
@@ -3,8 +3,13 @@ from trello import TrelloClient
 from trello import Board
 from trello import List
 from trello import Card
+from trello import ResourceUnavailable
+
+from db_def import db
+from db_def import Note
 
 import re
+import time
 from requests_oauthlib import OAuth1
 
 # for MJ
@@ -32,6 +37,11 @@ BOARD_ID_LONG_OBSV = '53eca60442d60cbc95778fe4'
 TRELLO_CLIENT = 'NULL'
 DEFAULT_LIST = 'To Do'
 
+# the lists of both boards are cached for this many seconds; the webhook
+# drops the cache earlier when a list is created or renamed
+LIST_CACHE_TTL = 600
+LIST_CACHE = {'expires_at': 0, 'by_name': {}, 'by_id': {}}
+
 def setup():
     create_client()
     #create_webhooks()
@@ -62,6 +72,7 @@ def check_init():
 def create_list_by_name(name):
     board = Board(TRELLO_CLIENT, BOARD_ID_LONG_OBSV)
     l = board.add_list(name)
+    invalidate_lists()
     return l
 
 def create_webhooks():
@@ -90,60 +101,136 @@ def get_cards(board_id):
     cards = board.all_cards()
     return cards
 
+def get_card_ids(board_id, card_filter='all'):
+    # only the ids, much lighter than get_cards for bulk operations
+    json_obj = TRELLO_CLIENT.fetch_json('/boards/' + board_id + '/cards',
+        query_params={'filter': card_filter, 'fields': 'id'})
+    return [x['id'] for x in json_obj]
+
 def find_card_by_its_id(card_id):
-    cards = get_cards(BOARD_ID_LONG_IDEAS)
-    for c in cards:
-        if c.id == card_id:
-            return c
-    cards = get_cards(BOARD_ID_LONG_OBSV)
-    for c in cards:
-        if c.id == card_id:
-            return c
-    return None
+    try:
+        return TRELLO_CLIENT.get_card(card_id)
+    except ResourceUnavailable as e:
+        if not card_is_gone(e):
+            raise
+        return None
+
+#
+# note -> card index, kept in note.trello_card_id and note.trello_list_id
+#
+
+def remember_card(note_id, card_id, list_id):
+    note = Note.query.get(note_id)
+    if note and (note.trello_card_id != card_id or note.trello_list_id != list_id):
+        note.trello_card_id = card_id
+        note.trello_list_id = list_id
+        # committed by the caller, with the rest of its changes
+        db.session.flush()
+
+def forget_card(note_id):
+    remember_card(note_id, None, None)
+
+def card_is_gone(e):
+    # trello answers 404 for deleted cards and 400 for malformed ids, other
+    # failures are worth retrying
+    return e.status in (400, 404)
+
+def card_stub(card_id, list_id=None, board_id=None):
+    # a card known by its id only, enough to update, move, comment or delete
+    # it without fetching it first
+    return Card(List(Board(TRELLO_CLIENT, board_id), list_id), card_id)
 
 def get_card_by_id(note_id):
-    cards = get_cards(BOARD_ID_LONG_IDEAS)
-    for c in cards:
-        cid = find_note_id_from_trello_card_desc(c.desc)
-        if int(cid) == note_id:
-            return c
-    cards = get_cards(BOARD_ID_LONG_OBSV)
-    for c in cards:
-        cid = find_note_id_from_trello_card_desc(c.desc)
-        if int(cid) == note_id:
-            return c
-    return None
+    note = Note.query.get(note_id)
+    if note is None or not note.trello_card_id:
+        return None
+    return card_stub(note.trello_card_id, note.trello_list_id)
+
+def get_cards_by_note_ids(note_ids):
+    # one query for the cards of many notes, by note id
+    cards = {}
+    if len(note_ids) == 0:
+        return cards
+    notes = Note.query.filter(Note.id.in_(note_ids), Note.trello_card_id != None).all()
+    for note in notes:
+        cards[note.id] = card_stub(note.trello_card_id, note.trello_list_id)
+    return cards
 
+def get_cards_actions(card_ids, action_filter):
+    # the actions of many cards through the batch api, by card id. filter
+    # may not combine several action types, the batch api splits on commas.
+    # cards whose request failed are left out, they are not cards without
+    # actions
+    paths = ['/cards/%s/actions?filter=%s' % (card_id, action_filter) for card_id in card_ids]
+    results = TRELLO_CLIENT.fetch_json_batch(paths)
+    actions = {}
+    for card_id, result in zip(card_ids, results):
+        if result is None:
+            print "could not fetch the actions of card %s" % (card_id)
+            continue
+        actions[card_id] = result
+    return actions
+
+def get_cards_comments(card_ids):
+    return get_cards_actions(card_ids, 'commentCard')
+
+def get_note_id_by_card(card):
+    note = Note.query.filter_by(trello_card_id=card.id).first()
+    if note:
+        return note.id
+    # cards created before the index existed, or from trello itself
+    note_id = find_note_id_from_trello_card_desc(card.desc)
+    if note_id != -1:
+        remember_card(note_id, card.id, getattr(card, 'idList', None))
+    return note_id
+
+def index_all_cards():
+    n = 0
+    for board_id in [BOARD_ID_LONG_IDEAS, BOARD_ID_LONG_OBSV]:
+        for c in get_cards(board_id):
+            note_id = find_note_id_from_trello_card_desc(c.desc)
+            if note_id != -1:
+                remember_card(note_id, c.id, c.idList)
+                n = n + 1
+    return n
+
+
+def get_lists():
+    if time.time() >= LIST_CACHE['expires_at']:
+        by_name = {}
+        by_id = {}
+        for board_id in [BOARD_ID_LONG_IDEAS, BOARD_ID_LONG_OBSV]:
+            for x in Board(TRELLO_CLIENT, board_id).all_lists():
+                by_id[x.id] = x
+                # the ideas board wins when both boards have the same name
+                by_name.setdefault(x.name.lower(), x)
+        LIST_CACHE['by_name'] = by_name
+        LIST_CACHE['by_id'] = by_id
+        LIST_CACHE['expires_at'] = time.time() + LIST_CACHE_TTL
+    return LIST_CACHE
+
+def invalidate_lists():
+    LIST_CACHE['expires_at'] = 0
 
 def get_list(list_id):
+    list = get_lists()['by_id'].get(list_id)
+    if list:
+        return list
     board = Board(TRELLO_CLIENT, BOARD_ID_LONG_IDEAS)
     list = List(board, list_id)
-    if not list:
-        board = Board(TRELLO_CLIENT, BOARD_ID_LONG_OBSV)
-        list = List(board, list_id)
     list.fetch()
     return list
 
 def get_list_id(list_name):
-    board = Board(TRELLO_CLIENT, BOARD_ID_LONG_IDEAS)
-    lists = board.all_lists()
-    for x in lists:
-        if x.name.lower() == list_name.lower():
-            return x.id
-    board = Board(TRELLO_CLIENT, BOARD_ID_LONG_OBSV)
-    lists = board.all_lists()
-    for x in lists:
-        if x.name.lower() == list_name.lower():
-            return x.id
+    list = get_lists()['by_name'].get(list_name.lower())
+    if list:
+        return list.id
     return None
 
 def get_card_by_id_in_list(note_id, list_id):
-    list = get_list(list_id)
-    cards = list.list_cards()
-    for c in cards:
-        cid = find_note_id_from_trello_card_desc(c.desc)
-        if int(cid) == note_id:
-            return c
+    c = get_card_by_id(note_id)
+    if c and c.trello_list.id == list_id:
+        return c
     return None
 
 def add_card(note_id, title, description, list_name, use_default_list=False, create_list=False):
@@ -165,21 +252,43 @@ def add_card(note_id, title, description, list_name, use_default_list=False, cre
         elif create_list:
             l = create_list_by_name(list_name)
             c = l.add_card(title, description)
+            remember_card(note_id, c.id, l.id)
             return c
         else:
             return None
     if not get_card_by_id_in_list(note_id, list_id):
         list = get_list(list_id)
         c = list.add_card(title, description)
+        remember_card(note_id, c.id, list_id)
         return c
     return None
 
 def add_card_with_attachment(note_id, title, description, list_name, url, create_list=True):
     c = add_card(note_id, title, description, list_name, create_list=create_list)
-    if not c:
-        return None
-    print "adding the attachment..."
-    c.add_attachment(url, "the attachment")
+    if c:
+        print "adding the attachment..."
+        c.add_attachment(url, "the attachment")
+        return c
+    # the card was already there, maybe without its attachment
+    return add_attachment(note_id, url)
+
+def add_attachment(note_id, url):
+    # attaches url to the card of the note unless it already is, so that
+    # doing it again is harmless
+    if not check_init():
+        print "Not initialized. Use setup function to initialize."
+        return
+    c = get_card_by_id(note_id)
+    if c:
+        try:
+            if not any(a.get('url') == url for a in c.get_attachments()):
+                print "adding the attachment..."
+                c.add_attachment(url, "the attachment")
+        except ResourceUnavailable as e:
+            if not card_is_gone(e):
+                raise
+            forget_card(note_id)
+            return None
     return c
 
 def move_card(note_id, list_name_to):
@@ -189,7 +298,14 @@ def move_card(note_id, list_name_to):
     list_id_to = get_list_id(list_name_to)
     c = get_card_by_id(note_id)
     if c:
-        c.change_list(list_id_to)
+        try:
+            c.change_list(list_id_to)
+        except ResourceUnavailable as e:
+            if not card_is_gone(e):
+                raise
+            forget_card(note_id)
+            return None
+        remember_card(note_id, c.id, list_id_to)
         return c
     return None
 
@@ -199,7 +315,12 @@ def delete_card(note_id):
         return
     c = get_card_by_id(note_id)
     if c:
-        c.delete()
+        try:
+            c.delete()
+        except ResourceUnavailable as e:
+            if not card_is_gone(e):
+                raise
+        forget_card(note_id)
     return
 
 def delete_cards(list_name):
@@ -214,38 +335,36 @@ def delete_cards(list_name):
             c.delete()
     return
 
+def delete_board_cards(board_id):
+    # trello only batches GETs, so this is one DELETE per card over the
+    # pooled session
+    card_ids = get_card_ids(board_id)
+    for card_id in card_ids:
+        card_stub(card_id, board_id=board_id).delete()
+    Note.query.filter(Note.trello_card_id.in_(card_ids)).update(
+        {'trello_card_id': None, 'trello_list_id': None}, synchronize_session=False)
+    db.session.commit()
+
 def delete_all_cards_ideas():
     if not check_init():
         print "Not initialized. Use setup function to initialize."
         return
-    cards = get_cards(BOARD_ID_LONG_IDEAS)
-    if cards:
-        for c in cards:
-            c.delete()
+    delete_board_cards(BOARD_ID_LONG_IDEAS)
     return
 
 def delete_all_cards_obsv():
     if not check_init():
         print "Not initialized. Use setup function to initialize."
         return
-    cards = get_cards(BOARD_ID_LONG_OBSV)
-    if cards:
-        for c in cards:
-            c.delete()
+    delete_board_cards(BOARD_ID_LONG_OBSV)
     return
 
 def delete_all_cards():
     if not check_init():
         print "Not initialized. Use setup function to initialize."
         return
-    cards = get_cards(BOARD_ID_LONG_IDEAS)
-    if cards:
-        for c in cards:
-            c.delete()
-    cards = get_cards(BOARD_ID_LONG_OBSV)
-    if cards:
-        for c in cards:
-            c.delete()
+    delete_board_cards(BOARD_ID_LONG_IDEAS)
+    delete_board_cards(BOARD_ID_LONG_OBSV)
     return
 
 def update_card(note_id, title, description):
@@ -255,9 +374,15 @@ def update_card(note_id, title, description):
     c = get_card_by_id(note_id)
     # print "updating card: title = %s" % (title)
     if c:
-        c._set_remote_attribute('desc', description)
-        if len(title)>0:
-            c._set_remote_attribute('name', title)
+        try:
+            c._set_remote_attribute('desc', description)
+            if len(title)>0:
+                c._set_remote_attribute('name', title)
+        except ResourceUnavailable as e:
+            if not card_is_gone(e):
+                raise
+            print "card was removed from trello."
+            forget_card(note_id)
     else:
         print "card not found."
     return
@@ -269,12 +394,19 @@ def add_comment_card(id, title, comment_text):
     c = get_card_by_id(id)
     # print "adding comment to card: title = %s" % (title)
     if c:
-        c.comment(comment_text)
+        try:
+            c.comment(comment_text)
+        except ResourceUnavailable as e:
+            if not card_is_gone(e):
+                raise
+            forget_card(id)
     return
 
-def comment_exists(card, text):
-    card.fetch()
-    comments = card.comments
+def comment_exists(card, text, comments=None):
+    # pass the comments from get_cards_comments to avoid fetching the card
+    if comments is None:
+        card.fetch()
+        comments = card.comments
     for comment in comments:
         the_comment = comment['data']['text']
         if the_comment == text:
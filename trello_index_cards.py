@@ -0,0 +1,12 @@
+import trello_api
+from db_def import db
+
+# fills note.trello_card_id and note.trello_list_id from the cards on both
+# boards; the webhook keeps them up to date afterwards.
+
+trello_api.setup()
+
+print "indexing trello cards..."
+n = trello_api.index_all_cards()
+db.session.commit()
+print "Done. (" + str(n) + " cards were indexed.)"
@@ -59,7 +59,7 @@ context = Context.query.filter(Context.name.ilike(context_name)).first()
 #             # db.session.add(feedback)
 #             # db.session.commit()
 #         else:
-#             f = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==note.id, Feedback.kind=='comment', Feedback.content==comment['data']['text']).first()
+#             f = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='comment', Feedback.content==comment['data']['text']).first()
 #             if not f:
 #                 feedback = Feedback(1, 'comment', comment['data']['text'], 'note', note.id, 0)
 #                 db.session.add(feedback)
@@ -67,14 +67,15 @@ context = Context.query.filter(Context.name.ilike(context_name)).first()
 
 # second pass (server -> trello)
 # print "SECOND PASS"
-ideas = Note.query.filter(Note.kind.ilike('designidea'), Note.context_id==context.id).all()
+ideas = Note.query.filter(Note.kind == 'DesignIdea', Note.context_id==context.id).all()
 print "%s ideas to sync." % len(ideas)
+cards = trello_api.get_cards_by_note_ids([i.id for i in ideas])
 num_new_cards = 0
 for i in ideas:
     # look if it does not exists in trello create it, else update it
-    card = trello_api.get_card_by_id(i.id)
-    feedbacks_comment = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==i.id, Feedback.kind=='comment').all()
-    feedbacks_like = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==i.id, Feedback.kind=='like').all()
+    card = cards.get(i.id)
+    feedbacks_comment = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==i.id, Feedback.kind=='comment').all()
+    feedbacks_like = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==i.id, Feedback.kind=='like').all()
     new_desc = i.to_trello_desc() + "\r\n#likes: " + str(len(feedbacks_like)) + "\r\n#comments: " + str(len(feedbacks_comment))
     new_card = None
     if not card:
@@ -89,6 +90,7 @@ for i in ideas:
             i.status = trello_api.DEFAULT_LIST
             list_name = trello_api.DEFAULT_LIST
         new_card = trello_api.add_card(i.id, i.content, new_desc, list_name, use_default_list=True)
+        db.session.commit()
 #     # updating the comments
 #     for comment in feedbacks_comment:
 #         account = Account.query.filter_by(id=comment.account_id).first()
@@ -37,6 +37,11 @@ medias = Media.query.filter(Media.created_at >= d1, Media.created_at < d2).all()
 n = 0
 print "# of medias", str(len(medias))
 
+# the cards and their comments for all the notes up front, in batches
+note_ids = [media.note.id for media in medias if media.note]
+cards = trello_api.get_cards_by_note_ids(note_ids)
+comments_by_card = trello_api.get_cards_comments([card.id for card in cards.values()])
+
 for media in medias:
     note = media.note
     if not note:
@@ -45,16 +50,16 @@ for media in medias:
         continue
     if note.context.id not in context_ids:
         continue
-    feedbacks_comment = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==note.id, Feedback.kind=='comment').all()
-    feedbacks_like = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==note.id, Feedback.kind=='like').all()
-    feedback_landmark = Feedback.query.filter(Feedback.table_name.ilike('note'), Feedback.row_id==note.id, Feedback.kind=='Landmark').first()
+    feedbacks_comment = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='comment').all()
+    feedbacks_like = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='like').all()
+    feedback_landmark = Feedback.query.filter(Feedback.table_name == 'note', Feedback.row_id==note.id, Feedback.kind=='Landmark').first()
     location_text = ""
     if note.kind == "FieldNote" and feedback_landmark:
         location = Context.query.filter_by(name=feedback_landmark.content).first()
         if location:
             location_text = "location: " + location.title + "\r\n"
     new_desc = location_text + note.to_trello_desc() + "\r\n#likes: " + str(len(feedbacks_like))
-    card = trello_api.get_card_by_id(note.id)
+    card = cards.get(note.id)
     new_card = False
     if card:
         # update the card
@@ -72,7 +77,11 @@ for media in medias:
             card = trello_api.add_card_with_attachment(note.id, media.link, new_desc, note.status, media.get_url())
         else:
             card = trello_api.add_card_with_attachment(note.id, note.content, new_desc, note.status, media.get_url())
-    # updating comments
+        db.session.commit()
+    # updating comments, unless trello failed to tell which the card has
+    if not new_card and card.id not in comments_by_card:
+        print "skipping the comments of note %s, its card could not be fetched" % (note.id)
+        continue
     for comment in feedbacks_comment:
         account = Account.query.filter_by(id=comment.account_id).first()
         name = 'The Design Team'
@@ -82,9 +91,10 @@ for media in medias:
             print "Adding comment to a new card."
             trello_api.add_comment_card(note.id, card.name, "[" + name + "] " + comment.content)
         else:
-            e = trello_api.comment_exists(card, comment.content)
+            e = trello_api.comment_exists(card, comment.content, comments_by_card[card.id])
             if not e:
                 print "Adding comment to an existing card."
                 trello_api.add_comment_card(note.id, card.name, "[" + name + "] " + comment.content)
 
+db.session.commit()
 print "Done. (" + str(n) + " cards were added to trello.)"
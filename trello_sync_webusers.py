@@ -16,10 +16,14 @@ cards = trello_list.list_cards()
 
 print "number of cards: ", str(len(cards))
 
+# list_cards already has the descriptions, the creators come in batches
+actions_by_card = trello_api.get_cards_actions([card.id for card in cards], 'createCard')
+
 for card in cards:
-    card.fetch()
-    card.fetch_actions()
-    actions = card.actions
+    if card.id not in actions_by_card:
+        print "skipping card %s, its actions could not be fetched" % (card.id)
+        continue
+    actions = actions_by_card[card.id]
     for action in actions:
         if action['type'] == 'createCard':
             creator = action['memberCreator']
@@ -27,13 +31,14 @@ for card in cards:
             if account:
                 if not card.desc:
                     note = Note.query.filter_by(content=card.name).first()
+                    note_id = note.id
                     new_desc = note.to_trello_desc() + "\r\n#likes: 0"
                     card._set_remote_attribute('desc', new_desc)
                 else:
                     note_id = trello_api.find_note_id_from_trello_card_desc(card.desc)
                     note = Note.query.get(note_id)
                 note.web_username = account.username
-                note.trello_card_id = card.id
+                trello_api.remember_card(note.id, card.id, listid)
                 note.modified_at = datetime.now()
                 db.session.commit()
                 print "note_id: %s updated." % (note_id)
@@ -1,6 +1,7 @@
 
 
 import trello_api
+from db_def import db
 from db_def import Note
 from db_def import Media
 
@@ -13,5 +14,6 @@ note = Note.query.get(194)
 media = Media.query.filter_by(note_id=194).first()
 trello_api.add_card_with_attachment(194, note.content, note.to_trello_desc(), note.status,
                                     media.get_url())
+db.session.commit()
 
 print "Done."
@@ -0,0 +1,5 @@
+import api
+import jobs
+
+# importing api registers the job handlers and sets up the trello client
+jobs.work()